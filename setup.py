@@ -17,7 +17,8 @@ tests_require = [
     "pytest-black",
     "pytest-flakes",
     "pytest-cov",
-    "pytest-mypy"
+    "pytest-mypy",
+    "utide",
 ]
 
 setup(
@@ -35,6 +36,6 @@ setup(
     zip_safe=False,
     install_requires=install_requires,
     tests_require=tests_require,
-    extras_require={"test": tests_require},
+    extras_require={"test": tests_require, "telemetry": ["pyarrow"]},
     entry_points={"console_scripts": ["run-tuflow-flash = tuflowflash.start_sim:main"]}
 )
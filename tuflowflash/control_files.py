@@ -0,0 +1,402 @@
+from dataclasses import asdict
+from dataclasses import dataclass
+from dataclasses import field
+from pathlib import Path
+from typing import Dict
+from typing import List
+from typing import Optional
+
+import json
+import logging
+import os
+import re
+
+
+logger = logging.getLogger(__name__)
+
+INDEX_CACHE_VERSION = 1
+
+# Commands that pull another control file into the tree
+INCLUDE_COMMANDS = (
+    "read file",
+    "geometry control file",
+    "bc control file",
+    "estry control file",
+    "estry control file auto",
+    "rainfall control file",
+    "operating controls file",
+    "external stress file",
+    "quadtree control file",
+    "read operating controls file",
+)
+# Commands (besides includes and "read ...") that reference an input file
+INPUT_COMMANDS = (
+    "bc database",
+    "shp projection",
+    "gis projection",
+    "tif projection",
+    "pipe network",
+)
+COMMENT_CHARACTERS = ("!", "#")
+# marks the control files tuflowflash generates
+GENERATED_MARKER = "! generated by tuflowflash, do not edit"
+# folder next to the tcf with the control files tuflowflash generates
+GENERATED_FOLDER = "tuflowflash"
+VARIABLE_PATTERN = re.compile(r"<<(.+?)>>")
+
+
+@dataclass
+class InputFile:
+    command: str
+    path: str
+    control_file: str
+
+
+@dataclass
+class ModelIndex:
+    """Resolved view of a TUFLOW control file tree.
+
+    ``commands`` holds the last active value per (lower case) command, which is
+    the value TUFLOW uses. Paths are resolved against the control file that
+    references them.
+    """
+
+    tcf_file: str
+    scenarios: List[str] = field(default_factory=list)
+    events: List[str] = field(default_factory=list)
+    control_files: List[str] = field(default_factory=list)
+    input_files: List[InputFile] = field(default_factory=list)
+    commands: Dict[str, str] = field(default_factory=dict)
+    start_time: Optional[float] = None
+    end_time: Optional[float] = None
+    output_folder: Optional[str] = None
+    log_folder: Optional[str] = None
+    check_folder: Optional[str] = None
+    map_output_formats: List[str] = field(default_factory=list)
+    map_output_data_types: List[str] = field(default_factory=list)
+    map_output_times: List[float] = field(default_factory=list)
+    restart_file: Optional[str] = None
+    write_restart_time: Optional[float] = None
+    write_restart_interval: Optional[float] = None
+
+    def get(self, command, default=None):
+        return self.commands.get(command.lower(), default)
+
+    def input_paths(self):
+        return [Path(input_file.path) for input_file in self.input_files]
+
+    @classmethod
+    def from_dict(cls, data):
+        data = dict(data)
+        data["input_files"] = [InputFile(**f) for f in data["input_files"]]
+        return cls(**data)
+
+
+def split_command(line):
+    """Return (command, value) of a control file line, or None."""
+    for comment_character in COMMENT_CHARACTERS:
+        line = line.split(comment_character)[0]
+    if "==" not in line:
+        return (line.strip().lower(), None) if line.strip() else None
+    command, value = line.split("==", 1)
+    return command.strip().lower(), value.strip()
+
+
+def resolve_path(folder, value):
+    """Resolve a (possibly Windows style) relative path against a folder."""
+    return os.path.normpath(os.path.join(str(folder), value.replace("\\", "/")))
+
+
+def split_values(value):
+    return [v.strip() for v in value.split("|") if v.strip()]
+
+
+def looks_like_file(value):
+    return bool(Path(value).suffix) and not value.replace(".", "", 1).isdigit()
+
+
+class ControlFileParser:
+    """Walk a .tcf and every control file it includes.
+
+    ``If Scenario``/``If Event`` blocks are evaluated against the given (or the
+    tcf's ``Model Scenarios``/``Model Events``) scenarios and events and
+    ``Set Variable`` values are substituted in ``<<name>>`` placeholders.
+    """
+
+    def __init__(self, tcf_file, scenarios=None, events=None):
+        self.tcf_file = Path(tcf_file)
+        self.scenarios = [s.lower() for s in scenarios or []]
+        self.events = [e.lower() for e in events or []]
+        self.variables = {}
+        self.index = ModelIndex(
+            tcf_file=str(self.tcf_file),
+            scenarios=list(scenarios or []),
+            events=list(events or []),
+        )
+
+    def parse(self):
+        self.read_control_file(self.tcf_file)
+        self.finalise_index()
+        return self.index
+
+    def substitute(self, value):
+        for number, scenario in enumerate(self.index.scenarios, start=1):
+            value = value.replace("~s{}~".format(number), scenario)
+        for number, event in enumerate(self.index.events, start=1):
+            value = value.replace("~e{}~".format(number), event)
+        return VARIABLE_PATTERN.sub(
+            lambda m: self.variables.get(m.group(1).lower(), m.group(0)), value
+        )
+
+    def condition_is_active(self, command, value):
+        options = [v.lower() for v in split_values(value)]
+        if "scenario" in command:
+            return any(option in self.scenarios for option in options)
+        return any(option in self.events for option in options)
+
+    def read_control_file(self, control_file):
+        control_file = Path(control_file)
+        if str(control_file) in self.index.control_files:
+            return
+        self.index.control_files.append(str(control_file))
+        with open(control_file) as f:
+            lines = f.readlines()
+
+        # stack of (branch active, a branch of this block was already taken)
+        blocks = []
+        for line in lines:
+            parsed = split_command(line)
+            if parsed is None:
+                continue
+            command, value = parsed
+            parent_active = all(active for active, _ in blocks)
+
+            if command in ("if scenario", "if event"):
+                active = parent_active and self.condition_is_active(command, value)
+                blocks.append((active, active))
+                continue
+            if command in ("else if scenario", "else if event") and blocks:
+                _, taken = blocks.pop()
+                parent_active = all(active for active, _ in blocks)
+                active = (
+                    parent_active
+                    and not taken
+                    and self.condition_is_active(command, value)
+                )
+                blocks.append((active, taken or active))
+                continue
+            if command == "else" and blocks:
+                _, taken = blocks.pop()
+                parent_active = all(active for active, _ in blocks)
+                blocks.append((parent_active and not taken, True))
+                continue
+            if command in ("end if", "endif") and blocks:
+                blocks.pop()
+                continue
+            if command == "estry control file auto" and value is None:
+                value = "auto"
+            if not parent_active or value is None:
+                continue
+
+            value = self.substitute(value)
+            self.handle_command(control_file, command, value)
+
+    def handle_command(self, control_file, command, value):
+        if command.startswith("set variable"):
+            name = command[len("set variable") :].strip()
+            self.variables[name] = value
+            return
+        if command == "model scenarios" and not self.scenarios:
+            self.index.scenarios = split_values(value)
+            self.scenarios = [s.lower() for s in self.index.scenarios]
+        if command == "model events" and not self.events:
+            self.index.events = split_values(value)
+            self.events = [e.lower() for e in self.index.events]
+
+        self.index.commands[command] = value
+        folder = control_file.parent
+
+        if command in INCLUDE_COMMANDS:
+            if value.lower() == "auto" or command.endswith("auto"):
+                include = self.tcf_file.with_suffix(".ecf")
+            else:
+                include = Path(resolve_path(folder, value))
+            self.index.input_files.append(
+                InputFile(command, str(include), str(control_file))
+            )
+            if include.exists():
+                self.read_control_file(include)
+            else:
+                logger.warning("Control file %s not found", include)
+        elif command.startswith("read ") or command in INPUT_COMMANDS:
+            for part in split_values(value):
+                if looks_like_file(part):
+                    self.index.input_files.append(
+                        InputFile(
+                            command,
+                            resolve_path(folder, part),
+                            str(control_file),
+                        )
+                    )
+
+    def finalise_index(self):
+        index = self.index
+        tcf_folder = self.tcf_file.parent
+
+        def folder(command):
+            value = index.get(command)
+            return resolve_path(tcf_folder, value) if value else None
+
+        def number(command):
+            value = index.get(command)
+            return float(value) if value else None
+
+        index.start_time = number("start time")
+        index.end_time = number("end time")
+        index.output_folder = folder("output folder")
+        index.log_folder = folder("log folder")
+        index.check_folder = folder("write check files")
+        restart_file = index.get("read restart file")
+        if restart_file:
+            index.restart_file = resolve_path(tcf_folder, restart_file)
+        index.write_restart_time = number("write restart file at time")
+        index.write_restart_interval = number("write restart file interval")
+
+        index.map_output_formats = split_values(
+            index.get("map output format", "").replace(" ", "|")
+        )
+        index.map_output_data_types = split_values(
+            index.get("map output data types", "").replace(" ", "|")
+        )
+        index.map_output_times = self.map_output_times()
+
+    def map_output_times(self):
+        index = self.index
+        explicit_times = index.get("map output times")
+        if explicit_times:
+            return [float(t) for t in re.split(r"[,\s]+", explicit_times) if t]
+        interval = index.get("map output interval")
+        if not interval or index.end_time is None:
+            return []
+        interval_hours = float(interval) / 3600
+        if interval_hours <= 0:
+            return []
+        start = float(index.get("start map output", index.start_time or 0))
+        end = float(index.get("end map output", index.end_time))
+        count = int(round((end - start) / interval_hours)) + 1
+        return [round(start + i * interval_hours, 6) for i in range(max(count, 0))]
+
+
+def generated_file(tcf_file, suffix):
+    """Return the generated file ``<tcf name><suffix>`` of a tcf."""
+    tcf_file = Path(tcf_file)
+    return tcf_file.parent / GENERATED_FOLDER / (tcf_file.stem + suffix)
+
+
+def run_control_file(tcf_file):
+    """Return the generated copy of a tcf that TUFLOW runs.
+
+    It has the name of the tcf, so TUFLOW names the results the same.
+    """
+    return generated_file(tcf_file, Path(tcf_file).suffix)
+
+
+def write_if_changed(path, lines):
+    content = "\n".join([GENERATED_MARKER] + lines) + "\n"
+    # unchanged files keep their mtime, so the model index stays cached
+    if not path.exists() or path.read_text() != content:
+        path.write_text(content)
+
+
+def write_run_control_file(tcf_file, commands=(), generated_files=()):
+    """Write the tcf TUFLOW runs: the model's tcf followed by generated files.
+
+    The model's tcf is left untouched. The copy reads it, then sets
+    ``commands`` ((command, path) pairs, written as absolute paths) and then
+    reads each generated file, so these override the model's commands. Use
+    ``commands`` for the folders TUFLOW resolves against the tcf, such as the
+    output and log folder. ``ESTRY Control File Auto`` finds a generated
+    ``.ecf`` that reads the model's ``.ecf``. Returns the generated tcf.
+    """
+    tcf_file = Path(tcf_file)
+    run_tcf = run_control_file(tcf_file)
+    run_tcf.parent.mkdir(exist_ok=True)
+
+    def read_file(path):
+        return "Read File == {}".format(os.path.relpath(path, run_tcf.parent))
+
+    ecf_file = tcf_file.with_suffix(".ecf")
+    if ecf_file.exists():
+        write_if_changed(run_tcf.with_suffix(".ecf"), [read_file(ecf_file)])
+    lines = [read_file(tcf_file)]
+    lines += [
+        "{} == {}".format(command, os.path.abspath(path)) for command, path in commands
+    ]
+    lines += [read_file(path) for path in generated_files]
+    write_if_changed(run_tcf, lines)
+    return run_tcf
+
+
+def cache_file_for(tcf_file):
+    tcf_file = Path(tcf_file)
+    return tcf_file.parent / (".{}.index.json".format(tcf_file.name))
+
+
+def control_file_mtimes(control_files):
+    """Return mtimes of the control files, None for control files not found."""
+    return {
+        control_file: (
+            os.stat(control_file).st_mtime_ns if os.path.exists(control_file) else None
+        )
+        for control_file in control_files
+    }
+
+
+def referenced_control_files(index):
+    includes = [
+        input_file.path
+        for input_file in index.input_files
+        if input_file.command in INCLUDE_COMMANDS
+    ]
+    return list(dict.fromkeys([index.tcf_file] + index.control_files + includes))
+
+
+def load_model_index(tcf_file, scenarios=None, events=None, cache_file=None):
+    """Return the ModelIndex of a .tcf, reusing the on-disk cache when valid.
+
+    The cache is invalidated when any control file of the tree changed (mtime)
+    or when other scenarios/events are requested.
+    """
+    cache_file = Path(cache_file) if cache_file else cache_file_for(tcf_file)
+    key = {
+        "version": INDEX_CACHE_VERSION,
+        "tcf_file": str(tcf_file),
+        "scenarios": list(scenarios or []),
+        "events": list(events or []),
+    }
+    if cache_file.exists():
+        try:
+            with open(cache_file) as f:
+                cached = json.load(f)
+            if cached["key"] == key and cached["mtimes"] == control_file_mtimes(
+                cached["mtimes"].keys()
+            ):
+                logger.debug("Using cached model index %s", cache_file)
+                return ModelIndex.from_dict(cached["index"])
+        except (ValueError, KeyError, TypeError, OSError):
+            logger.warning("Ignoring invalid model index cache %s", cache_file)
+
+    index = ControlFileParser(tcf_file, scenarios, events).parse()
+    try:
+        with open(cache_file, "w") as f:
+            json.dump(
+                {
+                    "key": key,
+                    "mtimes": control_file_mtimes(referenced_control_files(index)),
+                    "index": asdict(index),
+                },
+                f,
+            )
+    except OSError:
+        logger.warning("Could not write model index cache %s", cache_file)
+    return index
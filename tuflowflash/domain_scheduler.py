@@ -0,0 +1,225 @@
+from concurrent.futures import FIRST_COMPLETED
+from concurrent.futures import ThreadPoolExecutor
+from concurrent.futures import wait
+from pathlib import Path
+from tuflowflash import tracing
+from tuflowflash.job_queue import SIMULATION
+
+import logging
+import time
+
+
+logger = logging.getLogger(__name__)
+
+DEFAULT_POST_PROCESSING_WORKERS = 2
+STATE_FOLDER_SETTINGS = ("initial_states_folder", "export_states_folder")
+
+
+class DomainSchedulerException(Exception):
+    pass
+
+
+class Domain:
+    """One TUFLOW control file to run, needing ``units`` processing units."""
+
+    def __init__(self, settings, units=1, name=None):
+        self.settings = settings
+        self.units = units
+        self.name = name or Path(settings.tcf_file).stem
+
+
+def domains_from_settings(settings):
+    """Return the Domains of ``tuflow_domains`` (with ``tuflow_domain_units``)."""
+    tcf_files = [f.strip() for f in settings.tuflow_domains]
+    units = [int(u) for u in getattr(settings, "tuflow_domain_units", [])]
+    if not units:
+        units = [1] * len(tcf_files)
+    if len(units) != len(tcf_files):
+        raise DomainSchedulerException(
+            "tuflow_domains and tuflow_domain_units should have the same length "
+            "in {}.".format(settings.settingsFile)
+        )
+    domains = [
+        Domain(settings.domain_settings(tcf_file), number)
+        for tcf_file, number in zip(tcf_files, units)
+    ]
+    names = [domain.name for domain in domains]
+    for number, domain in enumerate(domains):
+        if names.count(domain.name) > 1:
+            domain.name = "{}_{}".format(domain.name, number + 1)
+    separate_domain_settings(domains)
+    return domains
+
+
+def separate_domain_settings(domains):
+    """Keep the states and uploaded rasters of the domains apart.
+
+    Every domain keeps its warm states in a subfolder named after it. A
+    raster in the upload lists belongs to the domain whose results are named
+    like it (the longest matching simulation name), only that domain
+    uploads it.
+    """
+    from tuflowflash.post_processing import UPLOAD_LISTS
+    from tuflowflash.run_tuflow import TuflowSimulation
+
+    simulation_names = [
+        TuflowSimulation(domain.settings).simulation_name() for domain in domains
+    ]
+    for domain in domains:
+        for setting in STATE_FOLDER_SETTINGS:
+            if hasattr(domain.settings, setting):
+                folder = Path(getattr(domain.settings, setting)) / domain.name
+                setattr(domain.settings, setting, folder)
+
+    for _, setting in UPLOAD_LISTS:
+        if not domains or not hasattr(domains[0].settings, setting):
+            continue
+        upload_lists = [[] for _ in domains]
+        for name in getattr(domains[0].settings, setting):
+            owners = [
+                (len(simulation_name), number)
+                for number, simulation_name in enumerate(simulation_names)
+                if name.strip().startswith(simulation_name + "_")
+            ]
+            if not owners:
+                logger.warning("raster %s in %s is of no domain", name, setting)
+                continue
+            upload_lists[max(owners)[1]].append(name)
+        for domain, upload_list in zip(domains, upload_lists):
+            setattr(domain.settings, setting, upload_list)
+
+
+class DomainScheduler:
+    """Run several TUFLOW domains concurrently within a processing unit budget.
+
+    ``processing_units`` are the ``-pu`` ids available; a domain starts, in
+    order, as soon as enough of them are free and gets its own ids. Every
+    domain that finishes is handed to ``post_process(settings)`` in a separate
+    pool so its units are free for the next domain right away. A failing
+    domain does not stop the others, the first error is re-raised at the end.
+
+    With a ``job_queue`` the domains are run by the queue's workers, all at
+    once; the processing unit budget is then up to the workers.
+    """
+
+    def __init__(
+        self,
+        domains,
+        processing_units,
+        post_process=None,
+        post_processing_workers=DEFAULT_POST_PROCESSING_WORKERS,
+        job_queue=None,
+    ):
+        self.domains = list(domains)
+        self.processing_units = [int(unit) for unit in processing_units]
+        self.post_process = post_process
+        self.post_processing_workers = post_processing_workers
+        self.job_queue = job_queue
+        # wall time of the simulation of each domain in seconds
+        self.durations = {}
+        for domain in self.domains:
+            if job_queue is None and domain.units > len(self.processing_units):
+                raise DomainSchedulerException(
+                    "Domain {} needs {} processing units, only {} available".format(
+                        domain.name, domain.units, len(self.processing_units)
+                    )
+                )
+
+    def run_domain(self, domain, units):
+        from tuflowflash.run_tuflow import TuflowSimulation
+        from tuflowflash.run_tuflow import TuflowSimulationException
+
+        if self.job_queue is not None:
+            logger.info("queueing domain %s", domain.name)
+        else:
+            logger.info(
+                "starting domain %s on processing units %s",
+                domain.name,
+                ", ".join(map(str, units)),
+            )
+        start = time.perf_counter()
+        try:
+            with tracing.span(domain.name, "domain"):
+                if self.job_queue is not None:
+                    self.job_queue.wait(
+                        [
+                            self.job_queue.submit(
+                                SIMULATION, domain.settings, domain.name, domain.units
+                            )
+                        ]
+                    )
+                else:
+                    TuflowSimulation(
+                        domain.settings, processing_units=units, name=domain.name
+                    ).run()
+        except TuflowSimulationException as e:
+            raise DomainSchedulerException(
+                "Domain {} failed: {}".format(domain.name, e)
+            ) from e
+        finally:
+            self.durations[domain.name] = time.perf_counter() - start
+
+    def post_process_domain(self, domain):
+        with tracing.span("post-process " + domain.name, "domain"):
+            self.post_process(domain.settings)
+        logger.info("post-processed domain %s", domain.name)
+
+    def run(self):
+        free_units = list(self.processing_units)
+        workers = len(self.processing_units)
+        if self.job_queue is not None:
+            # queued domains do not take local processing units
+            free_units = []
+            workers = max(len(self.domains), 1)
+        pending = list(self.domains)
+        running = {}
+        post_processing = {}
+        error = None
+
+        with ThreadPoolExecutor(
+            max_workers=workers, thread_name_prefix="domain"
+        ) as executor, ThreadPoolExecutor(
+            max_workers=self.post_processing_workers,
+            thread_name_prefix="domain-post",
+        ) as post_executor:
+            while pending or running:
+                for domain in list(pending):
+                    units = domain.units if self.job_queue is None else 0
+                    if units > len(free_units):
+                        # keep the order, a large domain is not overtaken
+                        break
+                    pending.remove(domain)
+                    units = [free_units.pop(0) for _ in range(units)]
+                    future = executor.submit(self.run_domain, domain, units)
+                    running[future] = (domain, units)
+
+                done, _ = wait(running, return_when=FIRST_COMPLETED)
+                for future in done:
+                    domain, units = running.pop(future)
+                    free_units = sorted(free_units + units)
+                    exception = future.exception()
+                    if exception is not None:
+                        logger.error("domain %s failed: %s", domain.name, exception)
+                        error = error or exception
+                        continue
+                    logger.info(
+                        "domain %s finished in %.0f s",
+                        domain.name,
+                        self.durations[domain.name],
+                    )
+                    if self.post_process is not None:
+                        post_future = post_executor.submit(
+                            self.post_process_domain, domain
+                        )
+                        post_processing[post_future] = domain
+
+            for future, domain in post_processing.items():
+                exception = future.exception()
+                if exception is not None:
+                    logger.error(
+                        "post-processing domain %s failed: %s", domain.name, exception
+                    )
+                    error = error or exception
+
+        if error is not None:
+            raise error
@@ -0,0 +1,349 @@
+from pathlib import Path
+from tuflowflash.control_files import resolve_path
+from tuflowflash.control_files import split_command
+from tuflowflash.lazy_import import lazy_import
+from tuflowflash.tracing import traced
+
+import copy
+import csv
+import json
+import logging
+import numpy as np
+import os
+import re
+
+gdal = lazy_import("gdal", "osgeo.gdal")
+
+logger = logging.getLogger(__name__)
+
+ALL_MEMBERS = "all"
+SELECTION_FILE = "ensemble.json"
+DEFAULT_EXCEEDANCE_DEPTHS = [0.1]
+EXCEEDANCE_BLOCK_ROWS = 256
+EXCEEDANCE_NODATA = -9999
+PERCENTILE_PATTERN = re.compile(r"^p(\d+(?:\.\d+)?)$")
+
+
+class EnsembleException(Exception):
+    pass
+
+
+def select_members(totals, members):
+    """Return {member name: ensemble index} for ``pNN`` percentiles or ``all``.
+
+    A percentile selects the member whose rainfall total is closest to that
+    percentile of all totals.
+    """
+    selection = {}
+    for member in (m.strip().lower() for m in members):
+        if member == ALL_MEMBERS:
+            width = max(len(str(len(totals) - 1)), 2)
+            for index in range(len(totals)):
+                selection["m{:0{}d}".format(index, width)] = index
+            continue
+        match = PERCENTILE_PATTERN.match(member)
+        if match is None or float(match.group(1)) > 100:
+            raise EnsembleException(
+                "Invalid ensemble member '{}', use pNN or {}".format(
+                    member, ALL_MEMBERS
+                )
+            )
+        p = np.percentile(totals, float(match.group(1)))
+        closest = min(totals, key=lambda x: abs(x - p))
+        selection[member] = totals.index(closest)
+    return selection
+
+
+def member_file(path, member):
+    """Return the member variant of a file: ``name.ext`` -> ``name_member.ext``."""
+    path = Path(path)
+    return path.with_name("{}_{}{}".format(path.stem, member, path.suffix))
+
+
+def selection_file(settings):
+    return Path(settings.rain_grids_csv).parent / SELECTION_FILE
+
+
+def write_selection(settings, selection):
+    with open(selection_file(settings), "w") as f:
+        json.dump({"members": selection}, f, indent=1)
+
+
+def read_selection(settings):
+    """Return the members prepared by the nowcast stage, in order."""
+    try:
+        with open(selection_file(settings)) as f:
+            return json.load(f)["members"]
+    except FileNotFoundError as e:
+        raise EnsembleException(
+            "No ensemble members prepared, ensemble_members needs get_bom_nowcast"
+        ) from e
+
+
+def member_rain_settings(settings, member):
+    """Return a copy of the settings with the rain inputs of one member.
+
+    A member's rain grids csv and grids are in a folder named after the
+    member next to ``rain_grids_csv``.
+    """
+    member_settings = copy.copy(settings)
+    rain_grids_csv = Path(settings.rain_grids_csv)
+    member_folder = rain_grids_csv.parent / member
+    member_settings.rain_grids_csv = member_folder / rain_grids_csv.name
+    member_settings.rain_grids_folder = (
+        member_folder / Path(settings.rain_grids_folder).name
+    )
+    member_settings.netcdf_nowcast_rainfall_file = member_file(
+        settings.netcdf_nowcast_rainfall_file, member
+    )
+    return member_settings
+
+
+def relative_reference(path, folder, original):
+    """Return path relative to folder with the separators of ``original``."""
+    reference = os.path.relpath(path, folder)
+    if "\\" in original:
+        reference = reference.replace(os.sep, "\\")
+    return reference
+
+
+def write_member_bc_database(
+    bc_database, member_bc_database, rain_grids_csv, member_rain_grids_csv
+):
+    """Copy the bc database, reading the member's rain grids csv instead."""
+    folder = Path(bc_database).parent
+    target = os.path.abspath(rain_grids_csv)
+    with open(bc_database, newline="") as f:
+        rows = list(csv.reader(f))
+    redirected = False
+    for row in rows[1:]:
+        if len(row) < 2 or not row[1].strip():
+            continue
+        if os.path.abspath(resolve_path(folder, row[1].strip())) == target:
+            row[1] = relative_reference(member_rain_grids_csv, folder, row[1].strip())
+            redirected = True
+    if not redirected:
+        raise EnsembleException(
+            "{} does not read the rain grids csv {}".format(bc_database, rain_grids_csv)
+        )
+    with open(member_bc_database, "w", newline="") as f:
+        csv.writer(f).writerows(rows)
+
+
+def write_member_control_files(settings, member):
+    """Write the tcf (and bc database) of a member next to the originals.
+
+    The member tcf only differs in its bc database, which reads the member's
+    rain grids, so all other inputs and the restart file are shared. TUFLOW
+    names the results after the tcf, so they do not overwrite each other.
+    """
+    tcf_file = Path(settings.tcf_file)
+    bc_databases = [
+        f for f in settings.model_index.input_files if f.command == "bc database"
+    ]
+    if not bc_databases or os.path.normpath(
+        bc_databases[-1].control_file
+    ) != os.path.normpath(str(tcf_file)):
+        raise EnsembleException(
+            "Ensemble runs need the BC Database command in {}".format(tcf_file)
+        )
+    bc_database = bc_databases[-1].path
+    member_bc_database = member_file(bc_database, member)
+    write_member_bc_database(
+        bc_database,
+        member_bc_database,
+        settings.rain_grids_csv,
+        member_rain_settings(settings, member).rain_grids_csv,
+    )
+
+    lines = []
+    redirected = False
+    with open(tcf_file) as f:
+        for line in f:
+            parsed = split_command(line)
+            if parsed is not None and parsed[0] == "bc database" and parsed[1]:
+                if resolve_path(tcf_file.parent, parsed[1]) == bc_database:
+                    line = "BC Database == {}\n".format(
+                        relative_reference(
+                            member_bc_database, tcf_file.parent, parsed[1]
+                        )
+                    )
+                    redirected = True
+            elif parsed is not None and parsed[0] == "estry control file auto":
+                # auto would look for an ecf named after the member tcf
+                line = "ESTRY Control File == {}\n".format(tcf_file.stem + ".ecf")
+            lines.append(line)
+    if not redirected:
+        raise EnsembleException(
+            "Could not find the BC Database line of {}".format(tcf_file)
+        )
+    member_tcf = member_file(tcf_file, member)
+    with open(member_tcf, "w") as f:
+        f.writelines(lines)
+    return member_tcf
+
+
+def member_raster_name(name, simulation_name, member_simulation_name):
+    if not name.startswith(simulation_name):
+        raise EnsembleException(
+            "Raster {} does not start with the simulation name {}".format(
+                name, simulation_name
+            )
+        )
+    return member_simulation_name + name[len(simulation_name) :]
+
+
+def member_settings(settings, member):
+    """Return the settings of a member's simulation (control files written)."""
+    from tuflowflash.run_tuflow import TuflowSimulation
+
+    member_settings = member_rain_settings(settings, member).domain_settings(
+        member_file(settings.tcf_file, member)
+    )
+    # the warm state is prepared once for all members
+    member_settings.manage_states = False
+    simulation_name = TuflowSimulation(settings).simulation_name()
+    member_simulation_name = TuflowSimulation(member_settings).simulation_name()
+    for setting in ("waterdepth_raster_upload_list", "waterlevel_raster_upload_list"):
+        if hasattr(settings, setting):
+            setattr(
+                member_settings,
+                setting,
+                [
+                    member_raster_name(
+                        name.strip(), simulation_name, member_simulation_name
+                    )
+                    for name in getattr(settings, setting)
+                ],
+            )
+    return member_settings
+
+
+def write_exceedance_raster(rasters, depths, out_files, block_rows):
+    """Write per depth the fraction of rasters exceeding it, block by block.
+
+    Only ``block_rows`` rows of one input are in memory at a time, memory does
+    not grow with the number of rasters. Cells without data in any raster are
+    written as nodata.
+    """
+    datasets = [gdal.Open(str(raster)) for raster in rasters]
+    x_size, y_size = datasets[0].RasterXSize, datasets[0].RasterYSize
+    for raster, dataset in zip(rasters, datasets):
+        if (dataset.RasterXSize, dataset.RasterYSize) != (x_size, y_size):
+            raise EnsembleException(
+                "{} is not aligned with {}".format(raster, rasters[0])
+            )
+    bands = [dataset.GetRasterBand(1) for dataset in datasets]
+
+    driver = gdal.GetDriverByName("GTiff")
+    outputs = []
+    for out_file in out_files:
+        out = driver.Create(
+            str(out_file),
+            x_size,
+            y_size,
+            1,
+            gdal.GDT_Float32,
+            options=["COMPRESS=Deflate", "TILED=YES"],
+        )
+        out.SetGeoTransform(datasets[0].GetGeoTransform())
+        out.SetProjection(datasets[0].GetProjection())
+        out.GetRasterBand(1).SetNoDataValue(EXCEEDANCE_NODATA)
+        outputs.append(out)
+
+    for y_off in range(0, y_size, block_rows):
+        rows = min(block_rows, y_size - y_off)
+        counts = np.zeros((len(depths), rows, x_size), dtype=np.uint32)
+        has_data = np.zeros((rows, x_size), dtype=bool)
+        for band in bands:
+            data = band.ReadAsArray(0, y_off, x_size, rows)
+            nodata = band.GetNoDataValue()
+            valid = np.isfinite(data)
+            if nodata is not None:
+                valid &= data != nodata
+            has_data |= valid
+            for number, depth in enumerate(depths):
+                counts[number] += valid & (data > depth)
+        for number, out in enumerate(outputs):
+            probability = np.where(
+                has_data, counts[number] / len(bands), EXCEEDANCE_NODATA
+            ).astype(np.float32)
+            out.GetRasterBand(1).WriteArray(probability, 0, y_off)
+
+    for out in outputs:
+        out.FlushCache()
+    outputs = datasets = None
+
+
+@traced
+def write_exceedance_rasters(settings, members, block_rows=EXCEEDANCE_BLOCK_ROWS):
+    """Write exceedance probability rasters of the members' depth rasters.
+
+    For every raster in ``waterdepth_raster_upload_list`` and every depth in
+    ``exceedance_depths`` a ``<name>_exceedance_<depth>m.tif`` is written to
+    the raster output folder: the fraction of members deeper than that depth.
+    The rasters are local output only, they are not uploaded.
+    """
+    depths = [
+        float(depth)
+        for depth in getattr(settings, "exceedance_depths", DEFAULT_EXCEEDANCE_DEPTHS)
+    ]
+    written = []
+    for number, name in enumerate(
+        getattr(settings, "waterdepth_raster_upload_list", [])
+    ):
+        rasters = [
+            os.path.join(
+                member.raster_output_folder,
+                member.waterdepth_raster_upload_list[number] + ".tif",
+            )
+            for member in members
+        ]
+        missing = [raster for raster in rasters if not os.path.exists(raster)]
+        if missing:
+            logger.warning("Not all members wrote %s: %s", name, ", ".join(missing))
+            continue
+        out_files = [
+            os.path.join(
+                settings.raster_output_folder,
+                "{}_exceedance_{:g}m.tif".format(name.strip(), depth),
+            )
+            for depth in depths
+        ]
+        write_exceedance_raster(rasters, depths, out_files, block_rows)
+        written += out_files
+    logger.info(
+        "wrote %s exceedance probability rasters, local output only", len(written)
+    )
+    return written
+
+
+@traced
+def run_ensemble(settings):
+    """Run the prepared ensemble members concurrently from one warm state.
+
+    The member listed first stands in for the deterministic run: its state
+    is saved. Returns the settings of the members.
+    """
+    from tuflowflash.domain_scheduler import Domain
+    from tuflowflash.domain_scheduler import DomainScheduler
+    from tuflowflash.job_queue import job_queue_from_settings
+    from tuflowflash.run_tuflow import TuflowSimulation
+
+    selection = read_selection(settings)
+    if settings.manage_states:
+        TuflowSimulation(settings).prepare_state()
+    for member in selection:
+        write_member_control_files(settings, member)
+    members = [Domain(member_settings(settings, m), name=m) for m in selection]
+    logger.info("running %s ensemble members", len(members))
+    DomainScheduler(
+        members,
+        getattr(settings, "processing_units", [settings.pu]),
+        job_queue=job_queue_from_settings(settings),
+    ).run()
+    if settings.manage_states and hasattr(settings, "export_states_folder"):
+        TuflowSimulation(members[0].settings).save_state()
+    member_settings_list = [member.settings for member in members]
+    write_exceedance_rasters(settings, member_settings_list)
+    return member_settings_list
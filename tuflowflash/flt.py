@@ -0,0 +1,157 @@
+from dataclasses import dataclass
+from pathlib import Path
+from tuflowflash.lazy_import import lazy_import
+from typing import Optional
+from typing import Tuple
+
+import logging
+import numpy as np
+
+
+gdal = lazy_import("gdal", "osgeo.gdal")
+
+logger = logging.getLogger(__name__)
+
+# rows written to a GeoTIFF at a time
+BLOCK_ROWS = 1024
+BYTE_ORDERS = {"lsbfirst": "<", "msbfirst": ">"}
+
+
+class FltException(Exception):
+    pass
+
+
+def read_flt_header(hdr_file):
+    """Return the (lower case) keys and values of an ESRI .hdr file."""
+    header = {}
+    with open(hdr_file) as f:
+        for line in f:
+            parts = line.split()
+            if len(parts) >= 2:
+                header[parts[0].lower()] = parts[1]
+    missing = {"ncols", "nrows", "cellsize"} - header.keys()
+    if missing:
+        raise FltException("{} misses {}".format(hdr_file, ", ".join(sorted(missing))))
+    return header
+
+
+class RasterStatistics:
+    """Count, minimum, maximum and mean of the valid cells, block by block."""
+
+    def __init__(self):
+        self.valid_cells = 0
+        self.minimum = None
+        self.maximum = None
+        self.total = 0.0
+
+    def add(self, block, nodata=None):
+        valid = np.isfinite(block)
+        if nodata is not None:
+            valid &= block != nodata
+        values = block[valid]
+        if not values.size:
+            return
+        self.valid_cells += int(values.size)
+        self.total += float(values.sum(dtype=np.float64))
+        minimum, maximum = float(values.min()), float(values.max())
+        self.minimum = minimum if self.minimum is None else min(self.minimum, minimum)
+        self.maximum = maximum if self.maximum is None else max(self.maximum, maximum)
+
+    def as_dict(self):
+        return {
+            "valid_cells": self.valid_cells,
+            "min": self.minimum,
+            "max": self.maximum,
+            "mean": self.total / self.valid_cells if self.valid_cells else None,
+        }
+
+
+@dataclass
+class FltRaster:
+    """A float32 grid mapped from disk, rows are only read when used.
+
+    ``data`` is a read only ``np.memmap`` of shape (rows, columns) with the
+    north row first; ``geotransform`` is in GDAL order.
+    """
+
+    path: str
+    data: np.ndarray
+    geotransform: Tuple[float, float, float, float, float, float]
+    nodata: Optional[float] = None
+
+    @property
+    def shape(self):
+        return self.data.shape
+
+    def valid(self, rows=slice(None)):
+        """Return a mask of the cells with data in a range of rows."""
+        block = self.data[rows]
+        valid = np.isfinite(block)
+        if self.nodata is not None:
+            valid &= block != self.nodata
+        return valid
+
+    def to_geotiff(
+        self, out_file, projection=None, block_rows=BLOCK_ROWS, statistics=None
+    ):
+        """Write the grid as a compressed GeoTIFF, ``block_rows`` at a time.
+
+        The written blocks are added to ``statistics`` (a RasterStatistics)
+        when given, so no second pass is needed.
+        """
+        rows, columns = self.shape
+        target = gdal.GetDriverByName("GTiff").Create(
+            str(out_file),
+            columns,
+            rows,
+            1,
+            gdal.GDT_Float32,
+            options=["COMPRESS=Deflate"],
+        )
+        target.SetGeoTransform(self.geotransform)
+        if projection is not None:
+            target.SetProjection(projection)
+        band = target.GetRasterBand(1)
+        if self.nodata is not None:
+            band.SetNoDataValue(self.nodata)
+        for y_off in range(0, rows, block_rows):
+            block = self.data[y_off : y_off + block_rows]
+            band.WriteArray(block, 0, y_off)
+            if statistics is not None:
+                statistics.add(block, self.nodata)
+        target.FlushCache()
+        target = None
+        return out_file
+
+
+def open_flt(path):
+    """Map a TUFLOW .flt output (raw float32 with a .hdr sidecar) read only."""
+    path = Path(path)
+    header = read_flt_header(path.with_suffix(".hdr"))
+    rows, columns = int(header["nrows"]), int(header["ncols"])
+    cell_size = float(header["cellsize"])
+    if "xllcorner" in header:
+        x_min = float(header["xllcorner"])
+    else:
+        x_min = float(header.get("xllcenter", 0)) - cell_size / 2
+    if "yllcorner" in header:
+        y_min = float(header["yllcorner"])
+    else:
+        y_min = float(header.get("yllcenter", 0)) - cell_size / 2
+    byte_order = header.get("byteorder", "lsbfirst").lower()
+    if byte_order not in BYTE_ORDERS:
+        raise FltException("Unknown byte order {} of {}".format(byte_order, path))
+    dtype = np.dtype(BYTE_ORDERS[byte_order] + "f4")
+    if path.stat().st_size != rows * columns * dtype.itemsize:
+        raise FltException(
+            "{} does not hold the {} x {} cells of its header".format(
+                path, rows, columns
+            )
+        )
+    nodata = header.get("nodata_value")
+    return FltRaster(
+        str(path),
+        np.memmap(path, dtype=dtype, mode="r", shape=(rows, columns)),
+        (x_min, cell_size, 0.0, y_min + rows * cell_size, 0.0, -cell_size),
+        float(nodata) if nodata is not None else None,
+    )
@@ -2,6 +2,7 @@ from rasterstats import zonal_stats, point_query
 import geopandas as gpd
 import rasterio
 from rasterio import features
+from tuflowflash.tracing import traced
 import numpy as np
 import pandas as pd
 
@@ -96,6 +97,7 @@ class impactModule:
 
         return vector_layer
 
+    @traced
     def sample_raster(
         self,
         raster_location,
@@ -130,6 +132,7 @@ class impactModule:
         )
         return shapes
 
+    @traced
     def determine_floor_level(
         self, building_shape_path, floor_level_shape_path, floor_level_column
     ):
@@ -168,6 +171,7 @@ class impactModule:
 
         return buildings
 
+    @traced
     def determine_vulnerability_buildings(
         self,
         buildings_geopackage,
@@ -192,6 +196,7 @@ class impactModule:
         )
         return output_filename
 
+    @traced
     def determine_vulnerability_road_closure_points(
         self,
         road_closure_pt_geopackage,
@@ -218,6 +223,7 @@ class impactModule:
         )
         return output_filename
 
+    @traced
     def determine_vulnerability_evacuation_centres(
         self,
         evac_centre_geopackage,
@@ -244,6 +250,7 @@ class impactModule:
         )
         return output_filename
 
+    @traced
     def determine_vulnerability_council_assets(
         self,
         council_assets_geopackage,
@@ -269,6 +276,7 @@ class impactModule:
         )
         return output_filename
 
+    @traced
     def create_impact_raster(self, layer_dict, depth_raster):
         with rasterio.open(depth_raster) as src:
             profile = src.profile
@@ -293,6 +301,7 @@ class impactModule:
         )
         return depth_raster.replace(".tif", "_vulnerability.tif")
 
+    @traced
     def create_impact_vector(self, layer_dict, impact_vector_output_path):
         for i, (layer_name, layer_location) in enumerate(layer_dict.items()):
             points = gpd.read_file(layer_location)
@@ -0,0 +1,516 @@
+from pathlib import Path
+from tuflowflash import metrics
+from tuflowflash.read_settings import FlashSettings
+
+import json
+import logging
+import os
+import shutil
+import socket
+import threading
+import time
+import uuid
+
+
+logger = logging.getLogger(__name__)
+
+JOBS_FOLDER = "jobs"
+LOCKS_FOLDER = "locks"
+RESULTS_FOLDER = "results"
+WORKERS_FOLDER = "workers"
+REFUSED_FOLDER = "refused"
+SIMULATION = "simulation"
+IMPACT = "impact"
+POLL_SECONDS = 2
+HEARTBEAT_SECONDS = 30
+# a claimed job whose lock was not touched for this long is run again
+STALE_SECONDS = 300
+# how long a submitter waits for its jobs by default
+TIMEOUT_MINUTES = 720
+DONE = "done"
+FAILED = "failed"
+REFERENCE_TIME_FORMAT = "%Y-%m-%dT%H:%M"
+# rebuilt by the worker from the settings file and the tcf
+DERIVED_SETTINGS = (
+    "settingsFile",
+    "config",
+    "model_index",
+    "reference_time",
+    "start_time",
+    "end_time",
+)
+
+
+class JobQueueException(Exception):
+    pass
+
+
+def write_atomic(path, data):
+    """Write bytes so readers on other nodes never see a partial file."""
+    temp_file = path.with_name(".{}.{}.tmp".format(path.name, uuid.uuid4().hex))
+    with open(temp_file, "wb") as f:
+        f.write(data)
+        f.flush()
+        os.fsync(f.fileno())
+    os.replace(temp_file, path)
+
+
+def worker_name():
+    return "{}:{}".format(socket.gethostname(), os.getpid())
+
+
+def read_settings(settings_file, reference_time, tcf_file=None):
+    settings = FlashSettings(settings_file, reference_time)
+    if tcf_file is not None and Path(tcf_file) != Path(settings.tcf_file):
+        settings = settings.domain_settings(tcf_file)
+    return settings
+
+
+def settings_reference(settings):
+    """Return the settings as data a worker can rebuild them from.
+
+    That is the settings file, the reference time, the tcf and the settings
+    that differ from those read from the file, such as the state folders of
+    a domain or the rain files of an ensemble member. Paths are sent as
+    strings, listed in ``paths``.
+    """
+    reference = {
+        "settings_file": str(settings.settingsFile),
+        "reference_time": settings.reference_time.strftime(REFERENCE_TIME_FORMAT),
+        "tcf_file": str(settings.tcf_file),
+        "overrides": {},
+        "paths": [],
+    }
+    original = read_settings(
+        reference["settings_file"], reference["reference_time"], settings.tcf_file
+    )
+    for name, value in vars(settings).items():
+        if name in DERIVED_SETTINGS or getattr(original, name, None) == value:
+            continue
+        if isinstance(value, Path):
+            reference["paths"].append(name)
+            value = str(value)
+        if not isinstance(value, (str, int, float, bool, list, type(None))):
+            raise JobQueueException(
+                "Setting {} ({}) cannot be sent to a worker".format(
+                    name, type(value).__name__
+                )
+            )
+        reference["overrides"][name] = value
+    return reference
+
+
+def settings_from_reference(reference):
+    """Return the settings described by ``settings_reference``."""
+    settings = read_settings(
+        reference["settings_file"],
+        reference["reference_time"],
+        reference["tcf_file"],
+    )
+    for name, value in reference["overrides"].items():
+        setattr(settings, name, Path(value) if name in reference["paths"] else value)
+    return settings
+
+
+class JobQueue:
+    """Queue of simulation and impact jobs in a shared folder.
+
+    A job is a json file in ``jobs/`` with its kind and the settings file,
+    reference time and changed settings to run with; it holds data only, the
+    kind picks one of the ``JOB_RUNNERS``. A worker claims a job by creating
+    ``locks/<job>.lock`` exclusively, touches the lock while it works and
+    writes ``results/<job>.json``. Locks that were not
+    touched for ``stale_seconds`` are released by the submitter, so a job of
+    a crashed worker is picked up by another one. Workers announce themselves
+    in ``workers/``; a job refused by every live worker (it needs more
+    processing units than any of them has) fails. All nodes should mount the
+    folder (and the model folders) at the same path.
+    """
+
+    def __init__(
+        self,
+        folder,
+        stale_seconds=STALE_SECONDS,
+        poll_seconds=POLL_SECONDS,
+        timeout=TIMEOUT_MINUTES * 60,
+    ):
+        self.folder = Path(folder)
+        self.jobs_folder = self.folder / JOBS_FOLDER
+        self.locks_folder = self.folder / LOCKS_FOLDER
+        self.results_folder = self.folder / RESULTS_FOLDER
+        self.workers_folder = self.folder / WORKERS_FOLDER
+        self.refused_folder = self.folder / REFUSED_FOLDER
+        self.stale_seconds = stale_seconds
+        self.poll_seconds = poll_seconds
+        # seconds wait() waits for its jobs unless told otherwise
+        self.timeout = timeout
+        for folder in (
+            self.jobs_folder,
+            self.locks_folder,
+            self.results_folder,
+            self.workers_folder,
+            self.refused_folder,
+        ):
+            folder.mkdir(parents=True, exist_ok=True)
+
+    def job_file(self, job_id):
+        return self.jobs_folder / (job_id + ".json")
+
+    def lock_file(self, job_id):
+        return self.locks_folder / (job_id + ".lock")
+
+    def result_file(self, job_id):
+        return self.results_folder / (job_id + ".json")
+
+    def worker_file(self, worker):
+        # worker names hold a colon, which Windows shares do not allow
+        return self.workers_folder / worker.replace(":", "_")
+
+    def refusals_folder(self, job_id):
+        return self.refused_folder / job_id
+
+    def submit(self, kind, settings, name=None, units=1, **arguments):
+        """Queue a job and return its id, ids sort in submission order.
+
+        ``arguments`` and the value the job returns should be plain json data.
+        """
+        if kind not in JOB_RUNNERS:
+            raise JobQueueException("Unknown job kind {}".format(kind))
+        self.remove_orphaned_results()
+        job_id = "{:020d}_{}".format(time.time_ns(), uuid.uuid4().hex[:8])
+        job = {
+            "id": job_id,
+            "kind": kind,
+            "name": name or job_id,
+            "settings": None if settings is None else settings_reference(settings),
+            "units": units,
+            "arguments": arguments,
+            "cwd": os.getcwd(),
+            "submitted": time.time(),
+        }
+        write_atomic(self.job_file(job_id), json.dumps(job).encode())
+        logger.info("queued %s job %s (%s)", kind, job["name"], job_id)
+        metrics.increment("queue_jobs", kind=kind, state="submitted")
+        return job_id
+
+    def pending(self):
+        """Return the ids of the jobs without a result or lock, oldest first."""
+        return [
+            job_file.stem
+            for job_file in sorted(self.jobs_folder.glob("*.json"))
+            if not self.result_file(job_file.stem).exists()
+            and not self.lock_file(job_file.stem).exists()
+        ]
+
+    def claim(self, worker, skip=()):
+        """Lock and return the oldest pending job, None if there is none."""
+        for job_id in self.pending():
+            if job_id in skip:
+                continue
+            try:
+                fd = os.open(
+                    self.lock_file(job_id), os.O_CREAT | os.O_EXCL | os.O_WRONLY
+                )
+            except FileExistsError:
+                # another worker was first
+                continue
+            with os.fdopen(fd, "w") as f:
+                f.write(worker)
+            if self.result_file(job_id).exists():
+                # finished by another worker after it was listed
+                self.release(job_id)
+                continue
+            try:
+                with open(self.job_file(job_id)) as f:
+                    return json.load(f)
+            except FileNotFoundError:
+                # collected in the meantime
+                self.release(job_id)
+            except ValueError:
+                logger.error("job file of %s is not valid json", job_id)
+                self.finish(job_id, worker, FAILED, error="invalid job file")
+        return None
+
+    def release(self, job_id):
+        try:
+            self.lock_file(job_id).unlink()
+        except FileNotFoundError:
+            pass
+
+    def heartbeat(self, job_id):
+        try:
+            os.utime(self.lock_file(job_id))
+        except FileNotFoundError:
+            logger.warning("lock of job %s was released while running", job_id)
+
+    def register(self, worker):
+        """Announce (or keep announcing) a worker taking jobs."""
+        self.worker_file(worker).touch()
+
+    def unregister(self, worker):
+        try:
+            self.worker_file(worker).unlink()
+        except FileNotFoundError:
+            pass
+
+    def live_workers(self):
+        """Return the file names of the workers announced recently."""
+        now = time.time()
+        workers = set()
+        for worker_file in self.workers_folder.iterdir():
+            try:
+                if now - worker_file.stat().st_mtime <= self.stale_seconds:
+                    workers.add(worker_file.name)
+            except FileNotFoundError:
+                continue
+        return workers
+
+    def refuse(self, job_id, worker):
+        """Record that a worker cannot run a job."""
+        folder = self.refusals_folder(job_id)
+        folder.mkdir(exist_ok=True)
+        (folder / self.worker_file(worker).name).touch()
+
+    def fail_refused_jobs(self, job_ids):
+        """Fail the jobs that every live worker refused."""
+        workers = self.live_workers()
+        if not workers:
+            return
+        for job_id in job_ids:
+            folder = self.refusals_folder(job_id)
+            if not folder.exists() or not workers <= set(os.listdir(folder)):
+                continue
+            if self.result_file(job_id).exists() or self.lock_file(job_id).exists():
+                continue
+            logger.warning("no worker can run job %s", job_id)
+            self.finish(
+                job_id,
+                "submitter",
+                FAILED,
+                error="refused by all workers ({}), it needs more processing "
+                "units than any of them has".format(", ".join(sorted(workers))),
+            )
+
+    def finish(self, job_id, worker, status, value=None, error=None, seconds=None):
+        """Write the result of a job, dropped when the job was withdrawn."""
+        if not self.job_file(job_id).exists():
+            logger.warning("job %s was withdrawn, dropping its result", job_id)
+            self.release(job_id)
+            return
+        result = {
+            "status": status,
+            "value": value,
+            "error": error,
+            "worker": worker,
+            "seconds": seconds,
+        }
+        write_atomic(self.result_file(job_id), json.dumps(result).encode())
+        self.release(job_id)
+
+    def remove_orphaned_results(self):
+        """Remove results written after their job was withdrawn."""
+        for result_file in self.results_folder.glob("*.json"):
+            if not self.job_file(result_file.stem).exists():
+                logger.info("removing result of withdrawn job %s", result_file.stem)
+                try:
+                    result_file.unlink()
+                except FileNotFoundError:
+                    pass
+
+    def release_stale_locks(self, job_ids):
+        now = time.time()
+        for job_id in job_ids:
+            lock_file = self.lock_file(job_id)
+            try:
+                age = now - lock_file.stat().st_mtime
+                if age > self.stale_seconds and not self.result_file(job_id).exists():
+                    logger.warning(
+                        "worker %s stopped working on job %s, releasing it",
+                        lock_file.read_text(),
+                        job_id,
+                    )
+                    lock_file.unlink()
+            except FileNotFoundError:
+                continue
+
+    def collect(self, job_id):
+        """Return the result of a finished job and remove its files."""
+        with open(self.result_file(job_id)) as f:
+            result = json.load(f)
+        self.remove(job_id)
+        return result
+
+    def remove(self, job_id):
+        """Remove the files of a job, no worker starts it anymore."""
+        for path in (self.job_file(job_id), self.result_file(job_id)):
+            try:
+                path.unlink()
+            except FileNotFoundError:
+                pass
+        shutil.rmtree(self.refusals_folder(job_id), ignore_errors=True)
+
+    def wait(self, job_ids, timeout=None):
+        """Wait for the jobs and return {job id: value}.
+
+        Every job is awaited; the first failure is raised afterwards. Jobs
+        not finished within ``timeout`` seconds (default ``self.timeout``) are
+        withdrawn and a JobQueueException is raised.
+        """
+        if timeout is None:
+            timeout = self.timeout
+        start = time.monotonic()
+        remaining = list(job_ids)
+        results = {}
+        while remaining:
+            for job_id in list(remaining):
+                if self.result_file(job_id).exists():
+                    results[job_id] = self.collect(job_id)
+                    remaining.remove(job_id)
+            if not remaining:
+                break
+            if timeout is not None and time.monotonic() - start > timeout:
+                for job_id in remaining:
+                    self.remove(job_id)
+                raise JobQueueException(
+                    "{} jobs did not finish within {} s".format(len(remaining), timeout)
+                )
+            self.release_stale_locks(remaining)
+            self.fail_refused_jobs(remaining)
+            time.sleep(self.poll_seconds)
+
+        failed = [
+            (job_id, result)
+            for job_id, result in results.items()
+            if result["status"] != DONE
+        ]
+        for job_id, result in failed:
+            logger.error(
+                "job %s failed on %s: %s", job_id, result["worker"], result["error"]
+            )
+        if failed:
+            job_id, result = failed[0]
+            raise JobQueueException(
+                "Job {} failed on {}: {}".format(
+                    job_id, result["worker"], result["error"]
+                )
+            )
+        return {job_id: result["value"] for job_id, result in results.items()}
+
+
+def job_queue_from_settings(settings):
+    """Return the JobQueue of ``job_queue_folder``, None to run locally."""
+    if not hasattr(settings, "job_queue_folder"):
+        return None
+    return JobQueue(
+        settings.job_queue_folder,
+        timeout=getattr(settings, "job_queue_timeout_minutes", TIMEOUT_MINUTES) * 60,
+    )
+
+
+def run_simulation_job(job, processing_units):
+    from tuflowflash.run_tuflow import TuflowSimulation
+
+    TuflowSimulation(
+        settings_from_reference(job["settings"]),
+        processing_units=processing_units,
+        name=job["name"],
+    ).run()
+
+
+def run_impact_job(job, processing_units):
+    from tuflowflash.impact_module import impactModule
+    from tuflowflash.post_processing import ProcessFlash
+
+    settings = settings_from_reference(job["settings"])
+    impact_module = impactModule(settings, settings.end_result_type)
+    return ProcessFlash(settings).determine_impact(
+        impact_module, job["arguments"]["raster"]
+    )
+
+
+JOB_RUNNERS = {SIMULATION: run_simulation_job, IMPACT: run_impact_job}
+
+
+class JobWorker:
+    """Claim and run jobs of a JobQueue, one at a time.
+
+    A simulation job gets as many of this node's ``processing_units`` as it
+    needs; jobs needing more than the node has are left to other workers.
+    """
+
+    def __init__(self, queue, processing_units, name=None):
+        self.queue = queue
+        self.processing_units = [int(unit) for unit in processing_units]
+        self.name = name or worker_name()
+        self.jobs_done = 0
+
+    def keep_alive(self, job_id, stopped):
+        while not stopped.wait(HEARTBEAT_SECONDS):
+            self.queue.heartbeat(job_id)
+            self.queue.register(self.name)
+
+    def run_job(self, job):
+        logger.info("%s runs %s job %s", self.name, job["kind"], job["name"])
+        stopped = threading.Event()
+        heartbeat = threading.Thread(
+            target=self.keep_alive,
+            args=(job["id"], stopped),
+            name="job-heartbeat",
+            daemon=True,
+        )
+        heartbeat.start()
+        cwd = os.getcwd()
+        start = time.perf_counter()
+        try:
+            if os.path.isdir(job["cwd"]):
+                os.chdir(job["cwd"])
+            value = JOB_RUNNERS[job["kind"]](job, self.processing_units[: job["units"]])
+            status, error = DONE, None
+        except Exception as e:
+            logger.exception("job %s failed", job["name"])
+            status, value, error = FAILED, None, "{}: {}".format(type(e).__name__, e)
+        finally:
+            os.chdir(cwd)
+            stopped.set()
+            heartbeat.join()
+        seconds = time.perf_counter() - start
+        self.queue.finish(job["id"], self.name, status, value, error, seconds)
+        metrics.increment("queue_jobs", kind=job["kind"], state=status)
+        logger.info("job %s %s after %.0f s", job["name"], status, seconds)
+        self.jobs_done += 1
+
+    def run(self, max_jobs=None, idle_seconds=None):
+        """Work until ``max_jobs`` ran or no job came for ``idle_seconds``."""
+        logger.info("worker %s waiting for jobs in %s", self.name, self.queue.folder)
+        try:
+            self.work(max_jobs, idle_seconds)
+        finally:
+            self.queue.unregister(self.name)
+        return self.jobs_done
+
+    def work(self, max_jobs, idle_seconds):
+        too_large = set()
+        idle_since = time.monotonic()
+        while max_jobs is None or self.jobs_done < max_jobs:
+            self.queue.register(self.name)
+            job = self.queue.claim(self.name, skip=too_large)
+            if job is None:
+                if (
+                    idle_seconds is not None
+                    and time.monotonic() - idle_since > idle_seconds
+                ):
+                    break
+                time.sleep(self.queue.poll_seconds)
+                continue
+            if job["units"] > len(self.processing_units):
+                logger.info(
+                    "job %s needs %s processing units, leaving it to another worker",
+                    job["name"],
+                    job["units"],
+                )
+                too_large.add(job["id"])
+                self.queue.refuse(job["id"], self.name)
+                self.queue.release(job["id"])
+                continue
+            self.run_job(job)
+            idle_since = time.monotonic()
@@ -0,0 +1,37 @@
+import importlib
+import types
+
+
+class LazyModule(types.ModuleType):
+    """Module placeholder that imports the real module on first attribute access.
+
+    Several candidate names can be given, the first one that imports is used
+    (e.g. ``gdal`` and ``osgeo.gdal``).
+    """
+
+    def __init__(self, *names):
+        super().__init__(names[0])
+        self._names = names
+        self._module = None
+
+    def _load(self):
+        if self._module is None:
+            error = None
+            for name in self._names:
+                try:
+                    self._module = importlib.import_module(name)
+                    break
+                except ImportError as e:
+                    error = e
+            else:
+                raise error
+        return self._module
+
+    def __getattr__(self, attribute):
+        if attribute.startswith("_"):
+            raise AttributeError(attribute)
+        return getattr(self._load(), attribute)
+
+
+def lazy_import(*names):
+    return LazyModule(*names)
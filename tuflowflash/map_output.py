@@ -0,0 +1,101 @@
+from functools import reduce
+from tuflowflash.control_files import generated_file
+from tuflowflash.control_files import write_if_changed
+from tuflowflash.tracing import traced
+
+import logging
+import math
+
+
+logger = logging.getLogger(__name__)
+
+OVERRIDE_SUFFIX = "_map_output.trd"
+# the rasters in the upload lists are read as GeoTIFF
+MAP_OUTPUT_FORMAT = "TIF"
+# TUFLOW data type of the rasters in each upload list
+UPLOAD_LIST_DATA_TYPES = (
+    ("waterdepth_raster_upload_list", "d"),
+    ("waterlevel_raster_upload_list", "h"),
+)
+# interval written when a single map output time is needed
+SINGLE_OUTPUT_INTERVAL = 3600
+
+
+class MapOutputException(Exception):
+    pass
+
+
+def required_map_outputs(settings):
+    """Return the TUFLOW data types and output times (h) of the upload lists."""
+    from tuflowflash.post_processing import ProcessFlash
+
+    post_processer = ProcessFlash(settings)
+    data_types = []
+    times = set()
+    for setting, data_type in UPLOAD_LIST_DATA_TYPES:
+        names = [name.strip() for name in getattr(settings, setting, []) if name]
+        if not names:
+            continue
+        data_types.append(data_type)
+        for name in names:
+            try:
+                times.add(post_processer.tuflow_output_hours(name))
+            except ValueError as e:
+                raise MapOutputException(
+                    "Cannot read the output time of raster {} in {}".format(
+                        name, setting
+                    )
+                ) from e
+    return data_types, sorted(times)
+
+
+def override_commands(data_types, times):
+    """Return control file lines that make TUFLOW write only these outputs.
+
+    The times are written from the first to the last at the largest interval
+    that hits every one of them.
+    """
+    seconds = [int(round(time * 3600)) for time in times]
+    differences = [b - a for a, b in zip(seconds, seconds[1:])]
+    interval = reduce(math.gcd, differences, 0) or SINGLE_OUTPUT_INTERVAL
+    return [
+        "Map Output Format == {}".format(MAP_OUTPUT_FORMAT),
+        "Map Output Data Types == {}".format(" ".join(data_types)),
+        "Start Map Output == {:g}".format(times[0]),
+        "End Map Output == {:g}".format(times[-1]),
+        "Map Output Interval == {}".format(interval),
+    ]
+
+
+def override_file(tcf_file):
+    return generated_file(tcf_file, OVERRIDE_SUFFIX)
+
+
+@traced
+def write_map_output_override(settings):
+    """Limit the TUFLOW map output to the rasters in the upload lists.
+
+    Writes ``<tcf>_map_output.trd`` with the output format, data types and
+    times the upload lists need. The generated tcf TUFLOW runs reads it after
+    the model's tcf, so it overrides the map output commands of the model.
+    Returns the override file, None when the upload lists are empty.
+    """
+    data_types, times = required_map_outputs(settings)
+    if not times:
+        logger.info("No rasters to upload, map output left as configured")
+        remove_map_output_override(settings)
+        return None
+    override = override_file(settings.tcf_file)
+    override.parent.mkdir(exist_ok=True)
+    write_if_changed(override, override_commands(data_types, times))
+    logger.info(
+        "map output limited to %s as %s", " ".join(data_types), MAP_OUTPUT_FORMAT
+    )
+    return override
+
+
+def remove_map_output_override(settings):
+    """Remove the override left by an earlier run with the switch on."""
+    override = override_file(settings.tcf_file)
+    if override.exists():
+        override.unlink()
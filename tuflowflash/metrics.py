@@ -0,0 +1,198 @@
+from http.server import BaseHTTPRequestHandler
+from http.server import ThreadingHTTPServer
+from pathlib import Path
+
+import logging
+import os
+import threading
+import time
+
+
+logger = logging.getLogger(__name__)
+
+PREFIX = "tuflowflash_"
+CONTENT_TYPE = "application/openmetrics-text; version=1.0.0; charset=utf-8"
+DEFAULT_METRICS_ADDRESS = "127.0.0.1"
+
+# name: (type, help)
+METRICS = {
+    "cycle_duration_seconds": (
+        "gauge",
+        "End-to-end wall time of the last forecast cycle.",
+    ),
+    "cycle_last_success_timestamp_seconds": (
+        "gauge",
+        "Unix time at which the last successful forecast cycle finished.",
+    ),
+    "cycles": ("counter", "Forecast cycles run by this process."),
+    "stage_duration_seconds": (
+        "gauge",
+        "Wall time of the pipeline stages in the last forecast cycle.",
+    ),
+    "tuflow_runtime_seconds": ("gauge", "Wall time of the last TUFLOW run."),
+    "tuflow_simulated_hours": ("gauge", "Simulated time reached by TUFLOW."),
+    "tuflow_progress_ratio": (
+        "gauge",
+        "Fraction of the simulation period TUFLOW has finished.",
+    ),
+    "tuflow_peak_rss_bytes": (
+        "gauge",
+        "Peak resident memory of the TUFLOW process tree in the last run.",
+    ),
+    "tuflow_cpu_seconds": ("gauge", "CPU time used by TUFLOW in the last run."),
+    "tuflow_watchdog_kills": (
+        "counter",
+        "TUFLOW runs stopped for exceeding the wall time or memory ceiling.",
+    ),
+    "result_cache": (
+        "counter",
+        "TUFLOW runs looked up in the result cache, by hit or miss.",
+    ),
+    "queue_jobs": (
+        "counter",
+        "Jobs of the shared job queue, by kind and state.",
+    ),
+    "download_bytes": ("counter", "Bytes downloaded from BoM and Lizard."),
+    "rasters_uploaded": ("counter", "Rasters posted to Lizard."),
+}
+
+
+def format_labels(labels):
+    if not labels:
+        return ""
+    return "{{{}}}".format(
+        ",".join(
+            '{}="{}"'.format(
+                key,
+                str(value)
+                .replace("\\", "\\\\")
+                .replace('"', '\\"')
+                .replace("\n", "\\n"),
+            )
+            for key, value in labels
+        )
+    )
+
+
+class MetricsRegistry:
+    """Thread safe store of the metric values, rendered as OpenMetrics text."""
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.values = {}
+
+    def key(self, name, labels):
+        if name not in METRICS:
+            raise KeyError("Unknown metric {}".format(name))
+        return name, tuple(sorted(labels.items()))
+
+    def increment(self, name, value=1, **labels):
+        key = self.key(name, labels)
+        with self.lock:
+            self.values[key] = self.values.get(key, 0) + value
+
+    def set(self, name, value, **labels):
+        key = self.key(name, labels)
+        with self.lock:
+            self.values[key] = value
+
+    def get(self, name, **labels):
+        key = self.key(name, labels)
+        with self.lock:
+            return self.values.get(key)
+
+    def clear(self, name):
+        with self.lock:
+            for key in [key for key in self.values if key[0] == name]:
+                del self.values[key]
+
+    def render(self):
+        with self.lock:
+            values = dict(self.values)
+        lines = []
+        for name, (metric_type, help_text) in METRICS.items():
+            samples = sorted(
+                (labels, value)
+                for (key, labels), value in values.items()
+                if key == name
+            )
+            if not samples:
+                continue
+            lines.append("# TYPE {}{} {}".format(PREFIX, name, metric_type))
+            lines.append("# HELP {}{} {}".format(PREFIX, name, help_text))
+            suffix = "_total" if metric_type == "counter" else ""
+            for labels, value in samples:
+                lines.append(
+                    "{}{}{}{} {}".format(
+                        PREFIX, name, suffix, format_labels(labels), value
+                    )
+                )
+        lines.append("# EOF")
+        return "\n".join(lines) + "\n"
+
+
+registry = MetricsRegistry()
+
+
+def increment(name, value=1, **labels):
+    registry.increment(name, value, **labels)
+
+
+def set_gauge(name, value, **labels):
+    registry.set(name, value, **labels)
+
+
+def value(name, **labels):
+    """Return the current value of a metric, None when it was not set."""
+    return registry.get(name, **labels)
+
+
+def record_cycle(durations, cycle_time, success):
+    """Record the stage durations and outcome of a finished forecast cycle."""
+    registry.clear("stage_duration_seconds")
+    for stage_name, duration in durations.items():
+        registry.set("stage_duration_seconds", duration, stage=stage_name)
+    registry.set("cycle_duration_seconds", cycle_time)
+    registry.increment("cycles", status="success" if success else "failure")
+    if success:
+        registry.set("cycle_last_success_timestamp_seconds", time.time())
+
+
+def write_textfile(metrics_file):
+    """Write the metrics atomically, e.g. for the node_exporter textfile collector."""
+    metrics_file = Path(metrics_file)
+    metrics_file.parent.mkdir(parents=True, exist_ok=True)
+    temp_file = metrics_file.with_name(metrics_file.name + ".tmp")
+    with open(temp_file, "w") as f:
+        f.write(registry.render())
+    os.replace(temp_file, metrics_file)
+
+
+class MetricsHandler(BaseHTTPRequestHandler):
+    def do_GET(self):
+        body = registry.render().encode("utf-8")
+        self.send_response(200)
+        self.send_header("Content-Type", CONTENT_TYPE)
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        logger.debug("metrics request: " + format, *args)
+
+
+_server = None
+
+
+def start_http_server(port, address=DEFAULT_METRICS_ADDRESS):
+    """Serve the metrics over HTTP from a daemon thread (once per process)."""
+    global _server
+    if _server is not None:
+        return _server
+    _server = ThreadingHTTPServer((address, port), MetricsHandler)
+    thread = threading.Thread(
+        target=_server.serve_forever, name="metrics-http", daemon=True
+    )
+    thread.start()
+    logger.info("serving metrics on http://%s:%s/metrics", address, port)
+    return _server
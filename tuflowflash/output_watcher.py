@@ -0,0 +1,152 @@
+from pathlib import Path
+from tuflowflash.tracing import traced
+
+import logging
+import os
+import threading
+
+
+logger = logging.getLogger(__name__)
+
+WATCH_POLL_SECONDS = 5
+# TUFLOW has finished writing the map output of hour T once it reports a
+# simulated time after T
+MILESTONE_MARGIN_HOURS = 1e-6
+DEPTH = "depth"
+LEVEL = "level"
+
+
+class OutputWatcher:
+    """Post-process TUFLOW map outputs while the simulation is still running.
+
+    Every raster in the upload lists is projected, uploaded to Lizard and
+    (depth rasters, with ``determine_impact``) classified for impact as soon as
+    TUFLOW has moved past its output time and the file no longer changes.
+    Register ``milestones()`` (and ``segment_finished`` for segmented runs)
+    with the TuflowSimulation and run the simulation inside ``with watcher:``.
+    """
+
+    def __init__(self, settings, post_processer, poll_seconds=WATCH_POLL_SECONDS):
+        self.settings = settings
+        self.post_processer = post_processer
+        self.poll_seconds = poll_seconds
+        self.rasters = {}
+        for kind, setting in (
+            (DEPTH, "waterdepth_raster_upload_list"),
+            (LEVEL, "waterlevel_raster_upload_list"),
+        ):
+            for name in getattr(settings, setting, []):
+                path = os.path.join(settings.raster_output_folder, name + ".tif")
+                self.rasters[path] = (kind, post_processer.tuflow_output_hours(path))
+        self.pending = sorted(self.rasters, key=lambda path: self.rasters[path][1])
+        self.reached_hours = float("-inf")
+        self.file_states = {}
+        self.errors = []
+        self.impact_module = None
+        self.simulation_finished = threading.Event()
+        self.aborted = threading.Event()
+        self.thread = None
+
+    def milestones(self):
+        hours = sorted({hours for _, hours in self.rasters.values()})
+        return [(h + MILESTONE_MARGIN_HOURS, self.reached) for h in hours]
+
+    def reached(self, simulated_time):
+        self.reached_hours = max(self.reached_hours, simulated_time)
+
+    def segment_finished(self, end_time):
+        """A finished segment wrote all map output up to its end time."""
+        self.reached(end_time + MILESTONE_MARGIN_HOURS)
+
+    def raster_uuid(self, kind):
+        if kind == DEPTH:
+            return self.settings.depth_raster_uuid
+        return self.settings.waterlevel_raster_uuid
+
+    def is_ready(self, path, finished):
+        """A raster is ready when TUFLOW moved past it and it stopped changing."""
+        if not os.path.exists(path):
+            return False
+        if finished:
+            return True
+        if self.rasters[path][1] >= self.reached_hours:
+            return False
+        stat = os.stat(path)
+        state = (stat.st_size, stat.st_mtime_ns)
+        previous, self.file_states[path] = self.file_states.get(path), state
+        return state == previous
+
+    @traced
+    def process_raster(self, path):
+        kind, _ = self.rasters[path]
+        timestamp = self.post_processer.tuflow_tif_output_to_relative_timestamp(path)
+        self.post_processer.finalise_raster(path)
+        self.post_processer.post_raster_to_lizard(
+            path, self.raster_uuid(kind), timestamp
+        )
+        if kind == DEPTH and self.settings.determine_impact:
+            if self.impact_module is None:
+                from tuflowflash.impact_module import impactModule
+
+                self.impact_module = impactModule(
+                    self.settings, self.settings.end_result_type
+                )
+            impact_raster = self.post_processer.determine_impact(
+                self.impact_module, path
+            )
+            if impact_raster is not None:
+                self.post_processer.post_raster_to_lizard(
+                    impact_raster, self.settings.impact_raster_uuid, timestamp
+                )
+        logger.info("post-processed %s", Path(path).name)
+
+    def watch(self):
+        while self.pending:
+            finished = self.simulation_finished.is_set()
+            for path in list(self.pending):
+                if self.aborted.is_set():
+                    return
+                if not self.is_ready(path, finished):
+                    continue
+                self.pending.remove(path)
+                try:
+                    self.process_raster(path)
+                except Exception as e:
+                    logger.error("post-processing %s failed: %s", path, e)
+                    self.errors.append(e)
+            if finished:
+                break
+            self.simulation_finished.wait(self.poll_seconds)
+        for path in self.pending:
+            logger.warning("TUFLOW did not write map output %s", path)
+
+    def start(self):
+        uuids = {self.raster_uuid(kind) for kind, _ in self.rasters.values()}
+        if self.settings.determine_impact and any(
+            kind == DEPTH for kind, _ in self.rasters.values()
+        ):
+            uuids.add(self.settings.impact_raster_uuid)
+        for raster_uuid in uuids:
+            self.post_processer.clear_temporal_raster(raster_uuid)
+        self.thread = threading.Thread(target=self.watch, name="output-watcher")
+        self.thread.start()
+
+    def finish(self):
+        """Process the remaining rasters, raise the first error (if any)."""
+        self.simulation_finished.set()
+        self.thread.join()
+        if self.errors:
+            raise self.errors[0]
+
+    def __enter__(self):
+        self.start()
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        if exc_type is None:
+            self.finish()
+        else:
+            # the simulation failed, leave the remaining rasters alone
+            self.aborted.set()
+            self.simulation_finished.set()
+            self.thread.join()
@@ -0,0 +1,156 @@
+from concurrent.futures import FIRST_COMPLETED
+from concurrent.futures import ThreadPoolExecutor
+from concurrent.futures import wait
+from tuflowflash import tracing
+
+import logging
+import time
+
+
+logger = logging.getLogger(__name__)
+
+DEFAULT_PIPELINE_WORKERS = 4
+
+
+class PipelineException(Exception):
+    pass
+
+
+class Stage:
+    """One step of a forecast cycle.
+
+    ``inputs`` and ``outputs`` are names of the data a stage consumes and
+    produces, a stage starts once every stage producing one of its inputs has
+    finished. Disabled stages are skipped (``skip_message`` is logged) but
+    still count as finished for the stages depending on them. Stages sharing
+    one of their ``resources`` (e.g. a library that is not thread safe) never
+    run at the same time.
+    """
+
+    def __init__(
+        self,
+        name,
+        function,
+        enabled=True,
+        inputs=(),
+        outputs=(),
+        skip_message=None,
+        resources=(),
+    ):
+        self.name = name
+        self.function = function
+        self.enabled = enabled
+        self.inputs = tuple(inputs)
+        self.outputs = tuple(outputs)
+        self.skip_message = skip_message
+        self.resources = frozenset(resources)
+
+
+class Pipeline:
+    def __init__(self, stages, max_workers=DEFAULT_PIPELINE_WORKERS, profiler=None):
+        self.stages = {stage.name: stage for stage in stages}
+        self.max_workers = max_workers
+        self.dependencies = self.resolve_dependencies()
+        # wall time per executed stage in seconds
+        self.durations = {}
+        # optional profiling.StageProfiler
+        self.profiler = profiler
+        if profiler is not None:
+            profiler.check_stage_names(list(self.stages))
+
+    def resolve_dependencies(self):
+        producers = {}
+        for stage in self.stages.values():
+            for output in stage.outputs:
+                if output in producers:
+                    raise PipelineException(
+                        "'{}' is produced by both {} and {}".format(
+                            output, producers[output], stage.name
+                        )
+                    )
+                producers[output] = stage.name
+
+        dependencies = {}
+        for stage in self.stages.values():
+            missing = [i for i in stage.inputs if i not in producers]
+            if missing:
+                raise PipelineException(
+                    "No stage produces {} for {}".format(", ".join(missing), stage.name)
+                )
+            dependencies[stage.name] = {producers[i] for i in stage.inputs}
+
+        # reject cycles, they would never become ready
+        resolved = set()
+        remaining = dict(dependencies)
+        while remaining:
+            ready = [name for name, deps in remaining.items() if deps <= resolved]
+            if not ready:
+                raise PipelineException(
+                    "Circular stage dependencies: {}".format(", ".join(remaining))
+                )
+            for name in ready:
+                resolved.add(name)
+                del remaining[name]
+        return dependencies
+
+    def run_stage(self, stage):
+        start = time.perf_counter()
+        try:
+            with tracing.span(stage.name, "stage"):
+                if self.profiler is not None and self.profiler.wants(stage.name):
+                    return self.profiler.run(stage.name, stage.function)
+                return stage.function()
+        finally:
+            self.durations[stage.name] = time.perf_counter() - start
+
+    def run(self):
+        """Run all stages, independent stages concurrently.
+
+        The first exception stops scheduling new stages; running stages are
+        allowed to finish before it is re-raised.
+        """
+        finished = set()
+        pending = list(self.stages)
+        running = {}
+        # resources held by the running stages
+        in_use = set()
+        error = None
+
+        with ThreadPoolExecutor(max_workers=self.max_workers) as executor:
+            while pending or running:
+                for name in list(pending):
+                    if error is not None or not self.dependencies[name] <= finished:
+                        continue
+                    stage = self.stages[name]
+                    if stage.enabled and stage.resources & in_use:
+                        continue
+                    pending.remove(name)
+                    if not stage.enabled:
+                        if stage.skip_message:
+                            logger.info(stage.skip_message)
+                        finished.add(name)
+                        continue
+                    logger.debug("starting stage %s", name)
+                    in_use |= stage.resources
+                    running[executor.submit(self.run_stage, stage)] = name
+
+                if not running:
+                    if error is not None or not pending:
+                        break
+                    # a skipped stage may have unblocked others
+                    continue
+
+                done, _ = wait(running, return_when=FIRST_COMPLETED)
+                for future in done:
+                    name = running.pop(future)
+                    in_use -= self.stages[name].resources
+                    exception = future.exception()
+                    if exception is not None:
+                        logger.error("stage %s failed", name)
+                        error = error or exception
+                    else:
+                        logger.debug("finished stage %s", name)
+                        finished.add(name)
+
+        if error is not None:
+            raise error
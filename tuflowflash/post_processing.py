@@ -1,28 +1,31 @@
-from osgeo import gdalconst
-from osgeo import osr
-from time import sleep
-
-import os
-import pandas as pd
-
-
-try:
-    import gdal
-except:
-    from osgeo import gdal
-
+from concurrent.futures import ProcessPoolExecutor
 from pathlib import Path
+from time import sleep
+from tuflowflash import metrics
+from tuflowflash import resources
+from tuflowflash.flt import BLOCK_ROWS
+from tuflowflash.flt import open_flt
+from tuflowflash.flt import RasterStatistics
+from tuflowflash.lazy_import import lazy_import
+from tuflowflash.tracing import traced
 
 import datetime
 import glob
+import itertools
 import json
 import logging
-import netCDF4 as nc
+import multiprocessing
 import numpy as np
+import os
+import pandas as pd
 import pytz
-import requests
 import shutil
-from tuflowflash.impact_module import impactModule
+
+
+# Heavy GIS libraries are only imported by the stages that use them
+gdal = lazy_import("gdal", "osgeo.gdal")
+osr = lazy_import("osgeo.osr")
+nc = lazy_import("netCDF4")
 
 logger = logging.getLogger(__name__)
 RASTER_SOURCES_URL = (
@@ -33,74 +36,178 @@ TIMESERIES_URL = "https://rhdhv.lizard.net/api/v4/timeseries/"
 
 MAXWAITTIME_RASTER_UPLOAD = 120
 
+DEPTH = "depth"
+LEVEL = "level"
+UPLOAD_LISTS = (
+    (DEPTH, "waterdepth_raster_upload_list"),
+    (LEVEL, "waterlevel_raster_upload_list"),
+)
+DEFAULT_RASTER_WORKERS = 4
+
+
+def finalise_raster(path, projection, convert_flt=False):
+    """Write or complete the GeoTIFF of an output raster in a single pass.
+
+    A GeoTIFF written by TUFLOW gets the projection in place. The ``.flt``
+    next to it is only written to the GeoTIFF (with the projection set at
+    creation) with ``convert_flt`` or when TUFLOW wrote no GeoTIFF. Returns
+    the statistics of the raster, None when neither exists.
+    """
+    statistics = RasterStatistics()
+    flt_file = Path(path).with_suffix(".flt")
+    if flt_file.exists() and (convert_flt or not os.path.exists(path)):
+        open_flt(flt_file).to_geotiff(path, projection, statistics=statistics)
+        return dict(statistics.as_dict(), source="flt")
+    if not os.path.exists(path):
+        return None
+    dataset = gdal.Open(str(path), gdal.GA_Update)
+    dataset.SetProjection(projection)
+    band = dataset.GetRasterBand(1)
+    nodata = band.GetNoDataValue()
+    for y_off in range(0, dataset.RasterYSize, BLOCK_ROWS):
+        rows = min(BLOCK_ROWS, dataset.RasterYSize - y_off)
+        statistics.add(band.ReadAsArray(0, y_off, dataset.RasterXSize, rows), nodata)
+    dataset = None
+    return dict(statistics.as_dict(), source="tif")
+
 
 class ProcessFlash:
     def __init__(self, settings):
         self.settings = settings
 
+    @traced
     def process_tuflow(self):
-        # self.convert_flt_to_tiff()
-        self.project_geotiff_rasters()
-        logger.info("Tuflow results converted to tiff")
+        manifest = self.finalise_rasters()
+        logger.info("Tuflow results finalised as GeoTIFF")
         if hasattr(self.settings, "waterlevel_result_uuid_file"):
             self.post_timeseries()
+        self.upload_manifest(manifest)
+
+    def upload_manifest(self, manifest):
+        """Upload the rasters of a manifest to Lizard, with their impact.
 
+        Every raster uuid is cleared before the upload, so all rasters of a
+        cycle should be in one manifest.
+        """
+        depth_rasters = [entry for entry in manifest if entry["kind"] == DEPTH]
         if hasattr(self.settings, "waterdepth_raster_upload_list"):
-            waterdepth_filenames, timestamps = self.select_rasters_to_upload(
-                self.settings.waterdepth_raster_upload_list
-            )
-            self.post_temporal_raster_to_lizard(
-                waterdepth_filenames, self.settings.depth_raster_uuid, timestamps
-            )
+            self.post_manifest_to_lizard(depth_rasters, self.settings.depth_raster_uuid)
 
         if hasattr(self.settings, "waterlevel_raster_upload_list"):
-            filenames, timestamps = self.select_rasters_to_upload(
-                self.settings.waterlevel_raster_upload_list
-            )
-            self.post_temporal_raster_to_lizard(
-                filenames, self.settings.waterlevel_raster_uuid, timestamps
+            self.post_manifest_to_lizard(
+                [entry for entry in manifest if entry["kind"] == LEVEL],
+                self.settings.waterlevel_raster_uuid,
             )
 
         if self.settings.determine_impact:
-            self.process_depth_to_impact(waterdepth_filenames)
+            self.process_depth_to_impact(depth_rasters)
         logger.info("Tuflow results posted to Lizard")
 
-    def tuflow_tif_output_to_relative_timestamp(self, filename):
+    @traced
+    def finalise_rasters(self):
+        """Write the GeoTIFF of every raster in the upload lists, once.
+
+        The rasters are finalised on a process pool (``raster_workers``).
+        Returns the manifest: per raster its kind, name, path, timestamp and
+        statistics, in upload list order. Missing rasters are left out.
+        """
+        projection = self.create_projection(self.settings.projection)
+        entries = []
+        for kind, setting in UPLOAD_LISTS:
+            for name in getattr(self.settings, setting, []):
+                name = name.strip()
+                path = os.path.join(self.settings.raster_output_folder, name + ".tif")
+                timestamp = self.tuflow_tif_output_to_relative_timestamp(path)
+                entries.append(
+                    {"kind": kind, "name": name, "path": path, "timestamp": timestamp}
+                )
+        if not entries:
+            return []
+        workers = min(
+            getattr(self.settings, "raster_workers", DEFAULT_RASTER_WORKERS),
+            len(entries),
+        )
+        # spawned, forking a process that runs threads and GDAL is unsafe
+        with ProcessPoolExecutor(
+            max_workers=workers, mp_context=multiprocessing.get_context("spawn")
+        ) as executor:
+            results = list(
+                executor.map(
+                    finalise_raster,
+                    [entry["path"] for entry in entries],
+                    itertools.repeat(projection),
+                    itertools.repeat(self.convert_flt()),
+                )
+            )
+        manifest = []
+        for entry, statistics in zip(entries, results):
+            if statistics is None:
+                logger.warning("TUFLOW did not write %s", entry["path"])
+                continue
+            entry.update(statistics)
+            manifest.append(entry)
+            logger.debug(
+                "%s: %s cells with data, max %s",
+                entry["name"],
+                entry["valid_cells"],
+                entry["max"],
+            )
+        return manifest
+
+    def finalise_raster(self, path):
+        """Finalise one output raster, return its statistics (None if missing)."""
+        return finalise_raster(
+            path, self.create_projection(self.settings.projection), self.convert_flt()
+        )
+
+    def convert_flt(self):
+        return getattr(self.settings, "convert_flt_outputs", False)
+
+    def post_manifest_to_lizard(self, entries, raster_uuid):
+        self.post_temporal_raster_to_lizard(
+            [entry["path"] for entry in entries],
+            raster_uuid,
+            [entry["timestamp"] for entry in entries],
+        )
+
+    def tuflow_output_hours(self, filename):
+        """Return the simulated time (h) of a TUFLOW map output file."""
         file_stem = Path(filename).stem
         if file_stem.endswith("_00_00"):
-            file_timestamp = float(file_stem[-9:-6])
+            return float(file_stem[-9:-6])
         elif file_stem.endswith("_00"):
-            file_timestamp = float(file_stem[-6:-3])
-        else:
-            file_timestamp = float(file_stem[-3:])
+            return float(file_stem[-6:-3])
+        return float(file_stem[-3:])
+
+    def tuflow_tif_output_to_relative_timestamp(self, filename):
         timestamp = self.settings.start_time + datetime.timedelta(
-            hours=float(file_timestamp)
+            hours=self.tuflow_output_hours(filename)
         )
         return timestamp
 
-    def process_depth_to_impact(self, waterdepth_filenames):
-        impact_module = impactModule(self.settings, self.settings.end_result_type)
+    @traced
+    def process_depth_to_impact(self, depth_rasters):
+        """Classify and upload the impact of the depth rasters of a manifest."""
+        from tuflowflash.job_queue import job_queue_from_settings
+
+        waterdepth_filenames = [entry["path"] for entry in depth_rasters]
+        job_queue = job_queue_from_settings(self.settings)
+        if job_queue is not None:
+            impact_rasters = self.queue_impact_jobs(job_queue, waterdepth_filenames)
+        else:
+            from tuflowflash.impact_module import impactModule
+
+            impact_module = impactModule(self.settings, self.settings.end_result_type)
+            impact_rasters = [
+                self.determine_impact(impact_module, raster)
+                for raster in waterdepth_filenames
+            ]
         raster_filenames = []
         timestamps = []
-        for raster in waterdepth_filenames:
-            vector_list = []
-            vector_list.append(
-                impact_module.determine_vulnerability_roads(
-                    self.settings.roads_file, self.settings.projection, raster
-                )
-            )
-            vector_list.append(
-                impact_module.determine_vulnerability_buildings(
-                    self.settings.buildings_file, self.settings.projection, raster
-                )
-            )
-            if self.settings.end_result_type == "raster":
-                raster_filenames.append(
-                    impact_module.create_impact_raster(vector_list, raster)
-                )
-                timestamps.append(self.tuflow_tif_output_to_relative_timestamp(raster))
-            else:
-                logger.info("Geoserver vulnerability not implemented yet")
+        for entry, impact_raster in zip(depth_rasters, impact_rasters):
+            if impact_raster is not None:
+                raster_filenames.append(impact_raster)
+                timestamps.append(entry["timestamp"])
         if self.settings.end_result_type == "raster":
             self.post_temporal_raster_to_lizard(
                 raster_filenames, self.settings.impact_raster_uuid, timestamps
@@ -108,45 +215,37 @@ class ProcessFlash:
         else:
             logger.info("Geoserver vulnerability not implemented yet")
 
-    def select_rasters_to_upload(self, raster_list):
-        filenames = []
-        for raster in raster_list:
-            filenames.append(
-                os.path.join(self.settings.raster_output_folder, raster + ".tif")
+    def queue_impact_jobs(self, job_queue, waterdepth_filenames):
+        """Classify the depth rasters on the queue's workers, in parallel."""
+        from tuflowflash.job_queue import IMPACT
+
+        job_ids = [
+            job_queue.submit(
+                IMPACT, self.settings, "impact " + Path(raster).stem, raster=raster
             )
-        timestamps = []
-        for (
-            file
-        ) in (
-            filenames
-        ):  # please note: might cause problems with water level rasters as well
-            timestamps.append(self.tuflow_tif_output_to_relative_timestamp(file))
-        return filenames, timestamps
-
-    def project_geotiff_rasters(self):
-        file_path_list = []
-        if hasattr(self.settings, "waterdepth_raster_upload_list"):
-            for file in self.settings.waterdepth_raster_upload_list:
-                file_path_list.append(
-                    os.path.join(self.settings.raster_output_folder, file + ".tif")
-                )
-        if hasattr(self.settings, "waterlevel_raster_upload_list"):
-            for file in self.settings.waterlevel_raster_upload_list:
-                file_path_list.append(
-                    os.path.join(self.settings.raster_output_folder, file + ".tif")
-                )
-        for file in file_path_list:
-            ds = gdal.Open(file, gdal.GA_Update)
-            if ds:
-                print("Updating projection for " + file)
-                srs_wkt = self.create_projection(self.settings.projection)
-                res = ds.SetProjection(srs_wkt)
-                if res != 0:
-                    print("Setting projection failed " + str(res))
-                ds = None  # save, close
-            else:
-                print("Could not open with GDAL: " + file)
+            for raster in waterdepth_filenames
+        ]
+        results = job_queue.wait(job_ids)
+        return [results[job_id] for job_id in job_ids]
+
+    def determine_impact(self, impact_module, raster):
+        """Classify the impact of one depth raster, return the impact raster."""
+        vector_list = []
+        vector_list.append(
+            impact_module.determine_vulnerability_roads(
+                self.settings.roads_file, self.settings.projection, raster
+            )
+        )
+        vector_list.append(
+            impact_module.determine_vulnerability_buildings(
+                self.settings.buildings_file, self.settings.projection, raster
+            )
+        )
+        if self.settings.end_result_type == "raster":
+            return impact_module.create_impact_raster(vector_list, raster)
+        logger.info("Geoserver vulnerability not implemented yet")
 
+    @traced
     def upload_bom_precipitation(self):
         self.NC_to_tiffs(Path("temp"))
 
@@ -163,6 +262,7 @@ class ProcessFlash:
         )
         logger.info("Bom rainfall posted to Lizard")
 
+    @traced
     def archive_simulation(self):
         folder_time_string = (
             str(self.settings.start_time).replace(":", "_").replace(" ", "_")
@@ -189,11 +289,14 @@ class ProcessFlash:
                 self.settings.gauge_rainfall_file,
                 os.path.join(result_folder, "gauge_rain.csv"),
             )
-        if hasattr(self.settings, "boundary_csv_tuflow_file"):
-            shutil.copyfile(
-                self.settings.boundary_csv_tuflow_file,
-                os.path.join(result_folder, "boundary_csv_tuflow_file.csv"),
+        for number, (_, boundary_file) in enumerate(
+            self.settings.get_boundary_sources()
+        ):
+            # archived under the name it always had, further ones numbered
+            name = "boundary_csv_tuflow_file{}.csv".format(
+                "_{}".format(number + 1) if number else ""
             )
+            shutil.copyfile(boundary_file, os.path.join(result_folder, name))
         if self.settings.get_bom_forecast:
             shutil.copyfile(
                 os.path.join("temp", "forecast_rain.nc"),
@@ -216,6 +319,7 @@ class ProcessFlash:
                     source_file = os.path.join(dirname, file)
                     os.remove(source_file)
 
+    @traced
     def clear_in_output(self):
         shutil.rmtree("Log")
         shutil.rmtree(self.settings.output_folder)
@@ -228,8 +332,8 @@ class ProcessFlash:
             os.remove(self.settings.netcdf_nowcast_rainfall_file)
         if hasattr(self.settings, "gauge_rainfall_file"):
             os.remove(self.settings.gauge_rainfall_file)
-        if hasattr(self.settings, "boundary_csv_tuflow_file"):
-            os.remove(self.settings.boundary_csv_tuflow_file)
+        for _, boundary_file in self.settings.get_boundary_sources():
+            os.remove(boundary_file)
 
     def create_projection(self, projection):
         """obtain wkt definition of the tuflow spatial projection. Used to write
@@ -240,41 +344,6 @@ class ProcessFlash:
         srs_wkt = srs.ExportToWkt()
         return srs_wkt
 
-    def convert_flt_to_tiff(self):
-        gdal.UseExceptions()
-        file_path_list = []
-        if self.settings.waterdepth_raster_upload_list:
-            for file in self.settings.waterdepth_raster_upload_list:
-                file_path_list.append(
-                    os.path.join(self.settings.raster_output_folder, file + ".flt")
-                )
-        if self.settings.waterlevel_raster_upload_list:
-            for file in self.settings.waterlevel_raster_upload_list:
-                file_path_list.append(
-                    os.path.join(self.settings.raster_output_folder, file + ".flt")
-                )
-
-        for file in file_path_list:
-            data = gdal.Open(file, gdalconst.GA_ReadOnly)
-            nodata = data.GetRasterBand(1).GetNoDataValue()
-            data_array = data.GetRasterBand(1).ReadAsArray()
-            geo_transform = data.GetGeoTransform()
-            proj = self.create_projection(self.settings.projection)
-            x_res = data.RasterXSize
-            y_res = data.RasterYSize
-
-            output = file.replace(".flt", ".tif")
-            target_ds = gdal.GetDriverByName("GTiff").Create(
-                output, x_res, y_res, 1, gdal.GDT_Float32, options=["COMPRESS=Deflate"]
-            )
-            target_ds.SetGeoTransform(geo_transform)
-            target_ds.GetRasterBand(1).WriteArray(data_array)
-            target_ds.SetProjection(proj)
-            target_ds.GetRasterBand(1).SetNoDataValue(nodata)
-            target_ds.FlushCache()
-            target_ds = None
-        return
-
     def create_post_element(self, series, shift):
         data = []
         aus_now = datetime.datetime.now(pytz.timezone("Australia/Sydney"))
@@ -290,7 +359,9 @@ class ProcessFlash:
             )
         return data
 
+    @traced
     def post_timeseries(self):
+        session = resources.http_session()
         username = "__key__"
         password = self.settings.apikey
         headers = {
@@ -321,9 +392,10 @@ class ProcessFlash:
                 results_dataframe[row["po_name"]], row["shift"]
             )
             url = TIMESERIES_URL + row["ts_uuid"] + "/events/"
-            r = requests.delete(url=url, headers=headers)
-            r = requests.post(url=url, data=json.dumps(timeserie), headers=headers)
+            r = session.delete(url=url, headers=headers)
+            r = session.post(url=url, data=json.dumps(timeserie), headers=headers)
 
+    @traced
     def NC_to_tiffs(self, Output_folder):
         nc_data_obj = nc.Dataset(self.settings.netcdf_rainfall_file)
         Lon = nc_data_obj.variables["y"][:]
@@ -369,40 +441,11 @@ class ProcessFlash:
             out_tif.FlushCache()  #  write data to hard disk
             out_tif = None  #  note that the tif file must be closed
 
+    @traced
     def post_temporal_raster_to_lizard(self, filenames, raster_uuid, timestamps):
-        username = "__key__"
-        password = self.settings.apikey
-        headers = {
-            "username": username,
-            "password": password,
-        }
-
-        json_headers = {
-            "username": username,
-            "password": password,
-            "Content-Type": "application/json",
-        }
-        raster_url = RASTER_SOURCES_URL + raster_uuid + "/"
-        url = raster_url + "data/"
-
-        aus_now = datetime.datetime.now(pytz.timezone("Australia/Sydney"))
-        timezone_stamp = (
-            "+" + str(int(aus_now.utcoffset().total_seconds() / 3600)).zfill(2) + ":00"
-        )
-        requests.delete(url=url, headers=json_headers)
-
+        self.clear_temporal_raster(raster_uuid)
         for file, timestamp in zip(filenames, timestamps):
-            logger.debug("posting file %s to lizard", file)
-            lizard_timestamp = timestamp.strftime("%Y-%m-%dT%H:%M:00")
-            lizard_timestamp = lizard_timestamp + timezone_stamp
-            file = {"file": open(file, "rb")}
-            data = {"timestamp": lizard_timestamp}
-            r = requests.post(url=url, data=data, files=file, headers=headers)
-
-            try:
-                r.raise_for_status()
-            except:
-                logger.error("Error, file post for %s failed", file)
+            self.post_raster_to_lizard(file, raster_uuid, timestamp)
 
             # waittime = 0
             # while (
@@ -418,7 +461,48 @@ class ProcessFlash:
             # sleep(10)
         return
 
+    def clear_temporal_raster(self, raster_uuid):
+        """Remove the data of the previous forecast from a temporal raster."""
+        json_headers = {
+            "username": "__key__",
+            "password": self.settings.apikey,
+            "Content-Type": "application/json",
+        }
+        url = RASTER_SOURCES_URL + raster_uuid + "/data/"
+        resources.http_session().delete(url=url, headers=json_headers)
+
+    def post_raster_to_lizard(self, file, raster_uuid, timestamp):
+        session = resources.http_session()
+        headers = {
+            "username": "__key__",
+            "password": self.settings.apikey,
+        }
+        url = RASTER_SOURCES_URL + raster_uuid + "/data/"
+
+        aus_now = datetime.datetime.now(pytz.timezone("Australia/Sydney"))
+        timezone_stamp = (
+            "+" + str(int(aus_now.utcoffset().total_seconds() / 3600)).zfill(2) + ":00"
+        )
+        logger.debug("posting file %s to lizard", file)
+        lizard_timestamp = timestamp.strftime("%Y-%m-%dT%H:%M:00")
+        lizard_timestamp = lizard_timestamp + timezone_stamp
+        with open(file, "rb") as f:
+            r = session.post(
+                url=url,
+                data={"timestamp": lizard_timestamp},
+                files={"file": f},
+                headers=headers,
+            )
+
+        try:
+            r.raise_for_status()
+            metrics.increment("rasters_uploaded", raster_source=raster_uuid)
+        except:
+            logger.error("Error, file post for %s failed", file)
+
+    @traced
     def track_historic_forecasts_in_lizard(self):
+        session = resources.http_session()
         headers = {
             "username": "__key__",
             "password": self.settings.apikey,
@@ -431,8 +515,8 @@ class ProcessFlash:
             for x in range(len(row) - 1, 0, -1):
                 url_to_update = TIMESERIES_URL + row[x] + "/events/"
                 source_data_url = TIMESERIES_URL + row[x - 1] + "/events/"
-                requests.delete(url=url_to_update, headers=headers)
-                r = requests.get(url=source_data_url, params=params, headers=headers)
+                session.delete(url=url_to_update, headers=headers)
+                r = session.get(url=source_data_url, params=params, headers=headers)
                 source_df = pd.DataFrame(r.json()["results"])
                 try:
                     source_df["time"] = pd.to_datetime(source_df["time"])
@@ -442,7 +526,7 @@ class ProcessFlash:
                         timeserie_data.append(
                             {"time": index.isoformat(), "value": str(value)}
                         )
-                    r = requests.post(
+                    r = session.post(
                         url=url_to_update,
                         data=json.dumps(timeserie_data),
                         headers=headers,
@@ -0,0 +1,170 @@
+from concurrent.futures import ThreadPoolExecutor
+from pathlib import Path
+
+import csv
+import logging
+
+
+logger = logging.getLogger(__name__)
+
+PREFLIGHT_WORKERS = 8
+HEADER_BYTES = 16
+SHAPEFILE_CODE = b"\x00\x00\x27\x0a"
+TIFF_SIGNATURES = (b"II*\x00", b"MM\x00*", b"II+\x00", b"MM\x00+")
+SIDECAR_EXTENSIONS = {".shp": (".shx", ".dbf"), ".flt": (".hdr",)}
+ERROR = "error"
+WARNING = "warning"
+
+
+class PreflightException(Exception):
+    pass
+
+
+def check_file(path, description):
+    """Check that a file exists, is not empty and has a recognisable header."""
+    path = Path(path)
+    if not path.is_file():
+        return [(ERROR, "{} {} not found".format(description, path))]
+    if path.stat().st_size == 0:
+        return [(ERROR, "{} {} is empty".format(description, path))]
+    try:
+        with open(path, "rb") as f:
+            header = f.read(HEADER_BYTES)
+    except OSError as e:
+        return [(ERROR, "{} {} is not readable: {}".format(description, path, e))]
+
+    problems = []
+    suffix = path.suffix.lower()
+    if suffix == ".asc" and not header.lower().startswith(b"ncols"):
+        problems.append(
+            (ERROR, "{} {} has no ascii grid header".format(description, path))
+        )
+    elif suffix == ".shp" and not header.startswith(SHAPEFILE_CODE):
+        problems.append((ERROR, "{} {} is not a shapefile".format(description, path)))
+    elif suffix in (".tif", ".tiff") and not header.startswith(TIFF_SIGNATURES):
+        problems.append((ERROR, "{} {} is not a GeoTIFF".format(description, path)))
+    for sidecar in SIDECAR_EXTENSIONS.get(suffix, ()):
+        if not path.with_suffix(sidecar).exists():
+            problems.append(
+                (ERROR, "{} {} misses its {} file".format(description, path, sidecar))
+            )
+    return problems
+
+
+def read_time_column(csv_file):
+    """Return the first (time) column of a TUFLOW csv as floats."""
+    with open(csv_file, newline="") as f:
+        reader = csv.reader(f)
+        next(reader)
+        return [float(row[0]) for row in reader if row and row[0].strip()]
+
+
+class PreflightCheck:
+    """Check every input a TUFLOW run depends on before launching it."""
+
+    def __init__(self, settings):
+        self.settings = settings
+
+    def get_checks(self):
+        checks = []
+        if hasattr(self.settings, "rain_grids_csv") and (
+            self.settings.get_bom_forecast
+            or self.settings.get_bom_nowcast
+            or self.settings.use_bom_historical
+        ):
+            checks += self.rain_grid_checks()
+        if self.settings.convert_csv_to_bc or getattr(
+            self.settings, "predict_tide", False
+        ):
+            for _, boundary_file in self.settings.get_boundary_sources():
+                checks.append((self.check_boundary_file, boundary_file))
+        if hasattr(self.settings, "restart_file"):
+            checks.append((check_file, self.settings.restart_file, "Restart file"))
+        model_index = getattr(self.settings, "model_index", None)
+        if model_index is not None:
+            for input_file in model_index.input_files:
+                if input_file.path == model_index.restart_file:
+                    continue
+                checks.append(
+                    (
+                        check_file,
+                        input_file.path,
+                        "Input '{}' ({})".format(
+                            input_file.command, Path(input_file.control_file).name
+                        ),
+                    )
+                )
+        return checks
+
+    def run(self):
+        checks = self.get_checks()
+        with ThreadPoolExecutor(max_workers=PREFLIGHT_WORKERS) as executor:
+            futures = [executor.submit(*check) for check in checks]
+            problems = [problem for future in futures for problem in future.result()]
+
+        for level, message in problems:
+            if level == WARNING:
+                logger.warning(message)
+        errors = [message for level, message in problems if level == ERROR]
+        if errors:
+            raise PreflightException(
+                "Pre-flight check failed:\n" + "\n".join(sorted(errors))
+            )
+        logger.info("Pre-flight check passed for %s inputs", len(checks))
+
+    def check_coverage(self, times, description):
+        if not times:
+            return [(ERROR, "{} contains no timesteps".format(description))]
+        problems = []
+        if min(times) > self.settings.tuflow_start_time:
+            problems.append(
+                (
+                    WARNING,
+                    "{} starts at {} h, after the simulation start ({} h)".format(
+                        description, min(times), self.settings.tuflow_start_time
+                    ),
+                )
+            )
+        if max(times) < self.settings.tuflow_end_time:
+            problems.append(
+                (
+                    WARNING,
+                    "{} ends at {} h, before the simulation end ({} h)".format(
+                        description, max(times), self.settings.tuflow_end_time
+                    ),
+                )
+            )
+        return problems
+
+    def check_boundary_file(self, boundary_file):
+        problems = check_file(boundary_file, "Boundary file")
+        if problems:
+            return problems
+        try:
+            times = read_time_column(boundary_file)
+        except (ValueError, StopIteration) as e:
+            return [(ERROR, "Boundary file {} is invalid: {}".format(boundary_file, e))]
+        return self.check_coverage(times, "Boundary file {}".format(boundary_file))
+
+    def rain_grid_checks(self):
+        """Return a check per rain grid listed in the rain grid csv."""
+        rain_grids_csv = Path(self.settings.rain_grids_csv)
+        problems = check_file(rain_grids_csv, "Rain grid csv")
+        if problems:
+            return [(lambda: problems,)]
+
+        times = []
+        checks = []
+        with open(rain_grids_csv, newline="") as f:
+            reader = csv.reader(f)
+            next(reader, None)
+            for row in reader:
+                if len(row) < 2:
+                    continue
+                times.append(float(row[0]))
+                grid_file = rain_grids_csv.parent / row[1].strip().replace("\\", "/")
+                checks.append((check_file, grid_file, "Rain grid"))
+        checks.append(
+            (self.check_coverage, times, "Rain grid csv {}".format(rain_grids_csv))
+        )
+        return checks
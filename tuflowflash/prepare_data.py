@@ -1,42 +1,120 @@
-from pyproj import Proj
-from pyproj import Transformer
-from shapely.geometry import mapping
+from functools import lru_cache
+from typing import Dict
 from typing import List
+from typing import TYPE_CHECKING
 from datetime import datetime, timedelta
 from pathlib import Path
+from tuflowflash import ensemble
+from tuflowflash import resources
+from tuflowflash.lazy_import import lazy_import
+from tuflowflash.read_settings import MissingSettingException
+from tuflowflash.tide_prediction import TidePredictor
+from tuflowflash.tracing import traced
 
-import cftime
 import ftplib
-import geopandas
 import glob
 import gzip
+import importlib.util
 import logging
-import netCDF4 as nc
 import numpy as np
 import os
 import pandas as pd
 import pytz
-import requests
-import rioxarray
+import re
 import shutil
 import time
 
 
+if TYPE_CHECKING:
+    import cftime
+
+try:
+    from pandas.tseries.api import guess_datetime_format
+except ImportError:
+    from pandas._libs.tslibs.parsing import guess_datetime_format
+
+# Heavy GIS libraries are only imported by the stages that use them
+gdal = lazy_import("gdal", "osgeo.gdal")
+nc = lazy_import("netCDF4")
+pyproj = lazy_import("pyproj")
+rioxarray = lazy_import("rioxarray")
+shapely_geometry = lazy_import("shapely.geometry")
+
 logger = logging.getLogger(__name__)
 
 TIMESERIES_URL = "https://rhdhv.lizard.net/api/v4/timeseries/{}/events/"
 FTP_RETRY_COUNT = 10
 FTP_RETRY_SLEEP = 5
+SOIL_BLOCK_ROWS = 256
+DEFAULT_RESIDUAL_FUNCTION = "apply_residual"
 
 
 class MissingFileException(Exception):
     pass
 
 
+# inferred boundary datetime formats by layout
+DATETIME_FORMATS: Dict[str, str] = {}
+
+
+def infer_datetime_format(sample):
+    """Guess the (day first) datetime format of a boundary csv once per layout.
+
+    The layout is the sample with its digits masked, so every file with the
+    same layout reuses the format inferred for the first one.
+    """
+    datetime_shape = re.sub(r"\d", "0", sample)
+    if datetime_shape in DATETIME_FORMATS:
+        return DATETIME_FORMATS[datetime_shape]
+    datetime_format = guess_datetime_format(sample, dayfirst=True)
+    if datetime_format is not None and datetime_format.startswith("%Y"):
+        # dayfirst does not apply to year first (ISO 8601) datetimes
+        datetime_format = guess_datetime_format(sample)
+    if datetime_format is None:
+        raise ValueError("Could not infer datetime format from '%s'" % sample)
+    DATETIME_FORMATS[datetime_shape] = datetime_format
+    return datetime_format
+
+
+def parse_boundary_datetimes(datetimes, datetime_format=None):
+    """Parse a column of datetime strings with one fixed format."""
+    if datetime_format is None:
+        datetime_format = infer_datetime_format(str(datetimes.iloc[0]).strip())
+    return pd.DatetimeIndex(
+        pd.to_datetime(datetimes, format=datetime_format), name=datetimes.name
+    )
+
+
+@lru_cache(maxsize=None)
+def load_residual_plugin(script, function_name=DEFAULT_RESIDUAL_FUNCTION):
+    """Import the custom residual tide script once and return its hook.
+
+    The hook is called as ``hook(boundary_df, settings, boundary_file)`` for
+    every boundary with its dataframe (indexed on hours relative to the
+    reference time) and the boundary file it is written to, and must return
+    the modified dataframe.
+    """
+    script = Path(script)
+    if not script.exists():
+        raise MissingFileException("Custom residual script %s not found" % script)
+    spec = importlib.util.spec_from_file_location(
+        "tuflowflash_residual_%s" % script.stem, script
+    )
+    module = importlib.util.module_from_spec(spec)
+    spec.loader.exec_module(module)
+    try:
+        return getattr(module, function_name)
+    except AttributeError as e:
+        raise AttributeError(
+            "Custom residual script %s has no function '%s'" % (script, function_name)
+        ) from e
+
+
 class prepareData:
     def __init__(self, settings):
         self.settings = settings
 
+    @traced
     def get_historical_precipitation(self):
         logger.info("Started gathering historical precipitation data")
         rainfall_gauges_uuids = self.read_rainfall_timeseries_uuids()
@@ -58,6 +136,7 @@ class prepareData:
         rain_df.to_csv(self.settings.gauge_rainfall_file)
         logger.info("succesfully written rainfall file")
 
+    @traced
     def get_precipitation_nowcast(self):
         sourcePath = Path(r"temp/radar_rain.nc")
         self.download_bom_radar_data(self.settings.bom_nowcast_file)
@@ -68,6 +147,9 @@ class prepareData:
         local_end = local.localize(self.settings.end_time, is_dst=None)
         utc_end = local_end.astimezone(pytz.utc)
 
+        if hasattr(self.settings, "ensemble_members"):
+            self.write_ensemble_nowcasts(sourcePath, utc_start, utc_end)
+            return
         self.write_nowcast_netcdf_with_time_indexes(
             sourcePath,
             self.settings.netcdf_nowcast_rainfall_file,
@@ -77,6 +159,28 @@ class prepareData:
         )
         logger.info("succesfully prepared netcdf radar rainfall")
 
+    def write_ensemble_nowcasts(self, source_file, start, end):
+        """Write a nowcast netcdf per selected ensemble member."""
+        source = nc.Dataset(source_file)
+        totals = self.ensemble_rainfall_totals(source)
+        source.close()
+        selection = ensemble.select_members(totals, self.settings.ensemble_members)
+        for member, member_index in selection.items():
+            self.write_nowcast_netcdf_with_time_indexes(
+                source_file,
+                ensemble.member_file(self.settings.netcdf_nowcast_rainfall_file, member),
+                start,
+                end,
+                self.settings.reference_time,
+                member_index,
+            )
+        ensemble.write_selection(self.settings, selection)
+        logger.info(
+            "succesfully prepared netcdf radar rainfall of %s ensemble members",
+            len(selection),
+        )
+
+    @traced
     def get_precipitation_forecast(self):
         sourcePath = Path(r"temp/forecast_rain.nc")
         self.download_bom_forecast_data(self.settings.bom_forecast_file)
@@ -91,23 +195,106 @@ class prepareData:
         )
         logger.info("succesfully prepared netcdf radar rainfall")
 
+    @traced
     def convert_csv_file_to_bc_file(self):
-        csv_df = pd.read_csv(self.settings.boundary_csv_input_file, delimiter=",")
-        csv_df["Time (h)"] = pd.to_datetime(csv_df["datetime"], dayfirst=True)
-        csv_df.set_index("Time (h)", inplace=True)
-        csv_df.index = (csv_df.index - self.settings.reference_time) / np.timedelta64(
-            1, "h"
+        boundary_sources = self.settings.get_boundary_sources()
+        if not boundary_sources:
+            raise MissingSettingException(
+                "convert_csv_to_bc needs boundary_csv_input_file(s) and "
+                "boundary_csv_tuflow_file(s) in {}.".format(self.settings.settingsFile)
+            )
+        datetime_format = getattr(self.settings, "boundary_datetime_format", None)
+
+        boundary_dfs = []
+        for input_file, _ in boundary_sources:
+            csv_df = pd.read_csv(input_file, delimiter=",")
+            csv_df.index = parse_boundary_datetimes(csv_df["datetime"], datetime_format)
+            csv_df.index.name = "Time (h)"
+            boundary_dfs.append(csv_df)
+
+        if len(boundary_dfs) > 1:
+            boundary_dfs = self.align_boundaries(boundary_dfs, datetime_format)
+
+        for csv_df, (_, output_file) in zip(boundary_dfs, boundary_sources):
+            csv_df.index = (
+                csv_df.index - self.settings.reference_time
+            ) / np.timedelta64(1, "h")
+            if self.settings.custom_residual_tide:
+                csv_df = self.apply_custom_residual(csv_df, output_file)
+            csv_df.to_csv(output_file)
+        logger.info(
+            "succesfully converted %s csv file(s) to boundary files",
+            len(boundary_sources),
         )
-        csv_df.to_csv(self.settings.boundary_csv_tuflow_file)
-        logger.info("succesfully converted csv to boundary file")
+
+    @traced
+    def predict_tide_boundaries(self):
+        local = pytz.timezone("Australia/Sydney")
+        local_reference_time = local.localize(self.settings.reference_time, is_dst=None)
+        utc_reference_time = local_reference_time.astimezone(pytz.utc)
+
+        residual_hook = None
+        if self.settings.custom_residual_tide:
+            residual_hook = self.apply_custom_residual
+        TidePredictor(self.settings).write_tide_boundaries(
+            utc_reference_time, residual_hook
+        )
+        logger.info("succesfully predicted tidal boundaries")
+
+    def align_boundaries(self, boundary_dfs, datetime_format=None):
+        """Put all boundary dataframes on one common time axis.
+
+        The axis is the union of all timestamps within the period covered by
+        every source, values are linearly interpolated in time. The datetime
+        column is written in the format of each source.
+        """
+        start = max(csv_df.index.min() for csv_df in boundary_dfs)
+        end = min(csv_df.index.max() for csv_df in boundary_dfs)
+        time_axis = boundary_dfs[0].index
+        for csv_df in boundary_dfs[1:]:
+            time_axis = time_axis.union(csv_df.index)
+        time_axis = time_axis[(time_axis >= start) & (time_axis <= end)]
+
+        aligned_dfs = []
+        for csv_df in boundary_dfs:
+            values = csv_df.drop(columns="datetime")
+            values = values[~values.index.duplicated()]
+            values = (
+                values.reindex(time_axis.union(values.index))
+                .interpolate(method="time", limit_area="inside")
+                .reindex(time_axis)
+            )
+            # rebuilt from the axis, interpolated times have no datetime string
+            source_format = datetime_format or infer_datetime_format(
+                str(csv_df["datetime"].iloc[0]).strip()
+            )
+            values.insert(0, "datetime", time_axis.strftime(source_format))
+            values.index.name = csv_df.index.name
+            aligned_dfs.append(values)
+        return aligned_dfs
+
+    def apply_custom_residual(self, boundary_df, boundary_file):
+        residual_hook = load_residual_plugin(
+            self.settings.custom_residual_script,
+            getattr(
+                self.settings, "custom_residual_function", DEFAULT_RESIDUAL_FUNCTION
+            ),
+        )
+        boundary_df = residual_hook(boundary_df, self.settings, Path(boundary_file))
+        logger.info(
+            "applied custom residual tide from %s to %s",
+            self.settings.custom_residual_script,
+            boundary_file,
+        )
+        return boundary_df
 
     def write_forecast_netcdf_with_time_indexes(
         self, sourcePath, output_file, clipshape, start_time, end_time, reference_time
     ):
-        geodf = geopandas.read_file(clipshape)
+        geodf = resources.read_vector(clipshape)
         xds = rioxarray.open_rasterio(sourcePath)
         xds = xds.rio.write_crs(4326)
-        source = xds.rio.clip(geodf.geometry.apply(mapping), geodf.crs)
+        source = xds.rio.clip(geodf.geometry.apply(shapely_geometry.mapping), geodf.crs)
         xds_lonlat = source.rio.reproject(
             "EPSG:{}".format(self.settings.projection), resolution=5500
         )
@@ -125,6 +312,7 @@ class prepareData:
         rainfall_timeseries = pd.read_csv(self.settings.precipitation_uuid_file)
         return rainfall_timeseries
 
+    @traced
     def get_lizard_timeseries(self, rainfall_timeseries):
         # ugly code
         json_headers = {
@@ -148,7 +336,7 @@ class prepareData:
             "page_size": 100000,
         }
         for index, row in rainfall_timeseries.iterrows():
-            r = requests.get(
+            r = resources.http_session().get(
                 TIMESERIES_URL.format(row["gauge_uuid"]),
                 params=params,
                 headers=json_headers,
@@ -186,31 +374,32 @@ class prepareData:
             rain_df[col].values[0] = 0
         return rain_df
 
-    def download_bom_radar_data(self, nowcast_file):
-        for x in range(FTP_RETRY_COUNT):
-            try:
-                ftp_server = ftplib.FTP(
-                    self.settings.bom_url,
-                    self.settings.bom_username,
-                    self.settings.bom_password,
-                )
-                ftp_server.encoding = "utf-8"
-                ftp_server.cwd("radar/")
+    def bom_ftp_connection(self):
+        return resources.ftp_connection(
+            self.settings.bom_url,
+            self.settings.bom_username,
+            self.settings.bom_password,
+        )
 
-                radar_files = []
-                files = ftp_server.nlst()
+    def get_latest_nowcast_filename(self, ftp_server, nowcast_file):
+        ftp_server.cwd("radar/")
+        radar_files = []
+        files = ftp_server.nlst()
 
-                for file in files:
-                    if file.startswith(nowcast_file):
-                        radar_files.append(file)
+        for file in files:
+            if file.startswith(nowcast_file):
+                radar_files.append(file)
+        return radar_files[-1]
 
-                bomfile = radar_files[-1]
-                if not os.path.exists("temp"):
-                    os.mkdir("temp")
+    @traced
+    def download_bom_radar_data(self, nowcast_file):
+        for x in range(FTP_RETRY_COUNT):
+            try:
+                with self.bom_ftp_connection() as ftp_server:
+                    bomfile = self.get_latest_nowcast_filename(ftp_server, nowcast_file)
+                    os.makedirs("temp", exist_ok=True)
 
-                with open("temp/radar_rain.nc", "wb") as file:
-                    ftp_server.retrbinary(f"RETR {bomfile}", file.write)
-                ftp_server.close()
+                    resources.ftp_download(ftp_server, bomfile, "temp/radar_rain.nc")
             except ftplib.error_temp:
                 logger.warning("Temporary ftp issue, retrying in: %s", FTP_RETRY_SLEEP)
                 time.sleep(FTP_RETRY_SLEEP)
@@ -218,20 +407,16 @@ class prepareData:
                 break
         return
 
+    @traced
     def download_bom_forecast_data(self, bomfile):
         for x in range(FTP_RETRY_COUNT):
             try:
-                ftp_server = ftplib.FTP(
-                    self.settings.bom_url,
-                    self.settings.bom_username,
-                    self.settings.bom_password,
-                )
-                ftp_server.encoding = "utf-8"
-                ftp_server.cwd("adfd/")
-                tmp_rainfile = Path("temp/" + bomfile)
+                with self.bom_ftp_connection() as ftp_server:
+                    ftp_server.cwd("adfd/")
+                    os.makedirs("temp", exist_ok=True)
+                    tmp_rainfile = Path("temp/" + bomfile)
 
-                with open(tmp_rainfile, "wb") as f:
-                    ftp_server.retrbinary(f"RETR {bomfile}", f.write)
+                    resources.ftp_download(ftp_server, bomfile, tmp_rainfile)
 
                 with gzip.open(tmp_rainfile, "rb") as f_in:
                     with open("temp/forecast_rain.nc", "wb") as f_out:
@@ -245,26 +430,34 @@ class prepareData:
 
     def timestamps_from_netcdf(
         self, source_file: Path
-    ) -> List[cftime.DatetimeGregorian]:
+    ) -> "List[cftime.DatetimeGregorian]":
         source = nc.Dataset(source_file)
         timestamps = nc.num2date(source["valid_time"][:], source["valid_time"].units)
         source.close()
         return timestamps
 
-    def get_p50_netcdf_rainfall(self, source):
-        # select 50pth percentile rainfall
+    def ensemble_rainfall_totals(self, source):
+        # one member at a time, so memory does not grow with the ensemble size
         cum_rainfall_list = []
         for x in range(len(source.variables["precipitation"])):
             cum_rainfall_list.append(
                 np.sum(np.sum(source.variables["precipitation"][x]))
             )
-        p = np.percentile(cum_rainfall_list, 50)
-        closest_to_p50 = min(cum_rainfall_list, key=lambda x: abs(x - p))
-        p50_index = cum_rainfall_list.index(closest_to_p50)
-        return p50_index
+        return cum_rainfall_list
+
+    def get_p50_netcdf_rainfall(self, source):
+        # select 50pth percentile rainfall
+        totals = self.ensemble_rainfall_totals(source)
+        return ensemble.select_members(totals, ["p50"])["p50"]
 
+    @traced
     def write_new_netcdf(
-        self, source_file: Path, dest_file: Path, time_indexes: List, reference_time
+        self,
+        source_file: Path,
+        dest_file: Path,
+        time_indexes: List,
+        reference_time,
+        member_index=None,
     ):
         source = nc.Dataset(source_file)
         x_center, y_center = self.reproject_bom(
@@ -272,7 +465,8 @@ class prepareData:
             source.variables["proj"].latitude_of_projection_origin,
         )
         target = nc.Dataset(dest_file, mode="w")
-        p50_index = self.get_p50_netcdf_rainfall(source)
+        if member_index is None:
+            member_index = self.get_p50_netcdf_rainfall(source)
         # Create the dimensions of the file.
         for name, dim in source.dimensions.items():
             dim_length = len(dim)
@@ -328,14 +522,17 @@ class prepareData:
                     }
                 )
 
-            data = source.variables[name][:]
+            if name == "precipitation":
+                # only read the member that is written
+                data = source.variables[name][member_index, time_indexes]
+            else:
+                data = source.variables[name][:]
             # Copy the variables values.
             if name == "valid_time":
                 data = data[time_indexes]
                 data = (data - reference_time.timestamp()) / 3600
                 target.variables["time"][:] = data
             elif name == "precipitation":
-                data = data[p50_index, time_indexes]
                 data = data  # * 20 # to be checked
                 data = np.where(data < 0, -999, data)
                 target.variables["rainfall_depth"][:, :, :] = data
@@ -348,7 +545,13 @@ class prepareData:
         source.close()
 
     def write_nowcast_netcdf_with_time_indexes(
-        self, source_file: Path, dest_file: Path, start, end, reference_time
+        self,
+        source_file: Path,
+        dest_file: Path,
+        start,
+        end,
+        reference_time,
+        member_index=None,
     ):
         """Return netcdf file with only time indexes"""
         if not source_file.exists():
@@ -365,16 +568,20 @@ class prepareData:
             .flatten()
             .tolist()
         )
-        self.write_new_netcdf(source_file, dest_file, time_indexes, reference_time)
+        self.write_new_netcdf(
+            source_file, dest_file, time_indexes, reference_time, member_index
+        )
         logger.debug("Wrote new time-index-only netcdf to %s", dest_file)
 
     def reproject_bom(self, x, y):
-        transformer = Transformer.from_proj(
-            Proj("epsg:4326"), Proj("epsg:{}".format(self.settings.projection))
+        transformer = pyproj.Transformer.from_proj(
+            pyproj.Proj("epsg:4326"),
+            pyproj.Proj("epsg:{}".format(self.settings.projection)),
         )
         x2, y2 = transformer.transform(y, x)
         return x2, y2
 
+    @traced
     def forecast_nowcast_netcdf_to_ascii(
         self, netcdf_file, previous_time, rainfall_mp_factor=1
     ):
@@ -419,6 +626,7 @@ class prepareData:
                 comments="",
             )
 
+    @traced
     def select_hindcast_netcdf_files(self):
         local = pytz.timezone("Australia/Sydney")
         local_start = local.localize(self.settings.start_time, is_dst=None)
@@ -453,6 +661,7 @@ class prepareData:
                     )
                     pass
 
+    @traced
     def hindcast_netcdf_to_ascii(self, netcdf_rainfall_file, ascii_outfile):
         nc_data_obj = nc.Dataset(netcdf_rainfall_file)
         x_center, y_center = self.reproject_bom(
@@ -492,6 +701,7 @@ class prepareData:
             comments="",
         )
 
+    @traced
     def write_ascii_csv(self):
         rain_timestamp_list = []
         file_names = []
@@ -505,6 +715,7 @@ class prepareData:
         df.set_index("Time (hrs)", inplace=True)
         df.to_csv(self.settings.rain_grids_csv)
 
+    @traced
     def get_soil_moisture(self):
         # Create timezone objecty of Sydney Australia
         aus_tz = pytz.timezone("Australia/Sydney")
@@ -515,21 +726,19 @@ class prepareData:
         for year in [str(time_now.year), str(time_now.year)]:
             # Generate the name of the .nc file to download (for example sm_pct_2023.nc). One nc file exists for each year and the file is updated daily
             soil_moisture_nc_filename = "sm_pct_" + str(year) + ".nc"
-            soil_moisture_nc_file = (self.settings.soil_moisture_folder / soil_moisture_nc_filename)
-
-            # Initialise soil moisture pct tif in EPSG4326 
-            soil_moisture_pct_tif_filename = "sm_pct_" + str(year) + "_EPSG4326.tif"
-            soil_moisture_pct_tif_file =  (self.settings.soil_moisture_folder / soil_moisture_pct_tif_filename)
-            # Initialise soil moisture pct tif in EPSG28355 
-            soil_moisture_pct_reprojected_tif_filename = "sm_pct_" + str(year) + "_EPSG28355.tif"
-            soil_moisture_pct_reprojected_tif_file =  (self.settings.soil_moisture_folder / soil_moisture_pct_reprojected_tif_filename)
-            # Initialise soil moisture pct tif in EPSG28355 
-            # soil_moisture_depth_tif_filename = "sm_pct_EPSG28355_depth.tif"
-            soil_moisture_depth_tif_file =  (self.settings.soil_moisture_folder / self.settings.soil_moisture_depth_file)
+            soil_moisture_nc_file = (
+                self.settings.soil_moisture_folder / soil_moisture_nc_filename
+            )
+            soil_moisture_depth_tif_file = (
+                self.settings.soil_moisture_folder
+                / self.settings.soil_moisture_depth_file
+            )
 
             # Generate request for file from the AWO HTTP server
-            awra_l_url = self.settings.soil_moisture_awra_l_url + soil_moisture_nc_filename
-            response = requests.get(awra_l_url)
+            awra_l_url = (
+                self.settings.soil_moisture_awra_l_url + soil_moisture_nc_filename
+            )
+            response = resources.http_session().get(awra_l_url)
 
             if response.status_code == 200:
                 with open(soil_moisture_nc_file, "wb") as file:
@@ -537,72 +746,93 @@ class prepareData:
                 logging.info("succesfully downloaded %s", soil_moisture_nc_filename)
 
                 # Open the NetCDF variable
-                soil_moisture_nc = gdal.Open(f'NETCDF:\"{soil_moisture_nc_file}\":sm_pct')
-
-                # Get the last band (latest time)
-                band = soil_moisture_nc.GetRasterBand(soil_moisture_nc.RasterCount)
-
-                # Save as GeoTIFF
-                gdal.Translate(str(soil_moisture_pct_tif_file), soil_moisture_nc, bandList=[soil_moisture_nc.RasterCount])
-
-                # the resolution and bounds of the depth of soil root zone file
-                x_res = self.settings.soil_moisture_xres #80
-                y_res = self.settings.soil_moisture_yres #80
-                # the extent of the depth of soil root zone file
-                xmin = self.settings.soil_moisture_xmin #388000
-                xmax = self.settings.soil_moisture_xmax #523040
-                ymin = self.settings.soil_moisture_ymin #7772960
-                ymax = self.settings.soil_moisture_ymax #7918000
-
-                # Warp the moisture_pct to the same extent and projection as the soil root zone file
-                gdal.Warp(
-                    str(soil_moisture_pct_reprojected_tif_file),
-                    str(soil_moisture_pct_tif_file), 
-                    srcSRS="EPSG:4326", 
-                    dstSRS="EPSG:28355", 
-                    outputBounds=(xmin, ymin, xmax, ymax),
-                    xRes=x_res,
-                    yRes=y_res,
-                    resampleAlg="nearest")
-
-                # Input and output paths
-                r1 = gdal.Open(str(soil_moisture_pct_reprojected_tif_file))
-                r2 = gdal.Open(str(self.settings.soil_root_zone_depth_file))
-                out_path = str(soil_moisture_depth_tif_file)
-
-                # Read arrays and NoData
-                a1 = r1.GetRasterBand(1)
-                a2 = r2.GetRasterBand(1)
-                d1 = a1.ReadAsArray()
-                d2 = a2.ReadAsArray()
-                nodata = a1.GetNoDataValue() or -9999
-
-                # Multiply two rasters with nodata where there is no data in the root zone depth
-                mask = (d1 != nodata) & (d2 != nodata)
-                result = np.full_like(d1, nodata, dtype=np.float32)
-                result[mask] = d1[mask] * d2[mask]
-
-                # Save result as a geotiff
-                driver = gdal.GetDriverByName("GTiff")
-                out = driver.Create(out_path, r1.RasterXSize, r1.RasterYSize, 1, gdal.GDT_Float32)
-                out.SetGeoTransform(r1.GetGeoTransform())
-                out.SetProjection(r1.GetProjection())
-                out.GetRasterBand(1).WriteArray(result)
-                out.GetRasterBand(1).SetNoDataValue(nodata)
-                out.FlushCache()
+                soil_moisture_nc = gdal.Open(f'NETCDF:"{soil_moisture_nc_file}":sm_pct')
+
+                # Select the last band (latest time) as an in-memory VRT
+                soil_moisture_pct = gdal.Translate(
+                    "",
+                    soil_moisture_nc,
+                    format="VRT",
+                    bandList=[soil_moisture_nc.RasterCount],
+                )
+
+                # Warp the moisture_pct to the same extent and projection as the
+                # soil root zone file, again as a VRT so nothing is computed yet
+                soil_moisture_pct_reprojected = gdal.Warp(
+                    "",
+                    soil_moisture_pct,
+                    format="VRT",
+                    srcSRS="EPSG:4326",
+                    dstSRS="EPSG:28355",
+                    outputBounds=(
+                        self.settings.soil_moisture_xmin,
+                        self.settings.soil_moisture_ymin,
+                        self.settings.soil_moisture_xmax,
+                        self.settings.soil_moisture_ymax,
+                    ),
+                    xRes=self.settings.soil_moisture_xres,
+                    yRes=self.settings.soil_moisture_yres,
+                    resampleAlg="nearest",
+                )
+                root_zone_depth = gdal.Open(
+                    str(self.settings.soil_root_zone_depth_file)
+                )
+
+                # Only the final depth geotiff is written to disk
+                self.multiply_rasters_blockwise(
+                    soil_moisture_pct_reprojected,
+                    root_zone_depth,
+                    soil_moisture_depth_tif_file,
+                )
 
                 # close all variables opened by gdal
                 soil_moisture_nc = None
-                r1 = None
-                r2 = None
-                out = None
-
-                # Delete the intermediate files except for the original .nc and the final depth geotiff
-                os.remove(soil_moisture_pct_tif_file)
-                os.remove(soil_moisture_pct_reprojected_tif_file)
+                soil_moisture_pct = None
+                soil_moisture_pct_reprojected = None
+                root_zone_depth = None
 
                 # End the function here if it works
                 return
 
         else:
-            logger.warning("Could not download %s", soil_moisture_nc_filename)
\ No newline at end of file
+            logger.warning("Could not download %s", soil_moisture_nc_filename)
+
+    @traced
+    def multiply_rasters_blockwise(self, r1, r2, out_path, block_rows=SOIL_BLOCK_ROWS):
+        """Multiply two aligned rasters strip by strip into a GeoTIFF.
+
+        Only ``block_rows`` rows of each input are held in memory at a time, so
+        larger extents do not blow up memory. Cells that are nodata in either
+        input are written as nodata.
+        """
+        a1 = r1.GetRasterBand(1)
+        a2 = r2.GetRasterBand(1)
+        nodata = a1.GetNoDataValue() or -9999
+        x_size, y_size = r1.RasterXSize, r1.RasterYSize
+
+        driver = gdal.GetDriverByName("GTiff")
+        out = driver.Create(
+            str(out_path),
+            x_size,
+            y_size,
+            1,
+            gdal.GDT_Float32,
+            options=["COMPRESS=Deflate", "TILED=YES"],
+        )
+        out.SetGeoTransform(r1.GetGeoTransform())
+        out.SetProjection(r1.GetProjection())
+        out_band = out.GetRasterBand(1)
+        out_band.SetNoDataValue(nodata)
+
+        for y_off in range(0, y_size, block_rows):
+            rows = min(block_rows, y_size - y_off)
+            d1 = a1.ReadAsArray(0, y_off, x_size, rows)
+            d2 = a2.ReadAsArray(0, y_off, x_size, rows)
+            # Multiply two rasters with nodata where there is no data in the root zone depth
+            mask = (d1 != nodata) & (d2 != nodata)
+            result = np.full(d1.shape, nodata, dtype=np.float32)
+            np.multiply(d1, d2, out=result, where=mask, casting="unsafe")
+            out_band.WriteArray(result, 0, y_off)
+
+        out.FlushCache()
+        out = None
@@ -0,0 +1,142 @@
+from pathlib import Path
+
+import cProfile
+import json
+import logging
+import pstats
+import threading
+
+
+logger = logging.getLogger(__name__)
+
+# Fraction of the total time below which call stacks are left out of the
+# speedscope file
+SPEEDSCOPE_MIN_FRACTION = 0.0005
+SPEEDSCOPE_SCHEMA = "https://www.speedscope.app/file-format-schema.json"
+
+# cProfile hooks into the interpreter globally (sys.monitoring since Python
+# 3.12), so profiled stages take turns
+_profile_lock = threading.Lock()
+
+
+def function_name(function):
+    filename, line, name = function
+    if filename == "~":
+        return name  # builtins, e.g. <built-in method time.sleep>
+    return "{} ({}:{})".format(name, Path(filename).name, line)
+
+
+def pstats_to_speedscope(stats, name):
+    """Return a speedscope (sampled) profile of a pstats.Stats.
+
+    pstats only keeps caller/callee totals, so the time of a function called
+    from several places is split over its call stacks in proportion to the
+    time spent per caller.
+    """
+    raw_stats = stats.stats
+    children = {}
+    for function, (_, _, _, _, callers) in raw_stats.items():
+        for caller, (_, _, _, edge_time) in callers.items():
+            children.setdefault(caller, {})[function] = edge_time
+    roots = [
+        function for function, (_, _, _, _, callers) in raw_stats.items() if not callers
+    ]
+    total = sum(raw_stats[root][3] for root in roots) or stats.total_tt
+    min_weight = total * SPEEDSCOPE_MIN_FRACTION
+
+    frames = []
+    frame_index = {}
+    samples = []
+    weights = []
+
+    def frame(function):
+        if function not in frame_index:
+            frame_index[function] = len(frames)
+            filename, line, _ = function
+            frames.append(
+                {
+                    "name": function_name(function),
+                    "file": filename,
+                    "line": line,
+                }
+            )
+        return frame_index[function]
+
+    def walk(function, stack, on_stack, fraction):
+        self_time = raw_stats[function][2]
+        stack = stack + [frame(function)]
+        if self_time * fraction >= min_weight:
+            samples.append(stack)
+            weights.append(self_time * fraction)
+        for child, edge_time in children.get(function, {}).items():
+            child_time = raw_stats[child][3]
+            if child in on_stack or not child_time:
+                continue
+            child_fraction = fraction * edge_time / child_time
+            if child_time * child_fraction < min_weight:
+                continue
+            walk(child, stack, on_stack | {child}, child_fraction)
+
+    for root in roots:
+        walk(root, [], {root}, 1.0)
+
+    return {
+        "$schema": SPEEDSCOPE_SCHEMA,
+        "name": name,
+        "exporter": "tuflowflash",
+        "shared": {"frames": frames},
+        "profiles": [
+            {
+                "type": "sampled",
+                "name": name,
+                "unit": "seconds",
+                "startValue": 0,
+                "endValue": sum(weights),
+                "samples": samples,
+                "weights": weights,
+            }
+        ],
+    }
+
+
+class StageProfiler:
+    """Profile pipeline stages with cProfile.
+
+    Per stage ``<stage>.pstats`` (for pstats/snakeviz) and
+    ``<stage>.speedscope.json`` (https://www.speedscope.app) are written to
+    the output folder. ``stages`` limits profiling to the named stages.
+    """
+
+    def __init__(self, output_folder, stages=None):
+        self.output_folder = Path(output_folder)
+        self.stages = set(stages) if stages else None
+
+    def wants(self, stage_name):
+        return self.stages is None or stage_name in self.stages
+
+    def check_stage_names(self, stage_names):
+        for name in sorted((self.stages or set()) - set(stage_names)):
+            logger.warning(
+                "Cannot profile unknown stage '%s', stages are: %s",
+                name,
+                ", ".join(stage_names),
+            )
+
+    def run(self, stage_name, function):
+        with _profile_lock:
+            profile = cProfile.Profile()
+            try:
+                return profile.runcall(function)
+            finally:
+                self.write(stage_name, profile)
+
+    def write(self, stage_name, profile):
+        self.output_folder.mkdir(parents=True, exist_ok=True)
+        pstats_file = self.output_folder / "{}.pstats".format(stage_name)
+        profile.dump_stats(pstats_file)
+        stats = pstats.Stats(profile)
+        with open(
+            self.output_folder / "{}.speedscope.json".format(stage_name), "w"
+        ) as f:
+            json.dump(pstats_to_speedscope(stats, stage_name), f)
+        logger.info("profile of stage %s written to %s", stage_name, pstats_file)
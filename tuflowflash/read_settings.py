@@ -1,6 +1,8 @@
 from pathlib import Path
+from tuflowflash.control_files import load_model_index
 
 import configparser as ConfigParser
+import copy
 import datetime
 import logging
 
@@ -15,8 +17,6 @@ Tuflow_settings = {
     "export_states_folder": Path,
     "states_expiry_time_days": int,
     "gauge_rainfall_file": Path,
-    "boundary_csv_input_file": Path,
-    "boundary_csv_tuflow_file": Path,
     "custom_residual_script": Path,
     "netcdf_forecast_rainfall_file": Path,
     "netcdf_nowcast_rainfall_file": Path,
@@ -38,6 +38,35 @@ Tuflow_settings = {
     "pu": int,
 }
 
+optional_tuflow_settings = {
+    "custom_residual_function": str,
+    "boundary_csv_input_file": Path,
+    "boundary_csv_tuflow_file": Path,
+    "boundary_csv_input_files": list,
+    "boundary_csv_tuflow_files": list,
+    "boundary_datetime_format": str,
+    "tide_constituent_files": list,
+    "tide_timestep_minutes": int,
+    "tide_level_column": str,
+    "tuflow_scenarios": list,
+    "tuflow_events": list,
+    "pipeline_workers": int,
+    "states_keep_count": int,
+    "result_cache_folder": Path,
+    "result_cache_entries": int,
+    "tuflow_domains": list,
+    "tuflow_domain_units": list,
+    "processing_units": list,
+    "tuflow_timeout_minutes": int,
+    "tuflow_memory_limit_mb": int,
+    "ensemble_members": list,
+    "exceedance_depths": list,
+    "job_queue_folder": Path,
+    "job_queue_timeout_minutes": int,
+    "segment_hours": int,
+    "raster_workers": int,
+}
+
 lizard_settings = {
     "apikey": str,
     "precipitation_uuid_file": Path,
@@ -74,6 +103,14 @@ switches_settings = {
     "determine_impact": bool,
 }
 
+optional_switches_settings = {
+    "predict_tide": bool,
+    "preflight_check": bool,
+    "overlap_post_processing": bool,
+    "map_output_override": bool,
+    "convert_flt_outputs": bool,
+}
+
 bom_settings = {
     "bom_username": str,
     "bom_password": str,
@@ -84,6 +121,16 @@ bom_settings = {
     "forecast_clipshape": Path,
 }
 
+optional_diagnostics_settings = {
+    "trace_folder": Path,
+    "trace_memory": bool,
+    "metrics_file": Path,
+    "metrics_port": int,
+    "metrics_address": str,
+    "telemetry_folder": Path,
+    "resource_sample_seconds": int,
+}
+
 email_settings = {
     "email_adress": str,
     "email_password": str,
@@ -112,15 +159,25 @@ class FlashSettings:
             raise MissingFileException(msg) from e
 
         self.read_settings_file(Tuflow_settings, "tuflow")
+        self.read_settings_file(optional_tuflow_settings, "tuflow", optional=True)
         self.read_settings_file(lizard_settings, "lizard")
         self.read_settings_file(switches_settings, "switches")
+        self.read_settings_file(optional_switches_settings, "switches", optional=True)
         if self.determine_impact:
             self.read_settings_file(impact_module_settings, "impact_module")
         self.read_settings_file(bom_settings, "bom")
         self.read_settings_file(email_settings, "email")
+        self.read_settings_file(
+            optional_diagnostics_settings, "diagnostics", optional=True
+        )
 
         self.read_tcf_parameters(self.tcf_file)
+        self.set_reference_time(reference_time)
+
+        logger.info("settings have been read")
 
+    def set_reference_time(self, reference_time=None):
+        """(Re)compute reference, start and end time, None means now."""
         self.reference_time, self.start_time = self.convert_relative_time(
             self.tuflow_start_time, reference_time
         )
@@ -129,39 +186,71 @@ class FlashSettings:
             self.tuflow_end_time, reference_time
         )
 
-        logger.info("settings have been read")
-
     def extract_variable_from_tcf(self, line):
         variable = line.split("==")[1]
         variable = variable.split("!")[0].strip()
         return variable
 
     def read_tcf_parameters(self, tcf_file):
-        with open(tcf_file) as f:
-            lines = f.readlines()
-        for line in lines:
-            if line.lower().startswith("start time"):
-                setattr(
-                    self,
-                    "tuflow_start_time",
-                    float(self.extract_variable_from_tcf(line)),
-                )
-            if line.lower().startswith("end time"):
-                setattr(
-                    self,
-                    "tuflow_end_time",
-                    float(self.extract_variable_from_tcf(line)),
-                )
-            if line.lower().startswith("output folder"):
-                setattr(
-                    self, "output_folder", Path(self.extract_variable_from_tcf(line))
+        self.model_index = load_model_index(
+            tcf_file,
+            scenarios=[s.strip() for s in getattr(self, "tuflow_scenarios", [])],
+            events=[e.strip() for e in getattr(self, "tuflow_events", [])],
+        )
+        if self.model_index.start_time is not None:
+            self.tuflow_start_time = self.model_index.start_time
+        if self.model_index.end_time is not None:
+            self.tuflow_end_time = self.model_index.end_time
+        if self.model_index.get("output folder"):
+            self.output_folder = Path(self.model_index.get("output folder"))
+        if self.model_index.get("shp projection"):
+            self.prj_file = Path(self.model_index.get("shp projection"))
+        if self.model_index.get("read restart file"):
+            self.restart_file = Path(self.model_index.get("read restart file"))
+
+    def domain_settings(self, tcf_file):
+        """Return a copy of the settings for another TUFLOW control file."""
+        settings = copy.copy(self)
+        settings.tcf_file = Path(tcf_file)
+        for variable in ("output_folder", "prj_file", "restart_file"):
+            settings.__dict__.pop(variable, None)
+        settings.read_tcf_parameters(settings.tcf_file)
+        settings.start_time = settings.reference_time + datetime.timedelta(
+            hours=float(settings.tuflow_start_time)
+        )
+        settings.end_time = settings.reference_time + datetime.timedelta(
+            hours=float(settings.tuflow_end_time)
+        )
+        return settings
+
+    def get_boundary_sources(self):
+        """Return (input csv, tuflow bc csv) pairs for all boundaries.
+
+        The lists take precedence over the single files, an empty list is
+        returned when no boundary is configured.
+        """
+        for settings in (
+            ("boundary_csv_input_files", "boundary_csv_tuflow_files"),
+            ("boundary_csv_input_file", "boundary_csv_tuflow_file"),
+        ):
+            missing = [setting for setting in settings if not hasattr(self, setting)]
+            if len(missing) == 1:
+                raise MissingSettingException(
+                    f"{missing[0]} is missing in {self.settingsFile}, it is "
+                    f"needed with {(set(settings) - set(missing)).pop()}."
                 )
-            if line.lower().startswith("shp projection"):
-                setattr(self, "prj_file", Path(self.extract_variable_from_tcf(line)))
-            if line.lower().startswith("read restart file"):
-                setattr(
-                    self, "restart_file", Path(self.extract_variable_from_tcf(line))
+        if hasattr(self, "boundary_csv_input_files"):
+            input_files = [Path(f.strip()) for f in self.boundary_csv_input_files]
+            output_files = [Path(f.strip()) for f in self.boundary_csv_tuflow_files]
+            if len(input_files) != len(output_files):
+                raise MissingSettingException(
+                    "boundary_csv_input_files and boundary_csv_tuflow_files "
+                    f"should have the same length in {self.settingsFile}."
                 )
+            return list(zip(input_files, output_files))
+        if hasattr(self, "boundary_csv_input_file"):
+            return [(self.boundary_csv_input_file, self.boundary_csv_tuflow_file)]
+        return []
 
     def roundTime(self, dt=None, roundTo=60):
         """Round a datetime object to any time lapse in seconds
@@ -184,10 +273,13 @@ class FlashSettings:
         time = reference_time + datetime.timedelta(hours=float(relative_time))
         return reference_time, time
 
-    def read_settings_file(self, variables, variable_header):
+    def read_settings_file(self, variables, variable_header, optional=False):
         # maak de output van deze functie aan
         for variable, datatype in variables.items():
-            value = self.config.get(variable_header, variable)
+            if optional:
+                value = self.config.get(variable_header, variable, fallback="")
+            else:
+                value = self.config.get(variable_header, variable)
             if len(value) > 0:
                 try:
                     if datatype == int:
@@ -0,0 +1,185 @@
+from tuflowflash import metrics
+from tuflowflash import tracing
+
+import logging
+import subprocess
+import threading
+import time
+
+try:
+    import psutil
+except ImportError:
+    psutil = None
+
+logger = logging.getLogger(__name__)
+
+DEFAULT_SAMPLE_SECONDS = 5
+# time TUFLOW gets to exit after a terminate before it is killed
+KILL_GRACE_SECONDS = 10
+
+
+class ResourceWatchdog:
+    """Sample and police the resources of a running TUFLOW process.
+
+    Every ``sample_seconds`` the CPU, RSS and IO of the process and its
+    children are recorded in the cycle trace (needs ``psutil``). The process
+    tree is terminated (and killed after ``KILL_GRACE_SECONDS``) when it runs
+    longer than ``max_wall_seconds`` or its RSS exceeds ``max_rss_bytes``.
+    """
+
+    def __init__(
+        self,
+        process,
+        name="TUFLOW",
+        sample_seconds=DEFAULT_SAMPLE_SECONDS,
+        max_wall_seconds=None,
+        max_rss_bytes=None,
+        metric_labels=None,
+    ):
+        self.process = process
+        self.name = name
+        self.sample_seconds = sample_seconds
+        self.max_wall_seconds = max_wall_seconds
+        self.max_rss_bytes = max_rss_bytes
+        self.metric_labels = metric_labels or {}
+        self.kill_reason = None
+        self.samples = []
+        self.tracked = {}
+        self.stopped = threading.Event()
+        self.thread = None
+        self.started = None
+        if max_rss_bytes is not None and psutil is None:
+            logger.warning("The TUFLOW memory ceiling needs psutil, not enforced")
+
+    def processes(self):
+        """Return the process and its (current) children as psutil Processes."""
+        try:
+            root = self.tracked.get(self.process.pid) or psutil.Process(
+                self.process.pid
+            )
+            current = [root] + root.children(recursive=True)
+        except psutil.Error:
+            return []
+        # keep the Process objects, cpu_percent is measured between calls
+        self.tracked = {p.pid: self.tracked.get(p.pid, p) for p in current}
+        return list(self.tracked.values())
+
+    def sample(self):
+        sample = {
+            "elapsed": time.monotonic() - self.started,
+            "cpu_percent": 0.0,
+            "cpu_seconds": 0.0,
+            "rss_bytes": 0,
+            "read_bytes": 0,
+            "write_bytes": 0,
+        }
+        for process in self.processes():
+            try:
+                with process.oneshot():
+                    sample["cpu_percent"] += process.cpu_percent()
+                    cpu_times = process.cpu_times()
+                    sample["cpu_seconds"] += cpu_times.user + cpu_times.system
+                    sample["rss_bytes"] += process.memory_info().rss
+                    try:
+                        io = process.io_counters()
+                        sample["read_bytes"] += io.read_bytes
+                        sample["write_bytes"] += io.write_bytes
+                    except (AttributeError, psutil.AccessDenied):
+                        pass
+            except psutil.Error:
+                # the process exited between listing and sampling
+                continue
+        return sample
+
+    def check(self, sample):
+        elapsed = time.monotonic() - self.started
+        if self.max_wall_seconds is not None and elapsed > self.max_wall_seconds:
+            return "wall_time", "ran longer than {:.0f} s".format(self.max_wall_seconds)
+        if (
+            sample is not None
+            and self.max_rss_bytes is not None
+            and sample["rss_bytes"] > self.max_rss_bytes
+        ):
+            return "memory", "RSS of {:.0f} MB exceeds {:.0f} MB".format(
+                sample["rss_bytes"] / 1e6, self.max_rss_bytes / 1e6
+            )
+        return None
+
+    def kill(self, kind, reason):
+        self.kill_reason = reason
+        logger.error("%s %s, stopping it", self.name, reason)
+        metrics.increment("tuflow_watchdog_kills", reason=kind, **self.metric_labels)
+        if psutil is None:
+            self.process.terminate()
+            try:
+                self.process.wait(KILL_GRACE_SECONDS)
+            except subprocess.TimeoutExpired:
+                self.process.kill()
+            return
+        processes = self.processes()
+        for process in reversed(processes):
+            try:
+                process.terminate()
+            except psutil.Error:
+                pass
+        _, alive = psutil.wait_procs(processes, timeout=KILL_GRACE_SECONDS)
+        for process in alive:
+            logger.warning("killing %s (pid %s)", self.name, process.pid)
+            try:
+                process.kill()
+            except psutil.Error:
+                pass
+
+    def watch(self):
+        while not self.stopped.wait(self.sample_seconds):
+            if self.process.poll() is not None:
+                return
+            sample = None
+            if psutil is not None:
+                sample = self.sample()
+                self.samples.append(sample)
+                tracing.sample(
+                    self.name,
+                    cpu_percent=sample["cpu_percent"],
+                    rss_bytes=sample["rss_bytes"],
+                    read_bytes=sample["read_bytes"],
+                    write_bytes=sample["write_bytes"],
+                )
+            limit = self.check(sample)
+            if limit is not None:
+                self.kill(*limit)
+                return
+
+    def summary(self):
+        """Return peak RSS, CPU time and mean CPU use of the samples."""
+        if not self.samples:
+            return {}
+        return {
+            "samples": len(self.samples),
+            "peak_rss_bytes": max(s["rss_bytes"] for s in self.samples),
+            "cpu_seconds": self.samples[-1]["cpu_seconds"],
+            "mean_cpu_percent": sum(s["cpu_percent"] for s in self.samples)
+            / len(self.samples),
+            "read_bytes": self.samples[-1]["read_bytes"],
+            "write_bytes": self.samples[-1]["write_bytes"],
+        }
+
+    def start(self):
+        self.started = time.monotonic()
+        self.thread = threading.Thread(
+            target=self.watch, name="tuflow-watchdog", daemon=True
+        )
+        self.thread.start()
+
+    def stop(self):
+        self.stopped.set()
+        self.thread.join()
+        summary = self.summary()
+        if summary:
+            metrics.set_gauge(
+                "tuflow_peak_rss_bytes", summary["peak_rss_bytes"], **self.metric_labels
+            )
+            metrics.set_gauge(
+                "tuflow_cpu_seconds", summary["cpu_seconds"], **self.metric_labels
+            )
+        return summary
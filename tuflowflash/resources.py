@@ -0,0 +1,138 @@
+from pathlib import Path
+from tuflowflash import metrics
+from typing import Any
+from typing import Dict
+from typing import List
+from typing import Optional
+from typing import Tuple
+from urllib.parse import urlsplit
+
+import atexit
+import contextlib
+import ftplib
+import logging
+import os
+import threading
+
+
+logger = logging.getLogger(__name__)
+
+_lock = threading.Lock()
+_http_session = None
+# logged in connections per (url, username)
+_idle_ftp_connections: Dict[Tuple[str, str], List[ftplib.FTP]] = {}
+# (mtime, GeoDataFrame) per (path, layer)
+_vector_cache: Dict[Tuple[str, Optional[str]], Tuple[int, Any]] = {}
+
+
+def http_session():
+    """Return the process wide requests session (keeps connections alive)."""
+    global _http_session
+    with _lock:
+        if _http_session is None:
+            import requests
+
+            _http_session = requests.Session()
+            _http_session.hooks["response"].append(count_response_bytes)
+        return _http_session
+
+
+def count_response_bytes(response, *args, **kwargs):
+    if kwargs.get("stream"):
+        size = int(response.headers.get("Content-Length", 0))
+    else:
+        size = len(response.content)
+    metrics.increment("download_bytes", size, source=urlsplit(response.url).hostname)
+
+
+def connect_ftp(url, username, password):
+    ftp_server = ftplib.FTP(url, username, password)
+    ftp_server.encoding = "utf-8"
+    ftp_server.home = ftp_server.pwd()
+    return ftp_server
+
+
+@contextlib.contextmanager
+def ftp_connection(url, username, password):
+    """Yield a logged in FTP connection in its home directory.
+
+    Idle connections are reused across downloads (and across cycles in service
+    mode). A connection that raised an error is closed instead of reused.
+    """
+    key = (url, username)
+    ftp_server = None
+    while ftp_server is None:
+        with _lock:
+            idle = _idle_ftp_connections.setdefault(key, [])
+            if not idle:
+                break
+            candidate = idle.pop()
+        try:
+            candidate.voidcmd("NOOP")
+            candidate.cwd(candidate.home)
+            ftp_server = candidate
+        except ftplib.all_errors:
+            close_ftp(candidate)
+    if ftp_server is None:
+        ftp_server = connect_ftp(url, username, password)
+
+    try:
+        yield ftp_server
+    except BaseException:
+        close_ftp(ftp_server)
+        raise
+    else:
+        with _lock:
+            _idle_ftp_connections[key].append(ftp_server)
+
+
+def ftp_download(ftp_server, filename, target_file):
+    """Download a file from the current FTP directory, return its size."""
+    size = 0
+    with open(target_file, "wb") as f:
+
+        def write(block):
+            nonlocal size
+            size += len(block)
+            f.write(block)
+
+        ftp_server.retrbinary(f"RETR {filename}", write)
+    metrics.increment("download_bytes", size, source=ftp_server.host)
+    return size
+
+
+def close_ftp(ftp_server):
+    try:
+        ftp_server.quit()
+    except ftplib.all_errors:
+        ftp_server.close()
+
+
+def read_vector(path, layer=None):
+    """Return a copy of a (static) GIS layer, read once per file version."""
+    import geopandas
+
+    path = Path(path)
+    key = (str(path), layer)
+    mtime = os.stat(path).st_mtime_ns
+    with _lock:
+        cached = _vector_cache.get(key)
+    if cached is None or cached[0] != mtime:
+        kwargs = {"layer": layer} if layer is not None else {}
+        cached = (mtime, geopandas.read_file(path, **kwargs))
+        with _lock:
+            _vector_cache[key] = cached
+    return cached[1].copy()
+
+
+@atexit.register
+def close_all():
+    global _http_session
+    with _lock:
+        connections = [c for idle in _idle_ftp_connections.values() for c in idle]
+        _idle_ftp_connections.clear()
+        session, _http_session = _http_session, None
+    for ftp_server in connections:
+        close_ftp(ftp_server)
+    if session is not None:
+        session.close()
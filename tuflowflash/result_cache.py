@@ -0,0 +1,242 @@
+from concurrent.futures import ThreadPoolExecutor
+from pathlib import Path
+from tuflowflash.state_catalogue import clone_file
+
+import csv
+import hashlib
+import json
+import logging
+import os
+import shutil
+import threading
+
+logger = logging.getLogger(__name__)
+
+DEFAULT_CACHE_ENTRIES = 5
+HASH_WORKERS = 4
+HASH_BLOCK_SIZE = 1024 * 1024
+DIGEST_FILE = "digests.json"
+MANIFEST_FILE = "manifest.json"
+KEY_VERSION = 1
+# outputs post-processing rewrites in place (finalised GeoTIFFs)
+REWRITTEN_SUFFIXES = (".tif", ".tiff")
+
+_digest_lock = threading.Lock()
+
+
+def file_digest(path):
+    digest = hashlib.sha256()
+    with open(path, "rb") as f:
+        for block in iter(lambda: f.read(HASH_BLOCK_SIZE), b""):
+            digest.update(block)
+    return digest.hexdigest()
+
+
+def rain_grid_files(rain_grids_csv):
+    """Return the rain grids listed in a TUFLOW rain grid csv."""
+    rain_grids_csv = Path(rain_grids_csv)
+    with open(rain_grids_csv, newline="") as f:
+        reader = csv.reader(f)
+        next(reader, None)
+        return [
+            rain_grids_csv.parent / row[1].strip().replace("\\", "/")
+            for row in reader
+            if len(row) >= 2
+        ]
+
+
+def simulation_inputs(settings):
+    """Return every file a TUFLOW run of these settings reads."""
+    inputs = []
+    model_index = getattr(settings, "model_index", None)
+    if model_index is not None:
+        inputs += [Path(f) for f in model_index.control_files]
+        inputs += model_index.input_paths()
+    else:
+        inputs.append(Path(settings.tcf_file))
+    rain_grids_csv = getattr(settings, "rain_grids_csv", None)
+    if rain_grids_csv is not None and Path(rain_grids_csv).is_file():
+        inputs.append(Path(rain_grids_csv))
+        inputs += rain_grid_files(rain_grids_csv)
+    if hasattr(settings, "gauge_rainfall_file"):
+        inputs.append(Path(settings.gauge_rainfall_file))
+    if hasattr(settings, "boundary_csv_input_files") or hasattr(
+        settings, "boundary_csv_tuflow_file"
+    ):
+        inputs += [Path(bc) for _, bc in settings.get_boundary_sources()]
+    restart_file = getattr(model_index, "restart_file", None) or getattr(
+        settings, "restart_file", None
+    )
+    if restart_file is not None:
+        restart_file = str(restart_file)
+        inputs += [Path(restart_file), Path(restart_file.replace(".trf", ".erf"))]
+    return sorted({os.path.normpath(str(path)) for path in inputs})
+
+
+class ResultCache:
+    """Cache of TUFLOW results keyed on the content of all simulation inputs.
+
+    An entry is a folder named after the input hash holding links to the
+    output folders of the run. File digests are remembered per (size, mtime)
+    so large static inputs are only hashed once. The ``max_entries`` most
+    recently used entries are kept.
+    """
+
+    def __init__(self, cache_folder, max_entries=DEFAULT_CACHE_ENTRIES):
+        self.cache_folder = Path(cache_folder)
+        self.max_entries = max_entries
+        self.digest_file = self.cache_folder / DIGEST_FILE
+        self.digests = None
+
+    def load_digests(self):
+        try:
+            with open(self.digest_file) as f:
+                return json.load(f)
+        except (OSError, ValueError):
+            return {}
+
+    def digest(self, path):
+        """Return the content digest of a file, "missing" if it does not exist."""
+        try:
+            stat = os.stat(path)
+        except FileNotFoundError:
+            return "missing"
+        if not os.path.isfile(path):
+            return "not a file"
+        signature = [stat.st_size, stat.st_mtime_ns]
+        with _digest_lock:
+            cached = self.digests.get(path)
+        if cached is not None and cached[0] == signature:
+            return cached[1]
+        digest = file_digest(path)
+        with _digest_lock:
+            self.digests[path] = (signature, digest)
+        return digest
+
+    def key(self, input_files, run_command):
+        """Return the hash of the run command and the content of the inputs."""
+        self.digests = self.load_digests()
+        with ThreadPoolExecutor(max_workers=HASH_WORKERS) as executor:
+            digests = list(executor.map(self.digest, input_files))
+        self.cache_folder.mkdir(parents=True, exist_ok=True)
+        temp_file = self.digest_file.with_name(DIGEST_FILE + ".tmp")
+        with open(temp_file, "w") as f:
+            json.dump(
+                {
+                    path: self.digests[path]
+                    for path in input_files
+                    if path in self.digests
+                },
+                f,
+            )
+        os.replace(temp_file, self.digest_file)
+
+        executable = run_command[0]
+        executable_signature = None
+        if os.path.isfile(executable):
+            stat = os.stat(executable)
+            executable_signature = [stat.st_size, stat.st_mtime_ns]
+        key = hashlib.sha256()
+        key.update(
+            json.dumps([KEY_VERSION, list(run_command), executable_signature]).encode()
+        )
+        for path, digest in zip(input_files, digests):
+            key.update("{}\0{}\n".format(path, digest).encode())
+        return key.hexdigest()
+
+    def entry(self, key):
+        return self.cache_folder / key
+
+    def restore(self, key, output_folders):
+        """Link the cached outputs into place, False when the key is not cached."""
+        manifest_file = self.entry(key) / MANIFEST_FILE
+        if not manifest_file.exists():
+            return False
+        with open(manifest_file) as f:
+            manifest = json.load(f)
+        if sorted(manifest["folders"].values()) != sorted(map(str, output_folders)):
+            return False
+        for name, folder in manifest["folders"].items():
+            source_folder = self.entry(key) / name
+            for source in source_folder.rglob("*"):
+                if source.is_file():
+                    target = Path(folder) / source.relative_to(source_folder)
+                    target.parent.mkdir(parents=True, exist_ok=True)
+                    clone_file(source, target)
+        os.utime(manifest_file)
+        return True
+
+    def store(self, key, output_folders):
+        entry = self.entry(key)
+        temp_entry = entry.with_name(key + ".tmp")
+        if temp_entry.exists():
+            shutil.rmtree(temp_entry)
+        folders = {}
+        for number, folder in enumerate(output_folders):
+            folder = Path(folder)
+            name = str(number)
+            folders[name] = str(folder)
+            if not folder.exists():
+                continue
+            for source in folder.rglob("*"):
+                if source.is_file():
+                    target = temp_entry / name / source.relative_to(folder)
+                    target.parent.mkdir(parents=True, exist_ok=True)
+                    clone_file(source, target)
+        temp_entry.mkdir(parents=True, exist_ok=True)
+        with open(temp_entry / MANIFEST_FILE, "w") as f:
+            json.dump({"key": key, "folders": folders}, f, indent=1)
+        if entry.exists():
+            shutil.rmtree(entry)
+        os.replace(temp_entry, entry)
+        self.prune()
+
+    def prune(self):
+        entries = sorted(
+            (
+                path
+                for path in self.cache_folder.iterdir()
+                if (path / MANIFEST_FILE).exists()
+            ),
+            key=lambda path: (path / MANIFEST_FILE).stat().st_mtime,
+        )
+        for entry in entries[: max(len(entries) - self.max_entries, 0)]:
+            logger.debug("removing result cache entry %s", entry.name)
+            shutil.rmtree(entry, ignore_errors=True)
+
+
+def release_links(folders):
+    """Unlink files shared with a cache or state folder before TUFLOW writes.
+
+    TUFLOW may rewrite output files in place, which would change the cached
+    copies sharing their data.
+    """
+    for folder in folders:
+        folder = Path(folder)
+        if not folder.exists():
+            continue
+        for path in folder.rglob("*"):
+            if path.is_file() and path.stat().st_nlink > 1:
+                path.unlink()
+
+
+def detach_links(folders, suffixes=REWRITTEN_SUFFIXES):
+    """Give shared outputs that post-processing rewrites their own data.
+
+    Restored and stored results are hard links into the cache; writing to
+    them would change the cache entry as well. A reflink or copy replaces
+    each linked file with one of these suffixes.
+    """
+    for folder in folders:
+        folder = Path(folder)
+        if not folder.exists():
+            continue
+        for path in folder.rglob("*"):
+            if (
+                path.suffix.lower() in suffixes
+                and path.is_file()
+                and path.stat().st_nlink > 1
+            ):
+                copy = path.with_name(path.name + ".detached")
+                clone_file(path, copy, hardlink=False)
+                os.replace(copy, path)
@@ -1,12 +1,33 @@
 from datetime import datetime
-from datetime import timedelta
 from pathlib import Path
+from tuflowflash import metrics
+from tuflowflash import tracing
+from tuflowflash.control_files import run_control_file
+from tuflowflash.control_files import write_run_control_file
+from tuflowflash.map_output import remove_map_output_override
+from tuflowflash.map_output import write_map_output_override
+from tuflowflash.preflight import PreflightCheck
+from tuflowflash.resource_watchdog import DEFAULT_SAMPLE_SECONDS
+from tuflowflash.result_cache import DEFAULT_CACHE_ENTRIES
+from tuflowflash.result_cache import detach_links
+from tuflowflash.result_cache import release_links
+from tuflowflash.result_cache import ResultCache
+from tuflowflash.result_cache import simulation_inputs
+from tuflowflash.segments import merge_po_csvs
+from tuflowflash.segments import PO_CSV_SUFFIX
+from tuflowflash.segments import remove_segment_override
+from tuflowflash.segments import segment_output_file
+from tuflowflash.segments import segment_windows
+from tuflowflash.segments import write_segment_override
+from tuflowflash.state_catalogue import clone_file
+from tuflowflash.state_catalogue import StateCatalogue
+from tuflowflash.state_catalogue import STATE_SUFFIXES
+from tuflowflash.tracing import traced
+from tuflowflash.tuflow_supervisor import TuflowSupervisor
 
-import glob
 import logging
 import os
-import shutil
-import subprocess
+import time
 
 
 logger = logging.getLogger(__name__)
@@ -16,117 +37,331 @@ class MissingFileException(Exception):
     pass
 
 
+class TuflowSimulationException(Exception):
+    pass
+
+
 class TuflowSimulation:
-    def __init__(self, settings):
+    def __init__(
+        self,
+        settings,
+        milestones=(),
+        processing_units=None,
+        name=None,
+        on_segment=None,
+    ):
         self.settings = settings
-        self.run_command = [
-            self.settings.tuflow_executable,
-            "-b",
-            "-x",
-            "-pu{}".format(str(self.settings.pu)),
-            str(self.settings.tcf_file),
-        ]
+        # (simulated time in hours, callback) called while TUFLOW runs
+        self.milestones = list(milestones)
+        # called with the end time (h) of every finished segment
+        self.on_segment = on_segment
+        # domain name used in logs and metrics when several models run at once
+        self.name = name
+        self.supervisor = None
+        if processing_units is None:
+            processing_units = [self.settings.pu]
+        self.run_command = [self.settings.tuflow_executable, "-b", "-x"]
+        self.run_command += ["-pu{}".format(unit) for unit in processing_units]
+        for number, scenario in enumerate(
+            getattr(self.settings, "tuflow_scenarios", []), start=1
+        ):
+            self.run_command += ["-s{}".format(number), scenario.strip()]
+        for number, event in enumerate(
+            getattr(self.settings, "tuflow_events", []), start=1
+        ):
+            self.run_command += ["-e{}".format(number), event.strip()]
+        # TUFLOW runs a generated copy of the tcf, see write_run_control_file
+        self.run_command.append(str(run_control_file(self.settings.tcf_file)))
+        # generated files the copy reads after the model's tcf
+        self.generated_files = []
 
+    @traced
     def run(self):
         try:
             if self.settings.manage_states:
                 self.prepare_state()
-            logger.info("starting TUFLOW simulation")
-            if isinstance(self.run_command, list):
-                cmd = " ".join(self.run_command)
-            process = subprocess.Popen(
-                cmd
-            )  # , stdout=subprocess.PIPE, stderr=subprocess.STDOUT, shell=True
-            # )
-            output, error = process.communicate()
-            returncode = process.poll()
-            logger.info(output)
-            if returncode != 0:
-                raise ValueError("Executable terminated, see log file")
+            if getattr(self.settings, "map_output_override", False):
+                override = write_map_output_override(self.settings)
+                if override is not None:
+                    self.generated_files.append(override)
+            else:
+                # left by an earlier cycle with the switch on
+                remove_map_output_override(self.settings)
+            run_tcf = self.write_run_control_file()
+            if self.generated_files:
+                # so the model index (and the result cache) sees the overrides
+                self.settings.read_tcf_parameters(run_tcf)
+            if getattr(self.settings, "preflight_check", True):
+                PreflightCheck(self.settings).run()
+            segmented = hasattr(self.settings, "segment_hours")
+            cache = None
+            if hasattr(self.settings, "result_cache_folder") and not segmented:
+                cache = ResultCache(
+                    self.settings.result_cache_folder,
+                    getattr(
+                        self.settings, "result_cache_entries", DEFAULT_CACHE_ENTRIES
+                    ),
+                )
+                key = cache.key(simulation_inputs(self.settings), self.run_command)
+            if segmented:
+                self.run_segments()
+            elif cache is not None and cache.restore(key, self.result_folders()):
+                logger.info(
+                    "Inputs identical to cached run %s, restored its results "
+                    "instead of running TUFLOW",
+                    key[:12],
+                )
+                metrics.increment("result_cache", result="hit")
+                detach_links(self.result_folders())
+            else:
+                if cache is not None:
+                    metrics.increment("result_cache", result="miss")
+                    release_links(self.result_folders())
+                self.run_tuflow()
+                if cache is not None:
+                    cache.store(key, self.result_folders())
+                    detach_links(self.result_folders())
             if self.settings.manage_states:
                 if hasattr(self.settings, "export_states_folder"):
                     self.save_state()
             logger.info("Tuflow simulation finished")
-        except (ValueError, IndexError):
-            exit("Executable terminated, see log file")
+        except (ValueError, IndexError) as e:
+            # raised rather than exit(), a service or worker outlives the run
+            raise TuflowSimulationException(
+                "Executable terminated, see log file ({})".format(e)
+            ) from e
 
-    def prepare_state(self):
-        search_dir = self.settings.initial_states_folder.stem
-        states = list(filter(os.path.isfile, glob.glob(search_dir + "/warm_*.trf")))
-        states.sort(key=lambda x: os.path.getmtime(x))
-        valid_states = []
-        if states:
-            for state in states:
-                if (
-                    os.stat(state).st_mtime
-                    < (
-                        datetime.now()
-                        - timedelta(self.settings.states_expiry_time_days)
-                    ).timestamp()
-                ):
-                    os.remove(state)
-                else:
-                    valid_states.append(state)
-            logger.info("Using state: %s", valid_states[-1])
-            shutil.copyfile(valid_states[-1], self.settings.restart_file)
-        else:
-            shutil.copyfile(
-                self.settings.initial_states_folder / "cold_state.trf",
-                self.settings.restart_file,
+    def run_tuflow(self, start_time=None, end_time=None):
+        logger.info("starting TUFLOW simulation")
+        self.supervisor = TuflowSupervisor(
+            self.run_command,
+            self.settings.tuflow_start_time if start_time is None else start_time,
+            self.settings.tuflow_end_time if end_time is None else end_time,
+            self.tuflow_log_files(),
+            name=self.name,
+            max_wall_seconds=(
+                self.settings.tuflow_timeout_minutes * 60
+                if hasattr(self.settings, "tuflow_timeout_minutes")
+                else None
+            ),
+            max_rss_bytes=(
+                self.settings.tuflow_memory_limit_mb * 1024**2
+                if hasattr(self.settings, "tuflow_memory_limit_mb")
+                else None
+            ),
+            sample_seconds=getattr(
+                self.settings, "resource_sample_seconds", DEFAULT_SAMPLE_SECONDS
+            ),
+        )
+        for simulated_time, callback in self.milestones:
+            self.supervisor.add_milestone(simulated_time, callback)
+        start = time.perf_counter()
+        with tracing.span("TUFLOW", "subprocess"):
+            returncode = self.supervisor.run()
+        metrics.set_gauge(
+            "tuflow_runtime_seconds",
+            time.perf_counter() - start,
+            **self.supervisor.metric_labels
+        )
+        if self.supervisor.watchdog.kill_reason is not None:
+            raise ValueError(
+                "TUFLOW stopped by the watchdog: "
+                + self.supervisor.watchdog.kill_reason
             )
+        if returncode != 0:
+            raise ValueError("TUFLOW returned {}".format(returncode))
 
-        states = list(filter(os.path.isfile, glob.glob(search_dir + "/warm_*.erf")))
-        states.sort(key=lambda x: os.path.getmtime(x))
-        valid_states = []
-        if states:
-            for state in states:
-                if (
-                    os.stat(state).st_mtime
-                    < (
-                        datetime.now()
-                        - timedelta(self.settings.states_expiry_time_days)
-                    ).timestamp()
-                ):
-                    os.remove(state)
-                else:
-                    valid_states.append(state)
-            logger.info("Using state: %s", valid_states[-1])
-            shutil.copyfile(
-                valid_states[-1],
-                str(self.settings.restart_file).replace(".trf", ".erf"),
-            )
-        else:
-            shutil.copyfile(
-                self.settings.initial_states_folder / "cold_state.erf",
-                str(self.settings.restart_file).replace(".trf", ".erf"),
-            )
+    @traced
+    def run_segments(self):
+        """Run the simulation window in segments chained by restart files.
 
-    def save_state(self):
-        tcf_file = str(self.settings.tcf_file)
-        trf_input_file = tcf_file.replace(".tcf", ".trf")
-        trf_result_file = Path(
-            os.path.join(self.settings.output_folder, trf_input_file)
+        Every segment continues from the restart file written at the end of
+        the previous one and ``on_segment`` is called when it finishes, so
+        its map output can be processed while the next segment runs. The
+        warm state written at the configured restart time and the point
+        output of all segments end up where a single run would put them.
+        """
+        tcf_file = Path(self.settings.tcf_file)
+        model_index = getattr(self.settings, "model_index", None)
+        checkpoint = getattr(model_index, "write_restart_time", None)
+        windows = segment_windows(
+            self.settings.tuflow_start_time,
+            self.settings.tuflow_end_time,
+            self.settings.segment_hours,
+            [checkpoint] if checkpoint is not None else [],
         )
+        state_files = self.result_state_files()
+        po_csv = self.output_folder() / (self.simulation_name() + PO_CSV_SUFFIX)
+        po_csvs = []
+        checkpoint_files = {}
+        restart_file = None
+        try:
+            for number, (start_time, end_time) in enumerate(windows, start=1):
+                logger.info(
+                    "running segment %s of %s: %g - %g h",
+                    number,
+                    len(windows),
+                    start_time,
+                    end_time,
+                )
+                self.write_run_control_file(
+                    write_segment_override(
+                        tcf_file, start_time, end_time, restart_file
+                    )
+                )
+                with tracing.span("segment {}".format(number), "segment"):
+                    self.run_tuflow(start_time, end_time)
 
-        if trf_result_file.exists():
-            shutil.copyfile(
-                trf_result_file,
-                self.settings.export_states_folder
-                / "warm_state_{}.trf".format(datetime.now().strftime("%Y%m%d%H")),
-            )
+                segment_files = {
+                    suffix: segment_output_file(path, number)
+                    for suffix, path in state_files.items()
+                    if path.exists()
+                }
+                if ".trf" not in segment_files:
+                    raise MissingFileException(
+                        "Segment {} wrote no restart file {}".format(
+                            number, state_files[".trf"]
+                        )
+                    )
+                for suffix, segment_state in segment_files.items():
+                    # moved, so the next segment writes a new restart file
+                    os.replace(state_files[suffix], segment_state)
+                restart_file = segment_files[".trf"]
+                if end_time == checkpoint:
+                    checkpoint_files = segment_files
+                if po_csv.exists():
+                    po_csvs.append(segment_output_file(po_csv, number))
+                    os.replace(po_csv, po_csvs[-1])
+                if self.on_segment is not None:
+                    self.on_segment(end_time)
+        finally:
+            remove_segment_override(tcf_file)
+            self.write_run_control_file()
+
+        merge_po_csvs(po_csvs, po_csv)
+        # leave the state of the configured restart time as the run result
+        final_files = checkpoint_files or segment_files
+        for suffix, path in state_files.items():
+            if suffix in final_files:
+                clone_file(final_files[suffix], path)
+
+    def write_run_control_file(self, *generated_files):
+        """Write the copy of the tcf TUFLOW runs, the model's tcf is untouched.
+
+        The copy reads the model's tcf, the generated files of this run and
+        then ``generated_files``. It writes to the output and log folder of
+        the model's tcf, which TUFLOW would otherwise resolve against the
+        folder of the copy.
+        """
+        model_index = getattr(self.settings, "model_index", None)
+        commands = [
+            ("Output Folder", self.output_folder()),
+            ("Log Folder", self.tuflow_log_files()[0].parent),
+        ]
+        if model_index is not None and model_index.check_folder:
+            commands.append(("Write Check Files", model_index.check_folder))
+        if model_index is not None and model_index.restart_file:
+            commands.append(("Read Restart File", model_index.restart_file))
+        return write_run_control_file(
+            self.settings.tcf_file,
+            commands,
+            self.generated_files + list(generated_files),
+        )
+
+    def output_folder(self):
+        """Return the folder TUFLOW writes its results to."""
+        model_index = getattr(self.settings, "model_index", None)
+        if model_index is not None and model_index.output_folder is not None:
+            return Path(model_index.output_folder)
+        return Path(self.settings.output_folder)
+
+    def result_folders(self):
+        """Return the folders TUFLOW writes results and logs to."""
+        folders = [self.output_folder(), self.tuflow_log_files()[0].parent]
+        if hasattr(self.settings, "raster_output_folder"):
+            folders.append(self.settings.raster_output_folder)
+        unique = []
+        for folder in sorted({os.path.abspath(folder) for folder in folders}):
+            if not any(folder.startswith(u + os.sep) for u in unique):
+                unique.append(folder)
+        return [Path(folder) for folder in unique]
+
+    def simulation_name(self):
+        """Return the name TUFLOW gives this run's results and logs."""
+        name = Path(self.settings.tcf_file).stem
+        for prefix, values in (
+            ("s", getattr(self.settings, "tuflow_scenarios", [])),
+            ("e", getattr(self.settings, "tuflow_events", [])),
+        ):
+            for number, value in enumerate(values, start=1):
+                name = name.replace("~{}{}~".format(prefix, number), value.strip())
+        return name
+
+    def tuflow_log_files(self):
+        """Return the .hpc.tlf and .tlf log files TUFLOW writes for this run."""
+        tcf_file = Path(self.settings.tcf_file)
+        model_index = getattr(self.settings, "model_index", None)
+        if model_index is not None and model_index.log_folder:
+            log_folder = Path(model_index.log_folder)
         else:
-            raise MissingFileException("Source trf file %s not found", trf_result_file)
+            log_folder = tcf_file.parent / "log"
+        name = self.simulation_name()
+        return [log_folder / (name + ".hpc.tlf"), log_folder / (name + ".tlf")]
 
-        erf_input_file = tcf_file.replace(".tcf", ".erf")
-        erf_result_file = Path(
-            os.path.join(self.settings.output_folder, erf_input_file)
+    def state_catalogue(self, folder):
+        return StateCatalogue(
+            folder,
+            self.settings.states_expiry_time_days,
+            getattr(self.settings, "states_keep_count", None),
         )
 
-        if erf_result_file.exists():
-            shutil.copyfile(
-                erf_result_file,
-                self.settings.export_states_folder
-                / "warm_state_{}.erf".format(datetime.now().strftime("%Y%m%d%H")),
+    def result_state_files(self):
+        tcf_file = str(self.settings.tcf_file)
+        return {
+            suffix: Path(
+                os.path.join(
+                    self.settings.output_folder, tcf_file.replace(".tcf", suffix)
+                )
             )
+            for suffix in STATE_SUFFIXES
+        }
+
+    @traced
+    def prepare_state(self):
+        catalogue = self.state_catalogue(self.settings.initial_states_folder)
+        state = catalogue.latest()
+        if state is not None:
+            logger.info("Using state: %s", state["name"])
         else:
+            logger.info("No valid warm state found, using the cold state")
+
+        restart_file = str(self.settings.restart_file)
+        for suffix in STATE_SUFFIXES:
+            source = catalogue.path(state, suffix) if state is not None else None
+            if source is None:
+                source = self.settings.initial_states_folder / ("cold_state" + suffix)
+            if suffix == ".erf" and not source.exists():
+                logger.info("No erf file found")
+                continue
+            clone_file(source, restart_file.replace(".trf", suffix))
+
+        # Saved states can share their data with the previous results, make
+        # TUFLOW write new files instead of overwriting them
+        for result_file in self.result_state_files().values():
+            if result_file.exists():
+                result_file.unlink()
+
+    @traced
+    def save_state(self):
+        result_files = self.result_state_files()
+        if not result_files[".trf"].exists():
+            raise MissingFileException(
+                "Source trf file %s not found", result_files[".trf"]
+            )
+        if not result_files[".erf"].exists():
             logger.info("No erf file found")
+            del result_files[".erf"]
+
+        self.state_catalogue(self.settings.export_states_folder).add(
+            "warm_state_{}".format(datetime.now().strftime("%Y%m%d%H")), result_files
+        )
@@ -0,0 +1,92 @@
+from pathlib import Path
+from tuflowflash.control_files import generated_file
+from tuflowflash.control_files import write_if_changed
+
+import logging
+import os
+import pandas as pd
+
+
+logger = logging.getLogger(__name__)
+
+SEGMENT_SUFFIX = "_segment.trd"
+# TUFLOW point output timeseries, uploaded by ProcessFlash.post_timeseries
+PO_CSV_SUFFIX = "_PO.csv"
+# time column of the PO csv
+PO_TIME_COLUMN = "Location"
+
+
+def segment_windows(start_time, end_time, segment_hours, checkpoints=()):
+    """Return the (start, end) hours of the segments of a simulation window.
+
+    Segments are ``segment_hours`` long; ``checkpoints`` inside the window,
+    such as the time a warm state is written, also end a segment.
+    """
+    if segment_hours <= 0:
+        raise ValueError("segment_hours should be positive")
+    boundaries = {float(end_time)}
+    boundary = float(start_time) + segment_hours
+    while boundary < end_time:
+        boundaries.add(boundary)
+        boundary += segment_hours
+    boundaries.update(
+        float(time) for time in checkpoints if start_time < float(time) < end_time
+    )
+    boundaries = sorted(boundaries)
+    return list(zip([float(start_time)] + boundaries[:-1], boundaries))
+
+
+def segment_file(tcf_file):
+    return generated_file(tcf_file, SEGMENT_SUFFIX)
+
+
+def write_segment_override(tcf_file, start_time, end_time, restart_file=None):
+    """Write the override that runs one segment, continuing from ``restart_file``.
+
+    The generated tcf TUFLOW runs should read it after the model's tcf.
+    """
+    override = segment_file(tcf_file)
+    lines = [
+        "Start Time == {:g}".format(start_time),
+        "End Time == {:g}".format(end_time),
+        "Write Restart File at Time == {:g}".format(end_time),
+    ]
+    if restart_file is not None:
+        lines.append(
+            "Read Restart File == {}".format(
+                os.path.relpath(restart_file, override.parent)
+            )
+        )
+    override.parent.mkdir(exist_ok=True)
+    write_if_changed(override, lines)
+    return override
+
+
+def remove_segment_override(tcf_file):
+    override = segment_file(tcf_file)
+    if override.exists():
+        override.unlink()
+
+
+def segment_output_file(path, number):
+    """Return where the output of one segment is kept: ``name_segment_01.ext``."""
+    path = Path(path)
+    return path.with_name("{}_segment_{:02d}{}".format(path.stem, number, path.suffix))
+
+
+def merge_po_csvs(segment_files, po_csv):
+    """Write the PO timeseries of all segments to one csv, in time order.
+
+    The row below the header (the point output names) is taken from the first
+    segment; a time written by two segments is kept from the later one.
+    """
+    frames = [pd.read_csv(f, dtype=str) for f in segment_files if f.exists()]
+    if not frames:
+        return
+    rows = pd.concat([frame.iloc[1:] for frame in frames], ignore_index=True)
+    rows = rows.drop_duplicates(PO_TIME_COLUMN, keep="last")
+    rows = rows.sort_values(PO_TIME_COLUMN, key=lambda times: times.astype(float))
+    pd.concat([frames[0].iloc[:1], rows]).to_csv(po_csv, index=False)
+    for segment in segment_files:
+        if segment.exists():
+            segment.unlink()
@@ -0,0 +1,153 @@
+from pathlib import Path
+from tuflowflash import metrics
+from tuflowflash import read_settings
+from tuflowflash import resources
+
+import datetime
+import logging
+import os
+import time
+
+
+logger = logging.getLogger(__name__)
+
+SERVICE_POLL_SECONDS = 60
+STATIC_LAYER_SETTINGS = (
+    "forecast_clipshape",
+    "assets_file",
+    "buildings_file",
+    "roads_file",
+)
+
+
+class FlashService:
+    """Run forecast cycles from one resident process.
+
+    Imports, settings, HTTP/FTP connections and static GIS layers stay warm
+    between cycles. A cycle starts every ``interval_minutes`` and, with
+    ``watch_bom``, as soon as a new BoM nowcast file is published.
+    """
+
+    def __init__(
+        self,
+        settings_file,
+        interval_minutes=60,
+        watch_bom=False,
+        rainfall_mp_factor=1,
+        verbose=False,
+        poll_seconds=SERVICE_POLL_SECONDS,
+        profile_stages=None,
+        profile_folder="profiles",
+    ):
+        self.settings_file = Path(settings_file)
+        self.interval = datetime.timedelta(minutes=interval_minutes)
+        self.watch_bom = watch_bom
+        self.rainfall_mp_factor = rainfall_mp_factor
+        self.verbose = verbose
+        self.poll_seconds = poll_seconds
+        self.profile_stages = profile_stages
+        self.profile_folder = profile_folder
+        self.settings = None
+        self.settings_mtime = None
+        self.last_nowcast_file = None
+        self.next_cycle = datetime.datetime.now()
+
+    def load_settings(self):
+        """Re-read the settings only when the settings file changed."""
+        mtime = os.stat(self.settings_file).st_mtime_ns
+        if self.settings is None or mtime != self.settings_mtime:
+            logger.info("reading settings from %s", self.settings_file)
+            self.settings = read_settings.FlashSettings(self.settings_file)
+            self.settings_mtime = mtime
+            self.prewarm()
+        else:
+            # cheap when the control files did not change (cached model index)
+            self.settings.read_tcf_parameters(self.settings.tcf_file)
+            self.settings.set_reference_time()
+        return self.settings
+
+    def prewarm(self):
+        # Imported here as well, the first cycle should not pay for it
+        from tuflowflash import start_sim
+
+        start_sim.build_stages(self.settings, self.rainfall_mp_factor)
+        for name in STATIC_LAYER_SETTINGS:
+            path = getattr(self.settings, name, None)
+            if path is not None and Path(path).exists():
+                resources.read_vector(path)
+
+    def new_bom_data(self):
+        from tuflowflash import prepare_data
+
+        data_prepper = prepare_data.prepareData(self.settings)
+        try:
+            with data_prepper.bom_ftp_connection() as ftp_server:
+                latest = data_prepper.get_latest_nowcast_filename(
+                    ftp_server, self.settings.bom_nowcast_file
+                )
+        except Exception as e:
+            logger.warning("Could not check for new BoM data: %s", e)
+            return False
+        is_new = self.last_nowcast_file is not None and latest != self.last_nowcast_file
+        self.last_nowcast_file = latest
+        return is_new
+
+    def should_run(self):
+        if datetime.datetime.now() >= self.next_cycle:
+            return True
+        if self.watch_bom and self.new_bom_data():
+            logger.info("new BoM nowcast %s available", self.last_nowcast_file)
+            return True
+        return False
+
+    def run_cycle(self):
+        from tuflowflash import start_sim
+
+        start = time.perf_counter()
+        try:
+            settings = self.load_settings()
+        except Exception as e:
+            logger.error("Could not read settings, skipping cycle: %s", e)
+            return
+        logger.info("starting forecast cycle for %s", settings.reference_time)
+        try:
+            cycle = start_sim.run_cycle(
+                settings,
+                self.rainfall_mp_factor,
+                self.profile_stages,
+                self.profile_folder,
+            )
+        except (Exception, SystemExit) as e:
+            # a failed cycle must not stop the service
+            start_sim.report_error(settings, e, self.verbose)
+            return
+        self.report(cycle, time.perf_counter() - start)
+
+    def report(self, cycle, cycle_time):
+        tuflow_time = cycle.durations.get("simulation", 0.0)
+        for name, duration in cycle.durations.items():
+            logger.debug("stage %s took %.1f s", name, duration)
+        logger.info(
+            "forecast cycle finished in %.1f s: TUFLOW %.1f s, overhead %.1f s",
+            cycle_time,
+            tuflow_time,
+            cycle_time - tuflow_time,
+        )
+        peak_rss = metrics.value("tuflow_peak_rss_bytes")
+        if "simulation" in cycle.durations and peak_rss is not None:
+            logger.info(
+                "TUFLOW used %.0f CPU s, peak RSS %.0f MB",
+                metrics.value("tuflow_cpu_seconds"),
+                peak_rss / 1e6,
+            )
+
+    def run_forever(self):
+        logger.info("starting tuflow-flash service")
+        if self.watch_bom:
+            self.load_settings()
+            self.new_bom_data()
+        while True:
+            if self.should_run():
+                self.next_cycle = datetime.datetime.now() + self.interval
+                self.run_cycle()
+            time.sleep(self.poll_seconds)
@@ -1,16 +1,17 @@
 from email.message import EmailMessage
 from pathlib import Path
-from tuflowflash import post_processing
-from tuflowflash import prepare_data
+from tuflowflash import metrics
+from tuflowflash import pipeline
+from tuflowflash import preflight
 from tuflowflash import read_settings
-from tuflowflash import run_tuflow
-import subprocess
+from tuflowflash import tracing
 
 import argparse
 import glob
 import logging
 import os
 import smtplib
+import time
 
 
 logger = logging.getLogger(__name__)
@@ -18,7 +19,12 @@ logger = logging.getLogger(__name__)
 OWN_EXCEPTIONS = (
     read_settings.MissingFileException,
     read_settings.MissingSettingException,
+    pipeline.PipelineException,
+    preflight.PreflightException,
 )
+# netCDF4, xarray and the GDAL netCDF driver are not thread safe, the stages
+# using them declare this resource so they run one at a time
+NETCDF = "netcdf"
 
 
 def send_email(
@@ -48,6 +54,346 @@ def get_latest_raingrid(folder):
         return -9999
 
 
+def report_error(settings, error, verbose=False):
+    send_email(
+        settings.email_subject,
+        settings.email_text_file,
+        settings.email_adress,
+        settings.email_password,
+        settings.email_attendees,
+        error,
+    )
+    if verbose:
+        logger.exception(error)
+    else:
+        logger.error("↓↓↓↓↓   Pass --verbose to get more information   ↓↓↓↓↓")
+        logger.error(error)
+
+
+def run_cycle(
+    settings, rainfall_mp_factor=1, profile_stages=None, profile_folder="profiles"
+):
+    """Run one forecast cycle and return the finished pipeline.
+
+    With a ``trace_folder`` a timing/memory trace of the cycle is written.
+    ``profile_stages`` (a list of stage names, empty for all stages) turns on
+    cProfile output in ``profile_folder/<reference time>``.
+    """
+    cycle_id = settings.reference_time.strftime("%Y%m%dT%H%M")
+    profiler = None
+    if profile_stages is not None:
+        from tuflowflash import profiling
+
+        profiler = profiling.StageProfiler(
+            Path(profile_folder) / cycle_id, profile_stages
+        )
+    if hasattr(settings, "metrics_port"):
+        metrics.start_http_server(
+            settings.metrics_port,
+            getattr(settings, "metrics_address", metrics.DEFAULT_METRICS_ADDRESS),
+        )
+    trace_folder = getattr(settings, "trace_folder", None)
+    if trace_folder is not None:
+        tracing.start_trace(cycle_id, getattr(settings, "trace_memory", True))
+    start = time.perf_counter()
+    cycle = None
+    success = False
+    try:
+        with tracing.span("cycle", "cycle"):
+            cycle = pipeline.Pipeline(
+                build_stages(settings, rainfall_mp_factor),
+                getattr(
+                    settings, "pipeline_workers", pipeline.DEFAULT_PIPELINE_WORKERS
+                ),
+                profiler,
+            )
+            cycle.run()
+        success = True
+    finally:
+        if trace_folder is not None:
+            tracing.stop_trace().write(trace_folder)
+        metrics.record_cycle(
+            cycle.durations if cycle is not None else {},
+            time.perf_counter() - start,
+            success,
+        )
+        if hasattr(settings, "metrics_file"):
+            metrics.write_textfile(settings.metrics_file)
+    return cycle
+
+
+def build_stages(settings, rainfall_mp_factor=1):
+    """Return the stages of a forecast cycle with the data they exchange."""
+    # Stage modules are imported here so --help and settings errors stay fast
+    from tuflowflash import post_processing
+    from tuflowflash import prepare_data
+    from tuflowflash import run_tuflow
+
+    data_prepper = prepare_data.prepareData(settings)
+    post_processer = post_processing.ProcessFlash(settings)
+    convert_bom = (
+        settings.get_bom_forecast
+        or settings.get_bom_nowcast
+        or settings.use_bom_historical
+    )
+
+    ensemble_mode = hasattr(settings, "ensemble_members")
+    if ensemble_mode and not settings.get_bom_nowcast:
+        raise read_settings.MissingSettingException(
+            "ensemble_members needs get_bom_nowcast in {}.".format(
+                settings.settingsFile
+            )
+        )
+
+    def export_member_rain_grids(prepper):
+        rain_settings = prepper.settings
+        os.makedirs(rain_settings.rain_grids_folder, exist_ok=True)
+        for f in glob.glob(str(rain_settings.rain_grids_folder) + "/*.asc"):
+            os.remove(f)
+        if settings.use_bom_historical:
+            prepper.select_hindcast_netcdf_files()
+        if settings.get_bom_nowcast:
+            previous_time = get_latest_raingrid(rain_settings.rain_grids_folder)
+            prepper.forecast_nowcast_netcdf_to_ascii(
+                rain_settings.netcdf_nowcast_rainfall_file,
+                previous_time,
+                rainfall_mp_factor,
+            )
+        if settings.get_bom_forecast:
+            previous_time = get_latest_raingrid(rain_settings.rain_grids_folder) + 1.5
+            prepper.forecast_nowcast_netcdf_to_ascii(
+                rain_settings.netcdf_forecast_rainfall_file,
+                previous_time,
+                rainfall_mp_factor,
+            )
+        prepper.write_ascii_csv()
+
+    def export_rain_grids():
+        if not ensemble_mode:
+            export_member_rain_grids(data_prepper)
+            return
+        from tuflowflash import ensemble
+
+        for member in ensemble.read_selection(settings):
+            export_member_rain_grids(
+                prepare_data.prepareData(
+                    ensemble.member_rain_settings(settings, member)
+                )
+            )
+
+    # segmented runs upload the map output of every segment when it finishes
+    overlap_post_processing = (
+        getattr(settings, "overlap_post_processing", False)
+        or hasattr(settings, "segment_hours")
+    ) and settings.post_to_lizard
+
+    multi_domain = hasattr(settings, "tuflow_domains")
+    # set by the simulation stage when the watcher uploaded the map output
+    watched_runs = []
+
+    # finalised rasters per domain tcf, uploaded together by the upload stage
+    domain_manifests = {}
+
+    def post_process_domain(domain_settings):
+        domain_post_processer = post_processing.ProcessFlash(domain_settings)
+        manifest = domain_post_processer.finalise_rasters()
+        if hasattr(settings, "waterlevel_result_uuid_file"):
+            domain_post_processer.post_timeseries()
+        domain_manifests[str(domain_settings.tcf_file)] = manifest
+
+    def run_simulation():
+        if ensemble_mode:
+            from tuflowflash import ensemble
+
+            ensemble.run_ensemble(settings)
+            return
+        if multi_domain:
+            from tuflowflash.domain_scheduler import DomainScheduler
+            from tuflowflash.domain_scheduler import domains_from_settings
+            from tuflowflash.job_queue import job_queue_from_settings
+
+            DomainScheduler(
+                domains_from_settings(settings),
+                getattr(settings, "processing_units", [settings.pu]),
+                post_process=post_process_domain if settings.post_to_lizard else None,
+                job_queue=job_queue_from_settings(settings),
+            ).run()
+            return
+        if not overlap_post_processing:
+            run_tuflow.TuflowSimulation(settings).run()
+            return
+        from tuflowflash.output_watcher import OutputWatcher
+
+        watcher = OutputWatcher(settings, post_processer)
+        simulation = run_tuflow.TuflowSimulation(
+            settings, watcher.milestones(), on_segment=watcher.segment_finished
+        )
+        with watcher:
+            simulation.run()
+        watched_runs.append(simulation)
+
+    def upload_results():
+        if ensemble_mode:
+            from tuflowflash import ensemble
+
+            # the first member stands in for the deterministic forecast
+            first_member = next(iter(ensemble.read_selection(settings)))
+            post_processing.ProcessFlash(
+                ensemble.member_settings(settings, first_member)
+            ).process_tuflow()
+        elif multi_domain:
+            from tuflowflash.domain_scheduler import domains_from_settings
+
+            manifest = []
+            for domain in domains_from_settings(settings):
+                if str(domain.settings.tcf_file) not in domain_manifests:
+                    # not simulated in this cycle
+                    post_process_domain(domain.settings)
+                manifest += domain_manifests[str(domain.settings.tcf_file)]
+            # one upload, clearing a raster per domain would remove the
+            # rasters of the domains uploaded before
+            post_processer.upload_manifest(manifest)
+        elif not watched_runs:
+            post_processer.process_tuflow()
+        elif hasattr(settings, "waterlevel_result_uuid_file"):
+            # the rasters were uploaded while TUFLOW was running
+            post_processer.post_timeseries()
+
+    def simulation_settings():
+        """Return (domain name, settings) of every TUFLOW run of the cycle."""
+        if ensemble_mode:
+            from tuflowflash import ensemble
+
+            return [
+                (member, ensemble.member_settings(settings, member))
+                for member in ensemble.read_selection(settings)
+            ]
+        if multi_domain:
+            from tuflowflash.domain_scheduler import domains_from_settings
+
+            return [
+                (domain.name, domain.settings)
+                for domain in domains_from_settings(settings)
+            ]
+        return [(None, settings)]
+
+    cycle_started = time.time()
+
+    def record_telemetry():
+        from tuflowflash import telemetry
+
+        store = telemetry.TelemetryStore(settings.telemetry_folder)
+        for domain, run_settings in simulation_settings():
+            telemetry.record_run(
+                store, run_settings, since=cycle_started, domain=domain
+            )
+
+    def clear_in_output():
+        logger.info("clearing in/output from simulation")
+        post_processer.clear_in_output()
+
+    predict_tide = getattr(settings, "predict_tide", False)
+    return [
+        pipeline.Stage(
+            "historical_gauges",
+            data_prepper.get_historical_precipitation,
+            enabled=settings.get_historical_precipitation,
+            outputs=["gauge_rainfall"],
+            skip_message="not gathering historical rainfall, skipping..",
+        ),
+        pipeline.Stage(
+            "forecast",
+            data_prepper.get_precipitation_forecast,
+            enabled=settings.get_bom_forecast,
+            outputs=["forecast_netcdf"],
+            skip_message="not gathering bom forecast rainfall data, skipping..",
+            resources=[NETCDF],
+        ),
+        pipeline.Stage(
+            "nowcast",
+            data_prepper.get_precipitation_nowcast,
+            enabled=settings.get_bom_nowcast,
+            outputs=["nowcast_netcdf"],
+            skip_message="not gathering bom nowcast rainfall data, skipping..",
+            resources=[NETCDF],
+        ),
+        pipeline.Stage(
+            "rain_grids",
+            export_rain_grids,
+            enabled=convert_bom,
+            inputs=["forecast_netcdf", "nowcast_netcdf"],
+            outputs=["rain_grids"],
+            skip_message="not converting bom products to ascii, skipping..",
+            resources=[NETCDF],
+        ),
+        pipeline.Stage(
+            "boundaries",
+            (
+                data_prepper.predict_tide_boundaries
+                if predict_tide
+                else data_prepper.convert_csv_file_to_bc_file
+            ),
+            enabled=predict_tide or settings.convert_csv_to_bc,
+            outputs=["boundaries"],
+            skip_message="not converting csv to boundary conditions, skipping..",
+        ),
+        pipeline.Stage(
+            "soil_moisture",
+            data_prepper.get_soil_moisture,
+            enabled=settings.use_soil_moisture,
+            outputs=["soil_moisture"],
+            skip_message="not gathering bom soil moisture, skipping..",
+            resources=[NETCDF],
+        ),
+        pipeline.Stage(
+            "simulation",
+            run_simulation,
+            enabled=settings.run_simulation,
+            inputs=["gauge_rainfall", "rain_grids", "boundaries", "soil_moisture"],
+            outputs=["results"],
+            skip_message="Not running Tuflow simulation, skipping..",
+        ),
+        pipeline.Stage(
+            "telemetry",
+            record_telemetry,
+            enabled=settings.run_simulation and hasattr(settings, "telemetry_folder"),
+            inputs=["results"],
+            outputs=["telemetry"],
+        ),
+        pipeline.Stage(
+            "historic_forecasts",
+            post_processer.track_historic_forecasts_in_lizard,
+            enabled=settings.track_historic_forecasts,
+            inputs=["results"],
+            outputs=["historic_forecasts"],
+            resources=[NETCDF],
+        ),
+        pipeline.Stage(
+            "upload",
+            upload_results,
+            enabled=settings.post_to_lizard,
+            inputs=["results", "historic_forecasts"],
+            outputs=["uploads"],
+            skip_message="Not uploading files to Lizard, skipping..",
+        ),
+        pipeline.Stage(
+            "archive",
+            post_processer.archive_simulation,
+            enabled=settings.archive_simulation,
+            inputs=["uploads", "telemetry"],
+            outputs=["archive"],
+            skip_message="Not archiving files, skipping..",
+        ),
+        pipeline.Stage(
+            "clear",
+            clear_in_output,
+            enabled=settings.clear_input_output,
+            inputs=["archive", "telemetry"],
+            skip_message="not clearing in/output, skipping..",
+        ),
+    ]
+
+
 def get_parser():
     """Return argument parser."""
     parser = argparse.ArgumentParser(description=__doc__)
@@ -77,6 +423,63 @@ def get_parser():
         default=False,
         help="Verbose output",
     )
+
+    parser.add_argument(
+        "--service",
+        action="store_true",
+        dest="service",
+        default=False,
+        help="Stay resident and run a forecast cycle on a schedule",
+    )
+
+    parser.add_argument(
+        "--interval",
+        dest="interval",
+        type=int,
+        default=60,
+        help="Minutes between scheduled cycles in service mode",
+    )
+
+    parser.add_argument(
+        "--watch-bom",
+        action="store_true",
+        dest="watch_bom",
+        default=False,
+        help="In service mode also start a cycle when a new BoM nowcast arrives",
+    )
+
+    parser.add_argument(
+        "--worker",
+        action="store_true",
+        dest="worker",
+        default=False,
+        help="Run simulation and impact jobs from the job_queue_folder",
+    )
+
+    parser.add_argument(
+        "--worker-idle-minutes",
+        dest="worker_idle_minutes",
+        type=float,
+        default=None,
+        help="Stop the worker when no job arrived for this many minutes",
+    )
+
+    parser.add_argument(
+        "--profile",
+        dest="profile",
+        nargs="?",
+        const="",
+        default=None,
+        metavar="STAGES",
+        help="Profile the stages (comma separated stage names, default all)",
+    )
+
+    parser.add_argument(
+        "--profile-folder",
+        dest="profile_folder",
+        default="profiles",
+        help="Folder for the pstats and speedscope files of --profile",
+    )
     return parser
 
 
@@ -92,113 +495,48 @@ def main(rainfall_mp_factor=1, settings=None):
     logging.basicConfig(
         level=log_level, format="%(asctime)s %(levelname)s: %(message)s"
     )
+    profile_stages = None
+    if options.profile is not None:
+        profile_stages = [s.strip() for s in options.profile.split(",") if s.strip()]
+
+    if options.service:
+        from tuflowflash.service import FlashService
+
+        return FlashService(
+            options.settings_file,
+            interval_minutes=options.interval,
+            watch_bom=options.watch_bom,
+            rainfall_mp_factor=rainfall_mp_factor,
+            verbose=options.verbose,
+            profile_stages=profile_stages,
+            profile_folder=options.profile_folder,
+        ).run_forever()
+
     if settings is None:
         settings = read_settings.FlashSettings(
             options.settings_file, options.reference_time
         )
 
-    try:
-        # Historical precipitation
-        data_prepper = prepare_data.prepareData(settings)
-        if settings.get_historical_precipitation:
-            data_prepper.get_historical_precipitation()
-        else:
-            logger.info("not gathering historical rainfall, skipping..")
-
-        # Future precipitation
-        if settings.get_bom_forecast:
-            data_prepper.get_precipitation_forecast()
-        else:
-            logger.info("not gathering bom forecast rainfall data, skipping..")
+    if options.worker:
+        from tuflowflash.job_queue import JobQueue
+        from tuflowflash.job_queue import JobWorker
 
-        if settings.get_bom_nowcast:
-            data_prepper.get_precipitation_nowcast()
-        else:
-            logger.info("not gathering bom nowcast rainfall data, skipping..")
-
-        if (
-            settings.get_bom_forecast
-            or settings.get_bom_nowcast
-            or settings.use_bom_historical
-        ):
-            for f in glob.glob(str(settings.rain_grids_folder) + "/*.asc"):
-                os.remove(f)
-            if settings.use_bom_historical:
-                data_prepper.select_hindcast_netcdf_files()
-            if settings.get_bom_nowcast:
-                previous_time = get_latest_raingrid(settings.rain_grids_folder)
-                data_prepper.forecast_nowcast_netcdf_to_ascii(
-                    settings.netcdf_nowcast_rainfall_file,
-                    previous_time,
-                    rainfall_mp_factor,
-                )
-            if settings.get_bom_forecast:
-                previous_time = get_latest_raingrid(settings.rain_grids_folder) + 1.5
-                data_prepper.forecast_nowcast_netcdf_to_ascii(
-                    settings.netcdf_forecast_rainfall_file,
-                    previous_time,
-                    rainfall_mp_factor,
-                )
-            data_prepper.write_ascii_csv()
-        else:
-            logger.info("not converting bom products to ascii, skipping..")
-
-        if settings.convert_csv_to_bc:
-            data_prepper.convert_csv_file_to_bc_file()
-            if settings.custom_residual_tide:
-                subprocess.run(["python", settings.custom_residual_script])
-        else:
-            logger.info("not converting csv to boundary conditions, skipping..")
-
-        # Soil moisture
-        if settings.use_soil_moisture:
-            data_prepper.get_soil_moisture()
-        else:
-            logger.info("not gathering bom soil moisture, skipping..")
-
-
-        # run simulation
-        if settings.run_simulation:
-            tuflow_simulation = run_tuflow.TuflowSimulation(settings)
-            tuflow_simulation.run()
-        else:
-            logger.info("Not running Tuflow simulation, skipping..")
-
-        # uploading to Lizard
-        post_processer = post_processing.ProcessFlash(settings)
-        if settings.track_historic_forecasts:
-            post_processer.track_historic_forecasts_in_lizard()
-
-        if settings.post_to_lizard:
-            post_processer.process_tuflow()
-            # post_processer.upload_bom_precipitation()
-        else:
-            logger.info("Not uploading files to Lizard, skipping..")
-
-        if settings.archive_simulation:
-            post_processer.archive_simulation()
-        else:
-            logger.info("Not archiving files, skipping..")
-
-        if settings.clear_input_output:
-            logger.info("clearing in/output from simulation")
-            post_processer.clear_in_output()
-        else:
-            logger.info("not clearing in/output, skipping..")
+        JobWorker(
+            JobQueue(settings.job_queue_folder),
+            getattr(settings, "processing_units", [settings.pu]),
+        ).run(
+            idle_seconds=(
+                options.worker_idle_minutes * 60
+                if options.worker_idle_minutes is not None
+                else None
+            )
+        )
+        return 0
+
+    try:
+        run_cycle(settings, rainfall_mp_factor, profile_stages, options.profile_folder)
         return 0
 
     except Exception as e:
-        send_email(
-            settings.email_subject,
-            settings.email_text_file,
-            settings.email_adress,
-            settings.email_password,
-            settings.email_attendees,
-            e,
-        )
-        if options.verbose:
-            logger.exception(e)
-        else:
-            logger.error("↓↓↓↓↓   Pass --verbose to get more information   ↓↓↓↓↓")
-            logger.error(e)
+        report_error(settings, e, options.verbose)
         return 1  # Exit code signalling an error.
@@ -0,0 +1,201 @@
+from pathlib import Path
+
+import json
+import logging
+import os
+import re
+import shutil
+import threading
+import time
+
+
+logger = logging.getLogger(__name__)
+
+INDEX_FILE = "states.json"
+INDEX_VERSION = 1
+STATE_SUFFIXES = (".trf", ".erf")
+WARM_STATE_PATTERN = re.compile(r"^(warm_.+)(\.trf|\.erf)$")
+# ioctl to let a file share the extents of another (btrfs, xfs, ...)
+FICLONE = 0x40049409
+
+_index_lock = threading.Lock()
+
+
+def reflink(source, target):
+    import fcntl
+
+    with open(source, "rb") as src, open(target, "wb") as dst:
+        fcntl.ioctl(dst.fileno(), FICLONE, src.fileno())
+
+
+def copy_in_kernel(source, target):
+    with open(source, "rb") as src, open(target, "wb") as dst:
+        remaining = os.fstat(src.fileno()).st_size
+        while remaining > 0:
+            copied = os.copy_file_range(src.fileno(), dst.fileno(), remaining)
+            if copied == 0:
+                break
+            remaining -= copied
+
+
+def clone_file(source, target, hardlink=True):
+    """Make target a copy of source without copying bytes where possible.
+
+    Tries a hard link (unless ``hardlink`` is False), a reflink and
+    copy_file_range before a plain copy and returns the method used. The
+    target is replaced atomically.
+    """
+    target = Path(target)
+    if target.exists() and os.path.samefile(source, target):
+        # renaming onto another link of the same file would be a no-op
+        return "hardlink"
+    temp_file = target.with_name(target.name + ".tmp")
+    if temp_file.exists():
+        temp_file.unlink()
+    for method, function in (
+        ("hardlink", os.link),
+        ("reflink", reflink),
+        ("copy_file_range", copy_in_kernel),
+    ):
+        if method == "hardlink" and not hardlink:
+            continue
+        try:
+            function(source, temp_file)
+            break
+        except (OSError, ImportError, AttributeError):
+            if temp_file.exists():
+                temp_file.unlink()
+    else:
+        method = "copy"
+        shutil.copyfile(source, temp_file)
+    os.replace(temp_file, target)
+    logger.debug("%s %s to %s", method, source, target)
+    return method
+
+
+class StateCatalogue:
+    """Warm states of a states folder, indexed in ``states.json``.
+
+    The index lists the states oldest first, so the latest state is found
+    without scanning the folder. States expire after ``expiry_days`` and
+    only the newest ``keep_count`` states are kept. Pruning deletes the files
+    in a background thread.
+    """
+
+    def __init__(self, folder, expiry_days=None, keep_count=None):
+        self.folder = Path(folder)
+        self.index_file = self.folder / INDEX_FILE
+        self.expiry_days = expiry_days
+        self.keep_count = keep_count
+        self.pruner = None
+
+    def scan(self):
+        """Build the index from the warm state files (index of older versions)."""
+        states = {}
+        for path in self.folder.glob("warm_*"):
+            match = WARM_STATE_PATTERN.match(path.name)
+            if match is None or not path.is_file():
+                continue
+            name, suffix = match.groups()
+            state = states.setdefault(name, {"name": name, "created": 0, "files": {}})
+            state["files"][suffix] = path.name
+            state["created"] = max(state["created"], path.stat().st_mtime)
+        return sorted(states.values(), key=lambda state: state["created"])
+
+    def load(self):
+        try:
+            with open(self.index_file) as f:
+                index = json.load(f)
+            if index.get("version") == INDEX_VERSION:
+                return index["states"]
+        except FileNotFoundError:
+            pass
+        except (ValueError, KeyError):
+            logger.warning("Rebuilding invalid state index %s", self.index_file)
+        states = self.scan()
+        self.write(states)
+        return states
+
+    def write(self, states):
+        self.folder.mkdir(parents=True, exist_ok=True)
+        temp_file = self.index_file.with_name(INDEX_FILE + ".tmp")
+        with open(temp_file, "w") as f:
+            json.dump({"version": INDEX_VERSION, "states": states}, f, indent=1)
+        os.replace(temp_file, self.index_file)
+
+    def is_expired(self, state, now):
+        if self.expiry_days is None:
+            return False
+        return state["created"] < now - self.expiry_days * 86400
+
+    def latest(self):
+        """Return the newest state that did not expire, None if there is none."""
+        with _index_lock:
+            states = self.load()
+            if states and not all(
+                (self.folder / f).exists() for f in states[-1]["files"].values()
+            ):
+                logger.warning("State index %s is out of date", self.index_file)
+                states = self.scan()
+                self.write(states)
+        self.prune()
+        if states and not self.is_expired(states[-1], time.time()):
+            return states[-1]
+        return None
+
+    def path(self, state, suffix):
+        if suffix not in state["files"]:
+            return None
+        return self.folder / state["files"][suffix]
+
+    def add(self, name, files):
+        """Clone {suffix: file} into the catalogue as state ``name``."""
+        state = {"name": name, "created": time.time(), "files": {}}
+        self.folder.mkdir(parents=True, exist_ok=True)
+        for suffix, source in files.items():
+            file_name = name + suffix
+            method = clone_file(source, self.folder / file_name)
+            state["files"][suffix] = file_name
+            logger.info("Saved state %s (%s)", file_name, method)
+        with _index_lock:
+            states = [s for s in self.load() if s["name"] != name] + [state]
+            self.write(states)
+        self.prune()
+        return state
+
+    def prune(self, background=True):
+        """Drop expired and surplus states from the index and delete their files."""
+        with _index_lock:
+            states = self.load()
+            now = time.time()
+            keep = [state for state in states if not self.is_expired(state, now)]
+            if self.keep_count is not None:
+                keep = keep[-self.keep_count :] if self.keep_count > 0 else []
+            if len(keep) == len(states):
+                return
+            self.write(keep)
+        kept_files = {f for state in keep for f in state["files"].values()}
+        files = [
+            self.folder / f
+            for state in states
+            if state not in keep
+            for f in state["files"].values()
+            if f not in kept_files
+        ]
+        if background:
+            self.pruner = threading.Thread(
+                target=self.delete_files, args=(files,), name="state-pruner"
+            )
+            self.pruner.start()
+        else:
+            self.delete_files(files)
+
+    def delete_files(self, files):
+        for path in files:
+            try:
+                path.unlink()
+                logger.info("Removed expired state %s", path.name)
+            except FileNotFoundError:
+                pass
+            except OSError as e:
+                logger.warning("Could not remove state %s: %s", path, e)
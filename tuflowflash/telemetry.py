@@ -0,0 +1,204 @@
+from datetime import datetime
+from pathlib import Path
+from tuflowflash import metrics
+from tuflowflash.tracing import traced
+from tuflowflash.tuflow_supervisor import parse_progress_line
+
+import logging
+import os
+import pandas as pd
+import re
+
+
+logger = logging.getLogger(__name__)
+
+RUNS_FILE = "runs.parquet"
+SAMPLES_FOLDER = "samples"
+# wall clock time since the start of the run, printed on some progress lines
+ELAPSED_PATTERN = re.compile(
+    r"\b(?:elapsed|clock)(?:\s+time)?\s*[:=]?\s*(\d+):(\d{2}):(\d{2}(?:\.\d+)?)",
+    re.IGNORECASE,
+)
+# total run time at the end of a log, e.g. "Clock Time: 0:05:12"
+CLOCK_TIME_PATTERN = re.compile(
+    r"\b(?:total\s+)?clock\s+time\b\D*?(\d+):(\d{2}):(\d{2}(?:\.\d+)?)",
+    re.IGNORECASE,
+)
+
+
+def hms_to_seconds(match):
+    hours, minutes, seconds = match.groups()
+    return int(hours) * 3600 + int(minutes) * 60 + float(seconds)
+
+
+def parse_tuflow_log(log_file):
+    """Return the progress samples and the clock time (s, or None) of a log."""
+    samples = []
+    clock_time = None
+    with open(log_file, errors="replace") as f:
+        for line in f:
+            progress = parse_progress_line(line)
+            if "simulated_time" in progress:
+                elapsed = ELAPSED_PATTERN.search(line)
+                progress["wall_seconds"] = (
+                    hms_to_seconds(elapsed) if elapsed is not None else None
+                )
+                samples.append(progress)
+                continue
+            clock = CLOCK_TIME_PATTERN.search(line)
+            if clock is not None:
+                clock_time = hms_to_seconds(clock)
+    return samples, clock_time
+
+
+def summarise_run(run_id, samples, clock_time):
+    """Return the run time, timestep and wet cell statistics of a run."""
+    simulated = samples["simulated_time"]
+    simulated_hours = float(simulated.max() - simulated.min()) if len(samples) else 0
+    runtime = clock_time
+    if runtime is None and samples["wall_seconds"].notna().any():
+        runtime = float(samples["wall_seconds"].max())
+    timestep = samples["timestep"].dropna()
+    wet_cells = samples["wet_cells"].dropna()
+    return {
+        "run_id": run_id,
+        "samples": len(samples),
+        "simulated_hours": simulated_hours,
+        "runtime_seconds": runtime,
+        "seconds_per_simulated_hour": (
+            runtime / simulated_hours if runtime and simulated_hours else None
+        ),
+        "timestep_min": timestep.min() if len(timestep) else None,
+        "timestep_mean": timestep.mean() if len(timestep) else None,
+        "timestep_max": timestep.max() if len(timestep) else None,
+        "wet_cells_mean": wet_cells.mean() if len(wet_cells) else None,
+        "wet_cells_max": wet_cells.max() if len(wet_cells) else None,
+    }
+
+
+class TelemetryStore:
+    """History of TUFLOW run statistics in Parquet files.
+
+    ``runs.parquet`` has one row per run; the progress samples of each run
+    are in ``samples/<run id>.parquet``, so adding a run never rewrites the
+    samples of earlier runs. Needs pyarrow (or fastparquet).
+    """
+
+    def __init__(self, folder):
+        self.folder = Path(folder)
+        self.runs_file = self.folder / RUNS_FILE
+        self.samples_folder = self.folder / SAMPLES_FOLDER
+
+    def append(self, run, samples):
+        self.samples_folder.mkdir(parents=True, exist_ok=True)
+        samples.to_parquet(self.samples_folder / (run["run_id"] + ".parquet"))
+        runs = pd.DataFrame([run])
+        if self.runs_file.exists():
+            previous = pd.read_parquet(self.runs_file)
+            previous = previous[previous["run_id"] != run["run_id"]]
+            runs = pd.concat([previous, runs], ignore_index=True)
+        temp_file = self.runs_file.with_name(RUNS_FILE + ".tmp")
+        runs.to_parquet(temp_file, index=False)
+        os.replace(temp_file, self.runs_file)
+
+    def runs(self, since=None, until=None, simulation=None):
+        """Return the runs (optionally of one simulation) started in a period."""
+        if not self.runs_file.exists():
+            return pd.DataFrame()
+        runs = pd.read_parquet(self.runs_file)
+        if since is not None:
+            runs = runs[runs["started"] >= pd.Timestamp(since)]
+        if until is not None:
+            runs = runs[runs["started"] < pd.Timestamp(until)]
+        if simulation is not None:
+            runs = runs[runs["simulation"] == simulation]
+        return runs.sort_values("started").reset_index(drop=True)
+
+    def samples(self, run_id):
+        """Return the progress samples of a run."""
+        return pd.read_parquet(self.samples_folder / (run_id + ".parquet"))
+
+    def trend(self, column="seconds_per_simulated_hour", period="D", **filters):
+        """Return count, median and max of a run statistic per period.
+
+        E.g. ``trend("seconds_per_simulated_hour", "W", since="2024-01-01")``
+        shows per week how long the model takes per simulated hour.
+        """
+        runs = self.runs(**filters)
+        if runs.empty:
+            return runs
+        return (
+            runs.set_index("started")[column]
+            .astype(float)
+            .resample(period)
+            .agg(["count", "median", "max"])
+        )
+
+
+def log_samples(log_file):
+    """Return the samples of a log as a compact DataFrame and the clock time."""
+    samples, clock_time = parse_tuflow_log(log_file)
+    samples = pd.DataFrame(
+        samples,
+        columns=["simulated_time", "timestep", "wet_cells", "wall_seconds"],
+    ).astype(
+        {
+            "simulated_time": "float32",
+            "timestep": "float32",
+            "wet_cells": "Int32",
+            "wall_seconds": "float32",
+        }
+    )
+    return samples, clock_time
+
+
+@traced
+def record_run(store, settings, since=None, domain=None):
+    """Add the TUFLOW run of these settings to the store, from its log.
+
+    Logs last written before ``since`` (a unix time) are from an earlier run,
+    e.g. restored by the result cache, and are skipped. When the log has no
+    clock time the run time measured by the supervisor (of ``domain``) is
+    used.
+    """
+    from tuflowflash.run_tuflow import TuflowSimulation
+
+    simulation = TuflowSimulation(settings)
+    for log_file in simulation.tuflow_log_files():
+        if log_file.exists():
+            break
+    else:
+        logger.warning("No TUFLOW log found for %s", settings.tcf_file)
+        return None
+    if since is not None and log_file.stat().st_mtime < since:
+        logger.info("%s was not written by this run, skipping", log_file.name)
+        return None
+
+    samples, clock_time = log_samples(log_file)
+    name = simulation.simulation_name()
+    run_id = "{}_{}".format(settings.reference_time.strftime("%Y%m%dT%H%M"), name)
+    if clock_time is None and not samples["wall_seconds"].notna().any():
+        labels = {"domain": domain} if domain else {}
+        clock_time = metrics.value("tuflow_runtime_seconds", **labels)
+    run = summarise_run(run_id, samples, clock_time)
+    run.update(
+        {
+            "simulation": name,
+            "reference_time": pd.Timestamp(settings.reference_time),
+            "started": pd.Timestamp(
+                datetime.fromtimestamp(
+                    log_file.stat().st_mtime - (run["runtime_seconds"] or 0)
+                )
+            ),
+            "log_file": str(log_file),
+        }
+    )
+    store.append(run, samples)
+    logger.info(
+        "recorded telemetry of %s: %s samples, %.1f simulated hours, %s s",
+        name,
+        run["samples"],
+        run["simulated_hours"],
+        run["runtime_seconds"],
+    )
+    return run
@@ -0,0 +1,97 @@
+from tuflowflash.control_files import ControlFileParser
+from tuflowflash.control_files import load_model_index
+from tuflowflash.control_files import run_control_file
+from tuflowflash.control_files import write_run_control_file
+
+import os
+import pytest
+
+
+NESTED_TCF = """\
+Model Scenarios == 5m | dev
+If Scenario == 10m
+    Start Time == 1
+Else If Scenario == 5m
+    Start Time == 2
+    If Scenario == dev
+        End Time == 20
+    Else
+        End Time == 30
+    End If
+Else
+    Start Time == 3
+End If
+"""
+
+
+@pytest.mark.parametrize(
+    "scenarios, start_time, end_time",
+    [
+        (None, 2, 20),
+        (["5m"], 2, 30),
+        (["10m", "dev"], 1, None),
+        (["2m"], 3, None),
+    ],
+)
+def test_nested_scenario_blocks(tmp_path, scenarios, start_time, end_time):
+    tcf_file = tmp_path / "model.tcf"
+    tcf_file.write_text(NESTED_TCF)
+
+    index = ControlFileParser(tcf_file, scenarios).parse()
+
+    assert index.start_time == start_time
+    assert index.end_time == end_time
+
+
+def test_set_variable_substitution(tmp_path):
+    (tmp_path / "model_5m.tgc").write_text("")
+    tcf_file = tmp_path / "model.tcf"
+    tcf_file.write_text(
+        "Set Variable Cell == 5m  ! comment\n"
+        "Geometry Control File == model_<<Cell>>.tgc\n"
+        "Output Folder == results\\<<cell>>\\\n"
+        "Log Folder == log\\<<unknown>>\n"
+    )
+
+    index = ControlFileParser(tcf_file).parse()
+
+    assert index.get("geometry control file") == "model_5m.tgc"
+    assert str(tmp_path / "model_5m.tgc") in index.control_files
+    assert index.output_folder == str(tmp_path / "results" / "5m")
+    assert index.log_folder == str(tmp_path / "log" / "<<unknown>>")
+
+
+def test_index_cache_follows_include_mtime(tmp_path):
+    tcf_file = tmp_path / "model.tcf"
+    tcf_file.write_text("Read File == times.trd\n")
+    include = tmp_path / "times.trd"
+    include.write_text("End Time == 12\n")
+
+    assert load_model_index(tcf_file).end_time == 12
+    # a second load comes from the cache
+    assert (tmp_path / ".model.tcf.index.json").exists()
+    assert load_model_index(tcf_file).end_time == 12
+
+    include.write_text("End Time == 24\n")
+    mtime = os.stat(include).st_mtime_ns
+    os.utime(include, ns=(mtime + 10**9, mtime + 10**9))
+    assert load_model_index(tcf_file).end_time == 24
+
+
+def test_run_control_file_leaves_the_model_alone(tmp_path):
+    tcf_file = tmp_path / "model.tcf"
+    tcf_file.write_text("End Time == 12\nOutput Folder == results\n")
+    override = run_control_file(tcf_file).with_name("model_end.trd")
+    override.parent.mkdir()
+    override.write_text("End Time == 6\n")
+
+    run_tcf = write_run_control_file(
+        tcf_file, [("Output Folder", tmp_path / "results")], [override]
+    )
+    index = ControlFileParser(run_tcf).parse()
+
+    assert run_tcf.name == tcf_file.name and run_tcf != tcf_file
+    assert tcf_file.read_text() == "End Time == 12\nOutput Folder == results\n"
+    assert index.end_time == 6
+    assert index.output_folder == str(tmp_path / "results")
+    assert str(tcf_file) in index.control_files
@@ -0,0 +1,117 @@
+from pathlib import Path
+from tuflowflash.domain_scheduler import Domain
+from tuflowflash.domain_scheduler import DomainScheduler
+from tuflowflash.domain_scheduler import DomainSchedulerException
+from types import SimpleNamespace
+
+import json
+import pytest
+import stat
+import sys
+
+
+STUB_TUFLOW = """#!{python}
+import json
+import sys
+import time
+
+units = [arg[3:] for arg in sys.argv if arg.startswith("-pu")]
+name = sys.argv[-1].rsplit("/", 1)[-1][: -len(".tcf")]
+start = time.time()
+with open({seconds!r}) as f:
+    time.sleep(json.load(f)[name])
+with open({runs!r}, "a") as f:
+    f.write(json.dumps([name, units, start, time.time()]) + "\\n")
+sys.exit(1 if name.startswith("fail") else 0)
+"""
+
+
+@pytest.fixture
+def tuflow(tmp_path):
+    """Return a function making domains run by a stub TUFLOW executable."""
+    runs = tmp_path / "runs.jsonl"
+    run_times = {}
+    run_times_file = tmp_path / "run_times.json"
+    executable = tmp_path / "tuflow"
+    executable.write_text(
+        STUB_TUFLOW.format(
+            python=sys.executable, runs=str(runs), seconds=str(run_times_file)
+        )
+    )
+    executable.chmod(executable.stat().st_mode | stat.S_IXUSR)
+
+    def domain(name, units=1, seconds=0.3):
+        folder = tmp_path / name
+        folder.mkdir()
+        (folder / (name + ".tcf")).write_text("Timestep == 1\n")
+        run_times[name] = seconds
+        run_times_file.write_text(json.dumps(run_times))
+        settings = SimpleNamespace(
+            tuflow_executable=str(executable),
+            tcf_file=folder / (name + ".tcf"),
+            output_folder=folder / "results",
+            pu=0,
+            tuflow_start_time=0,
+            tuflow_end_time=1,
+            manage_states=False,
+            preflight_check=False,
+        )
+        return Domain(settings, units)
+
+    def results():
+        return [json.loads(line) for line in runs.read_text().splitlines()]
+
+    domain.results = results
+    return domain
+
+
+def overlap(run, other):
+    return run[2] < other[3] and other[2] < run[3]
+
+
+def test_domains_never_share_processing_units(tuflow):
+    domains = [tuflow("a", 2), tuflow("b"), tuflow("c"), tuflow("d", 2)]
+    DomainScheduler(domains, [0, 1, 2]).run()
+
+    runs = tuflow.results()
+    assert sorted(run[0] for run in runs) == ["a", "b", "c", "d"]
+    for number, run in enumerate(runs):
+        for other in runs[number + 1 :]:
+            if overlap(run, other):
+                assert not set(run[1]) & set(other[1])
+    units = {run[0]: run[1] for run in runs}
+    assert len(units["a"]) == 2 and len(units["d"]) == 2
+
+
+def test_units_are_reused_once_a_domain_finishes(tuflow):
+    domains = [tuflow("a"), tuflow("b", seconds=1), tuflow("c")]
+    DomainScheduler(domains, [4, 5]).run()
+
+    runs = {run[0]: run for run in tuflow.results()}
+    # c waits for a free unit and gets the one of a, which finishes first
+    assert runs["a"][1] == ["4"] and runs["b"][1] == ["5"]
+    assert runs["a"][3] <= runs["c"][2] < runs["b"][3]
+    assert runs["c"][1] == ["4"]
+
+
+def test_failing_domain_does_not_lose_the_others(tuflow):
+    post_processed = []
+    domains = [tuflow("a"), tuflow("fail"), tuflow("b"), tuflow("c")]
+    scheduler = DomainScheduler(
+        domains,
+        [0, 1],
+        post_process=lambda settings: post_processed.append(
+            Path(settings.tcf_file).stem
+        ),
+    )
+
+    with pytest.raises(DomainSchedulerException, match="Domain fail failed"):
+        scheduler.run()
+    assert sorted(run[0] for run in tuflow.results()) == ["a", "b", "c", "fail"]
+    assert sorted(post_processed) == ["a", "b", "c"]
+    assert set(scheduler.durations) == {"a", "b", "c", "fail"}
+
+
+def test_domain_larger_than_the_budget_is_refused(tuflow):
+    with pytest.raises(DomainSchedulerException):
+        DomainScheduler([tuflow("a", 3)], [0, 1])
@@ -0,0 +1,22 @@
+import subprocess
+import sys
+
+
+# only the stages needing them should import these
+HEAVY_MODULES = {"osgeo", "gdal", "netCDF4", "geopandas", "pandas"}
+
+
+def test_start_sim_imports_no_heavy_modules():
+    process = subprocess.run(
+        [sys.executable, "-X", "importtime", "-c", "import tuflowflash.start_sim"],
+        capture_output=True,
+        text=True,
+        check=True,
+    )
+    imported = {
+        line.split("|")[-1].strip().split(".")[0]
+        for line in process.stderr.splitlines()
+        if line.startswith("import time:")
+    }
+    assert "tuflowflash" in imported
+    assert not imported & HEAVY_MODULES
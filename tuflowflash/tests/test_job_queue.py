@@ -0,0 +1,110 @@
+from tuflowflash import job_queue
+from tuflowflash.job_queue import JobQueue
+from tuflowflash.job_queue import JobQueueException
+from tuflowflash.job_queue import JobWorker
+
+import json
+import multiprocessing
+import os
+import pytest
+import time
+
+
+STUB = "stub"
+POLL_SECONDS = 0.05
+
+
+def run_stub_job(job, processing_units):
+    time.sleep(job["arguments"]["seconds"])
+    return job["arguments"]["value"], os.getpid()
+
+
+# registered on import, so also in the spawned workers
+job_queue.JOB_RUNNERS[STUB] = run_stub_job
+
+
+def run_worker(folder, units, idle_seconds):
+    JobWorker(JobQueue(folder, poll_seconds=POLL_SECONDS), range(units)).run(
+        idle_seconds=idle_seconds
+    )
+
+
+@pytest.fixture
+def start_workers(tmp_path):
+    context = multiprocessing.get_context("spawn")
+    processes = []
+
+    def start(count, units=1, idle_seconds=5):
+        for _ in range(count):
+            process = context.Process(
+                target=run_worker, args=(tmp_path, units, idle_seconds)
+            )
+            process.start()
+            processes.append(process)
+        return processes
+
+    yield start
+    for process in processes:
+        process.join(10)
+        if process.is_alive():
+            process.terminate()
+
+
+def test_workers_share_the_jobs(tmp_path, start_workers):
+    queue = JobQueue(tmp_path, poll_seconds=POLL_SECONDS)
+    job_ids = [queue.submit(STUB, None, value=value, seconds=0.3) for value in range(9)]
+    start_workers(3)
+
+    results = queue.wait(job_ids, timeout=60)
+
+    assert [results[job_id][0] for job_id in job_ids] == list(range(9))
+    assert len({pid for _, pid in results.values()}) > 1
+    assert queue.pending() == []
+
+
+def test_job_refused_by_all_workers_fails(tmp_path, start_workers):
+    queue = JobQueue(tmp_path, poll_seconds=POLL_SECONDS)
+    start_workers(2, units=1)
+    job_id = queue.submit(STUB, None, units=4, value=1, seconds=0)
+
+    start = time.monotonic()
+    with pytest.raises(JobQueueException, match="refused by all workers"):
+        queue.wait([job_id], timeout=60)
+    assert time.monotonic() - start < 30
+
+
+def test_wait_times_out_and_withdraws_jobs(tmp_path):
+    queue = JobQueue(tmp_path, poll_seconds=POLL_SECONDS)
+    job_id = queue.submit(STUB, None, value=1, seconds=0)
+
+    with pytest.raises(JobQueueException, match="did not finish"):
+        queue.wait([job_id], timeout=0.2)
+    assert queue.pending() == []
+
+
+def test_result_of_withdrawn_job_is_dropped(tmp_path):
+    queue = JobQueue(tmp_path, poll_seconds=POLL_SECONDS)
+    job_id = queue.submit(STUB, None, value=1, seconds=0)
+    job = queue.claim("worker")
+    assert json.loads(queue.job_file(job_id).read_text()) == job
+
+    # the submitter gave up while the worker was running the job
+    queue.remove(job_id)
+    queue.finish(job_id, "worker", "done", value=1)
+    assert not queue.result_file(job_id).exists()
+    assert not queue.lock_file(job_id).exists()
+
+
+def test_submit_removes_orphaned_results(tmp_path):
+    queue = JobQueue(tmp_path, poll_seconds=POLL_SECONDS)
+    orphan = queue.result_file("00000000000000000001_orphan")
+    orphan.write_text("{}")
+
+    queue.submit(STUB, None, value=1, seconds=0)
+    assert not orphan.exists()
+
+
+def test_unknown_job_kind_is_refused(tmp_path):
+    queue = JobQueue(tmp_path, poll_seconds=POLL_SECONDS)
+    with pytest.raises(JobQueueException, match="Unknown job kind"):
+        queue.submit("shell", None)
@@ -0,0 +1,116 @@
+from tuflowflash.pipeline import Pipeline
+from tuflowflash.pipeline import PipelineException
+from tuflowflash.pipeline import Stage
+
+import pytest
+import threading
+import time
+
+
+class Recorder:
+    """Stage functions that log when they start and end."""
+
+    def __init__(self):
+        self.events = []
+        self.lock = threading.Lock()
+        self.running = set()
+        self.overlaps = set()
+
+    def stage(self, name, seconds=0.05):
+        def function():
+            with self.lock:
+                self.events.append(("start", name))
+                self.overlaps.update(frozenset((name, other)) for other in self.running)
+                self.running.add(name)
+            time.sleep(seconds)
+            with self.lock:
+                self.running.discard(name)
+                self.events.append(("end", name))
+
+        return function
+
+    def position(self, event, name):
+        return self.events.index((event, name))
+
+
+def test_stages_wait_for_their_inputs():
+    recorder = Recorder()
+    Pipeline(
+        [
+            Stage("upload", recorder.stage("upload"), inputs=["results"]),
+            Stage("rain", recorder.stage("rain"), outputs=["rain"]),
+            Stage("tide", recorder.stage("tide"), outputs=["tide"]),
+            Stage(
+                "simulation",
+                recorder.stage("simulation"),
+                inputs=["rain", "tide"],
+                outputs=["results"],
+            ),
+        ]
+    ).run()
+
+    for before, after in (("rain", "simulation"), ("tide", "simulation")):
+        assert recorder.position("end", before) < recorder.position("start", after)
+    assert recorder.position("end", "simulation") < recorder.position("start", "upload")
+    # independent stages run concurrently
+    assert frozenset(("rain", "tide")) in recorder.overlaps
+
+
+def test_disabled_stage_unblocks_dependents():
+    recorder = Recorder()
+    Pipeline(
+        [
+            Stage("rain", recorder.stage("rain"), enabled=False, outputs=["rain"]),
+            Stage("simulation", recorder.stage("simulation"), inputs=["rain"]),
+        ]
+    ).run()
+
+    assert recorder.events == [("start", "simulation"), ("end", "simulation")]
+
+
+def test_stages_sharing_a_resource_never_overlap():
+    recorder = Recorder()
+    Pipeline(
+        [
+            Stage("forecast", recorder.stage("forecast"), resources=["netcdf"]),
+            Stage("nowcast", recorder.stage("nowcast"), resources=["netcdf"]),
+            Stage("soil", recorder.stage("soil"), resources=["netcdf"]),
+            Stage("gauges", recorder.stage("gauges", 0.2)),
+        ]
+    ).run()
+
+    netcdf_stages = {"forecast", "nowcast", "soil"}
+    assert not any(pair <= netcdf_stages for pair in recorder.overlaps)
+    assert any("gauges" in pair for pair in recorder.overlaps)
+
+
+def test_failure_stops_dependents_and_is_raised():
+    recorder = Recorder()
+
+    def fail():
+        raise ValueError("no rain")
+
+    with pytest.raises(ValueError, match="no rain"):
+        Pipeline(
+            [
+                Stage("rain", fail, outputs=["rain"]),
+                Stage("simulation", recorder.stage("simulation"), inputs=["rain"]),
+            ]
+        ).run()
+    assert recorder.events == []
+
+
+@pytest.mark.parametrize(
+    "stages",
+    [
+        [Stage("a", None, inputs=["missing"])],
+        [Stage("a", None, outputs=["x"]), Stage("b", None, outputs=["x"])],
+        [
+            Stage("a", None, inputs=["y"], outputs=["x"]),
+            Stage("b", None, inputs=["x"], outputs=["y"]),
+        ],
+    ],
+)
+def test_invalid_dependencies_are_rejected(stages):
+    with pytest.raises(PipelineException):
+        Pipeline(stages)
@@ -0,0 +1,23 @@
+from tuflowflash.result_cache import detach_links
+from tuflowflash.result_cache import ResultCache
+
+
+def test_rewriting_restored_rasters_leaves_the_cache_alone(tmp_path):
+    results = tmp_path / "results"
+    results.mkdir()
+    (results / "m_d_001.tif").write_text("tuflow")
+    (results / "m_PO.csv").write_text("points")
+    cache = ResultCache(tmp_path / "cache")
+
+    cache.store("key", [results])
+    detach_links([results])
+    (results / "m_d_001.tif").write_text("finalised")
+    assert cache.restore("key", [results])
+    detach_links([results])
+    (results / "m_d_001.tif").write_text("finalised again")
+
+    cached_raster = cache.entry("key") / "0" / "m_d_001.tif"
+    assert cached_raster.read_text() == "tuflow"
+    assert (results / "m_d_001.tif").stat().st_nlink == 1
+    # outputs that are not rewritten keep sharing their data
+    assert (results / "m_PO.csv").stat().st_nlink == 2
@@ -0,0 +1,59 @@
+from pathlib import Path
+from tuflowflash import start_sim
+from tuflowflash.run_tuflow import TuflowSimulation
+from tuflowflash.run_tuflow import TuflowSimulationException
+from tuflowflash.service import FlashService
+from types import SimpleNamespace
+
+import pytest
+
+
+def hanging_tuflow_settings(tmp_path):
+    """Settings of a 'TUFLOW' that never finishes and a 1 s timeout."""
+    executable = tmp_path / "tuflow.sh"
+    executable.write_text("#!/bin/sh\nsleep 60\n")
+    executable.chmod(0o755)
+    tcf_file = tmp_path / "model.tcf"
+    tcf_file.write_text("")
+    return SimpleNamespace(
+        tuflow_executable=str(executable),
+        tcf_file=tcf_file,
+        output_folder=tmp_path / "results",
+        pu=0,
+        manage_states=False,
+        preflight_check=False,
+        tuflow_start_time=0,
+        tuflow_end_time=1,
+        tuflow_timeout_minutes=1 / 60,
+        resource_sample_seconds=0.1,
+        reference_time="2026-10-18 12:00",
+    )
+
+
+def test_killed_run_raises(tmp_path):
+    settings = hanging_tuflow_settings(tmp_path)
+    with pytest.raises(TuflowSimulationException, match="watchdog"):
+        TuflowSimulation(settings).run()
+
+
+def test_killed_run_fails_cycle_but_not_service(tmp_path, monkeypatch):
+    settings = hanging_tuflow_settings(tmp_path)
+    errors = []
+
+    def run_cycle(settings, *args):
+        TuflowSimulation(settings).run()
+
+    monkeypatch.setattr(start_sim, "run_cycle", run_cycle)
+    monkeypatch.setattr(
+        start_sim,
+        "report_error",
+        lambda settings, error, verbose=False: errors.append(error),
+    )
+    service = FlashService(Path(tmp_path / "settings.ini"))
+    monkeypatch.setattr(service, "load_settings", lambda: settings)
+
+    service.run_cycle()
+    service.run_cycle()
+
+    assert len(errors) == 2
+    assert all(isinstance(error, TuflowSimulationException) for error in errors)
@@ -0,0 +1,41 @@
+from tuflowflash.tide_prediction import predict_tide
+
+import numpy as np
+import pandas as pd
+import pytest
+
+
+# diurnal dominated, as on most of the Australian coast
+CONSTITUENTS = pd.DataFrame(
+    {
+        "constituent": ["K1", "O1", "Q1", "M2"],
+        "amplitude": [0.6, 0.45, 0.1, 0.2],
+        "phase": [120.0, 80.0, 50.0, 200.0],
+    }
+)
+
+
+def test_phases_agree_with_utide():
+    utide = pytest.importorskip("utide")
+    times = pd.date_range("2026-01-01", periods=24 * 120, freq="h")
+    levels = predict_tide(CONSTITUENTS, times.values)
+
+    coef = utide.solve(
+        times,
+        levels,
+        lat=-33.9,
+        constit=CONSTITUENTS["constituent"].tolist(),
+        nodal=True,
+        trend=False,
+        method="ols",
+        conf_int="none",
+        verbose=False,
+    )
+
+    for name, amplitude, phase in CONSTITUENTS.itertuples(index=False):
+        i = list(coef.name).index(name)
+        assert coef.A[i] == pytest.approx(amplitude, abs=0.01)
+        difference = (coef.g[i] - phase + 180) % 360 - 180
+        assert abs(difference) < 1, name
+    reconstruction = utide.reconstruct(times, coef, verbose=False)
+    assert np.abs(reconstruction.h - levels).max() < 0.01
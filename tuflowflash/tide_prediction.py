@@ -0,0 +1,227 @@
+from pathlib import Path
+
+import logging
+import numpy as np
+import pandas as pd
+
+
+logger = logging.getLogger(__name__)
+
+J2000 = np.datetime64("2000-01-01T12:00:00")
+MEAN_LEVEL_CONSTITUENT = "Z0"
+DEFAULT_TIMESTEP = 1
+DEFAULT_LEVEL_COLUMN = "level"
+
+# Doodson numbers (tau, s, h, p, N', p1) and phase offset in degrees
+CONSTITUENTS = {
+    "SA": ((0, 0, 1, 0, 0, -1), 0),
+    "SSA": ((0, 0, 2, 0, 0, 0), 0),
+    "MM": ((0, 1, 0, -1, 0, 0), 0),
+    "MF": ((0, 2, 0, 0, 0, 0), 0),
+    "2Q1": ((1, -3, 0, 2, 0, 0), -90),
+    "Q1": ((1, -2, 0, 1, 0, 0), -90),
+    "RHO1": ((1, -2, 2, -1, 0, 0), -90),
+    "O1": ((1, -1, 0, 0, 0, 0), -90),
+    "P1": ((1, 1, -2, 0, 0, 0), -90),
+    "K1": ((1, 1, 0, 0, 0, 0), 90),
+    "J1": ((1, 2, 0, -1, 0, 0), 90),
+    "OO1": ((1, 3, 0, 0, 0, 0), 90),
+    "2N2": ((2, -2, 0, 2, 0, 0), 0),
+    "MU2": ((2, -2, 2, 0, 0, 0), 0),
+    "N2": ((2, -1, 0, 1, 0, 0), 0),
+    "NU2": ((2, -1, 2, -1, 0, 0), 0),
+    "M2": ((2, 0, 0, 0, 0, 0), 0),
+    "L2": ((2, 1, 0, -1, 0, 0), 180),
+    "T2": ((2, 2, -3, 0, 0, 1), 0),
+    "S2": ((2, 2, -2, 0, 0, 0), 0),
+    "K2": ((2, 2, 0, 0, 0, 0), 0),
+    "MN4": ((4, -1, 0, 1, 0, 0), 0),
+    "M4": ((4, 0, 0, 0, 0, 0), 0),
+    "MS4": ((4, 2, -2, 0, 0, 0), 0),
+    "M6": ((6, 0, 0, 0, 0, 0), 0),
+}
+
+# Nodal correction family per constituent, see nodal_corrections
+NODAL_FAMILY = {
+    "MM": "MM",
+    "MF": "MF",
+    "2Q1": "O1",
+    "Q1": "O1",
+    "RHO1": "O1",
+    "O1": "O1",
+    "K1": "K1",
+    "J1": "J1",
+    "OO1": "OO1",
+    "2N2": "M2",
+    "MU2": "M2",
+    "N2": "M2",
+    "NU2": "M2",
+    "M2": "M2",
+    "L2": "M2",
+    "K2": "K2",
+    "MN4": "M2^2",
+    "M4": "M2^2",
+    "MS4": "M2",
+    "M6": "M2^3",
+}
+
+
+def astronomical_arguments(hours_since_j2000):
+    """Return (tau, s, h, p, N', p1) in degrees for every time, shape (6, n)."""
+    t = np.asarray(hours_since_j2000, dtype=np.float64)
+    centuries = t / (24 * 36525)
+    s = 218.3164 + 481267.8812 * centuries
+    h = 280.4661 + 36000.7698 * centuries
+    p = 83.3535 + 4069.0137 * centuries
+    n = 125.0445 - 1934.1363 * centuries
+    p1 = 282.9384 + 1.7195 * centuries
+    # J2000 is at noon, tau counts the lunar day from 00:00 UT
+    tau = 15.0 * t + 180.0 + h - s
+    return np.stack([tau, s, h, p, -n, p1]), n
+
+
+def nodal_corrections(families, node):
+    """Return nodal amplitude factors f and phase corrections u (degrees).
+
+    Uses the simplified Schureman/Doodson series in the longitude of the
+    moon's node. ``families`` has shape (m,), ``node`` shape (n,), the result
+    has shape (m, n).
+    """
+    n = np.radians(node)[np.newaxis, :]
+    cos1, cos2, cos3 = np.cos(n), np.cos(2 * n), np.cos(3 * n)
+    sin1, sin2, sin3 = np.sin(n), np.sin(2 * n), np.sin(3 * n)
+
+    f_m2 = 1.0004 - 0.0373 * cos1 + 0.0002 * cos2
+    u_m2 = -2.14 * sin1
+    series = {
+        "M2": (f_m2, u_m2),
+        "M2^2": (f_m2**2, 2 * u_m2),
+        "M2^3": (f_m2**3, 3 * u_m2),
+        "O1": (
+            1.0089 + 0.1871 * cos1 - 0.0147 * cos2 + 0.0014 * cos3,
+            10.80 * sin1 - 1.34 * sin2 + 0.19 * sin3,
+        ),
+        "K1": (
+            1.0060 + 0.1150 * cos1 - 0.0088 * cos2 + 0.0006 * cos3,
+            -8.86 * sin1 + 0.68 * sin2 - 0.07 * sin3,
+        ),
+        "J1": (
+            1.1029 + 0.1676 * cos1 - 0.0170 * cos2 + 0.0016 * cos3,
+            -12.94 * sin1 + 1.34 * sin2 - 0.19 * sin3,
+        ),
+        "OO1": (
+            1.1027 + 0.6504 * cos1 + 0.0317 * cos2 - 0.0014 * cos3,
+            -36.68 * sin1 + 4.02 * sin2 - 0.57 * sin3,
+        ),
+        "K2": (
+            1.0241 + 0.2863 * cos1 + 0.0083 * cos2 - 0.0015 * cos3,
+            -17.74 * sin1 + 0.68 * sin2 - 0.04 * sin3,
+        ),
+        "MM": (1.0 - 0.1300 * cos1 + 0.0013 * cos2, 0.0 * sin1),
+        "MF": (
+            1.0429 + 0.4135 * cos1 - 0.004 * cos2,
+            -23.74 * sin1 + 2.68 * sin2 - 0.38 * sin3,
+        ),
+    }
+    f = np.ones((len(families), n.shape[1]))
+    u = np.zeros((len(families), n.shape[1]))
+    for i, family in enumerate(families):
+        if family in series:
+            f[i], u[i] = series[family]
+    return f, u
+
+
+def read_constituent_table(constituent_file):
+    """Read a csv with ``constituent``, ``amplitude`` and ``phase`` columns.
+
+    Phases are Greenwich phase lags in degrees (UTC), amplitudes in metres. An
+    optional ``Z0`` row holds the mean water level.
+    """
+    table = pd.read_csv(constituent_file, skipinitialspace=True)
+    table.columns = [column.strip().lower() for column in table.columns]
+    table["constituent"] = table["constituent"].str.strip().str.upper()
+    unknown = set(table["constituent"]) - set(CONSTITUENTS) - {MEAN_LEVEL_CONSTITUENT}
+    if unknown:
+        raise ValueError(
+            "Unknown tidal constituent(s) %s in %s"
+            % (", ".join(sorted(unknown)), constituent_file)
+        )
+    return table
+
+
+def predict_tide(constituent_table, utc_times):
+    """Evaluate the harmonic tide for all constituents and times at once."""
+    utc_times = np.asarray(utc_times, dtype="datetime64[ns]")
+    hours = (utc_times - J2000) / np.timedelta64(1, "h")
+
+    mean_level = constituent_table.loc[
+        constituent_table["constituent"] == MEAN_LEVEL_CONSTITUENT, "amplitude"
+    ].sum()
+    table = constituent_table[
+        constituent_table["constituent"] != MEAN_LEVEL_CONSTITUENT
+    ]
+    names = table["constituent"].tolist()
+    doodson = np.array([CONSTITUENTS[name][0] for name in names], dtype=np.float64)
+    offset = np.array([CONSTITUENTS[name][1] for name in names], dtype=np.float64)
+    families = [NODAL_FAMILY.get(name) for name in names]
+    amplitude = table["amplitude"].to_numpy(dtype=np.float64)[:, np.newaxis]
+    phase = table["phase"].to_numpy(dtype=np.float64)[:, np.newaxis]
+
+    arguments, node = astronomical_arguments(hours)
+    f, u = nodal_corrections(families, node)
+    # (m, 6) @ (6, n) -> equilibrium argument per constituent and time step
+    equilibrium = doodson @ arguments + offset[:, np.newaxis]
+    angle = np.radians(equilibrium + u - phase)
+    return mean_level + (f * amplitude * np.cos(angle)).sum(axis=0)
+
+
+class TidePredictor:
+    def __init__(self, settings):
+        self.settings = settings
+
+    def get_forecast_times(self, utc_reference_time):
+        """Return local hours relative to the reference time and UTC times."""
+        timestep_hours = (
+            getattr(self.settings, "tide_timestep_minutes", DEFAULT_TIMESTEP) / 60
+        )
+        relative_hours = np.arange(
+            self.settings.tuflow_start_time,
+            self.settings.tuflow_end_time + timestep_hours / 2,
+            timestep_hours,
+        )
+        utc_reference = np.datetime64(utc_reference_time.replace(tzinfo=None), "ns")
+        utc_times = utc_reference + (relative_hours * 3600e9).astype("m8[ns]")
+        return relative_hours, utc_times
+
+    def write_tide_boundaries(self, utc_reference_time, residual_hook=None):
+        relative_hours, utc_times = self.get_forecast_times(utc_reference_time)
+        local_times = pd.DatetimeIndex(
+            np.datetime64(self.settings.reference_time, "ns")
+            + (relative_hours * 3600e9).astype("m8[ns]")
+        )
+        column = getattr(self.settings, "tide_level_column", DEFAULT_LEVEL_COLUMN)
+
+        boundary_files = [
+            output_file for _, output_file in self.settings.get_boundary_sources()
+        ]
+        constituent_files = [
+            Path(f.strip()) for f in self.settings.tide_constituent_files
+        ]
+        if len(constituent_files) != len(boundary_files):
+            raise ValueError(
+                "tide_constituent_files should have one table per boundary file"
+            )
+
+        for constituent_file, boundary_file in zip(constituent_files, boundary_files):
+            table = read_constituent_table(constituent_file)
+            levels = predict_tide(table, utc_times)
+            boundary_df = pd.DataFrame(
+                {"datetime": local_times.strftime("%d/%m/%Y %H:%M"), column: levels},
+                index=pd.Index(relative_hours, name="Time (h)"),
+            )
+            if residual_hook is not None:
+                boundary_df = residual_hook(boundary_df, boundary_file)
+            boundary_df.to_csv(boundary_file)
+            logger.info(
+                "predicted tide from %s written to %s", constituent_file, boundary_file
+            )
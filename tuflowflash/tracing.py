@@ -0,0 +1,268 @@
+from pathlib import Path
+
+import contextlib
+import functools
+import json
+import logging
+import os
+import sys
+import threading
+import time
+import tracemalloc
+
+
+try:
+    import psutil
+except ImportError:
+    psutil = None  # type: ignore[assignment]
+
+try:
+    import resource
+except ImportError:  # Windows
+    resource = None  # type: ignore[assignment]
+
+logger = logging.getLogger(__name__)
+
+_tracer = None
+
+
+def memory_usage():
+    """Return (rss, peak rss) of this process in bytes, None when unknown."""
+    rss = peak = None
+    if psutil is not None:
+        info = psutil.Process().memory_info()
+        rss = info.rss
+        peak = getattr(info, "peak_wset", None)
+    if peak is None and resource is not None:
+        peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+        if sys.platform != "darwin":
+            peak *= 1024
+    if rss is not None and peak is not None:
+        peak = max(peak, rss)
+    return rss, peak
+
+
+def io_counters():
+    """Return (bytes read, bytes written) of this process, None when unknown."""
+    if psutil is None:
+        return None, None
+    try:
+        counters = psutil.Process().io_counters()
+    except (AttributeError, psutil.Error):
+        return None, None
+    return counters.read_bytes, counters.write_bytes
+
+
+def children_cpu_time():
+    times = os.times()
+    return times.children_user + times.children_system
+
+
+def difference(end, start):
+    if end is None or start is None:
+        return None
+    return end - start
+
+
+class Tracer:
+    """Record timing and memory spans of one forecast cycle.
+
+    Per span it records wall time, the CPU time of its thread and of finished
+    child processes (TUFLOW), the peak of Python (tracemalloc) memory while the
+    span was open, RSS and the bytes read/written by the process. Memory peaks
+    and IO are process wide, so spans running concurrently share them.
+    """
+
+    def __init__(self, cycle_id, trace_memory=True):
+        self.cycle_id = cycle_id
+        self.spans = []
+        # resource samples of child processes, see add_sample
+        self.samples = []
+        self.open_spans = {}
+        self.lock = threading.Lock()
+        self.origin = time.perf_counter()
+        self.started_tracemalloc = trace_memory and not tracemalloc.is_tracing()
+        if self.started_tracemalloc:
+            tracemalloc.start()
+
+    def sample_python_peak(self):
+        """Attribute the tracemalloc peak since the last sample to open spans."""
+        if not tracemalloc.is_tracing():
+            return
+        _, peak = tracemalloc.get_traced_memory()
+        tracemalloc.reset_peak()
+        for record in self.open_spans.values():
+            record["python_peak_bytes"] = max(record["python_peak_bytes"], peak)
+
+    @contextlib.contextmanager
+    def span(self, name, category="function"):
+        record = {
+            "cycle": self.cycle_id,
+            "name": name,
+            "category": category,
+            "thread": threading.current_thread().name,
+            "tid": threading.get_native_id(),
+            "status": "ok",
+            "python_peak_bytes": 0,
+        }
+        read_start, write_start = io_counters()
+        cpu_start = time.thread_time()
+        children_start = children_cpu_time()
+        with self.lock:
+            self.sample_python_peak()
+            self.open_spans[id(record)] = record
+        start = time.perf_counter()
+        try:
+            yield record
+        except BaseException:
+            record["status"] = "error"
+            raise
+        finally:
+            end = time.perf_counter()
+            with self.lock:
+                self.sample_python_peak()
+                del self.open_spans[id(record)]
+            read_end, write_end = io_counters()
+            record["rss_bytes"], record["rss_peak_bytes"] = memory_usage()
+            record.update(
+                start=start - self.origin,
+                wall=end - start,
+                cpu=time.thread_time() - cpu_start,
+                child_cpu=children_cpu_time() - children_start,
+                read_bytes=difference(read_end, read_start),
+                write_bytes=difference(write_end, write_start),
+            )
+            if not tracemalloc.is_tracing():
+                record["python_peak_bytes"] = None
+            self.spans.append(record)
+
+    def add_sample(self, name, **values):
+        """Record counter values (e.g. TUFLOW's RSS) at the current time."""
+        record = {
+            "cycle": self.cycle_id,
+            "name": name,
+            "category": "sample",
+            "start": time.perf_counter() - self.origin,
+        }
+        record.update(values)
+        with self.lock:
+            self.samples.append(record)
+
+    def close(self):
+        if self.started_tracemalloc:
+            tracemalloc.stop()
+
+    def chrome_trace(self):
+        """Return the spans as a Chrome trace (chrome://tracing, Perfetto)."""
+        pid = os.getpid()
+        events = []
+        threads = {}
+        for record in sorted(self.spans, key=lambda r: r["start"]):
+            threads[record["tid"]] = record["thread"]
+            events.append(
+                {
+                    "name": record["name"],
+                    "cat": record["category"],
+                    "ph": "X",
+                    "ts": round(record["start"] * 1e6),
+                    "dur": round(record["wall"] * 1e6),
+                    "pid": pid,
+                    "tid": record["tid"],
+                    "args": {
+                        key: value
+                        for key, value in record.items()
+                        if key not in ("name", "category", "thread", "tid")
+                    },
+                }
+            )
+            if record["rss_bytes"] is not None:
+                events.append(
+                    {
+                        "name": "memory",
+                        "ph": "C",
+                        "ts": round((record["start"] + record["wall"]) * 1e6),
+                        "pid": pid,
+                        "args": {"rss_bytes": record["rss_bytes"]},
+                    }
+                )
+        for record in self.samples:
+            events.append(
+                {
+                    "name": record["name"],
+                    "ph": "C",
+                    "ts": round(record["start"] * 1e6),
+                    "pid": pid,
+                    "args": {
+                        key: value
+                        for key, value in record.items()
+                        if key not in ("cycle", "name", "category", "start")
+                    },
+                }
+            )
+        for tid, thread in threads.items():
+            events.append(
+                {
+                    "name": "thread_name",
+                    "ph": "M",
+                    "pid": pid,
+                    "tid": tid,
+                    "args": {"name": thread},
+                }
+            )
+        return {
+            "traceEvents": events,
+            "displayTimeUnit": "ms",
+            "otherData": {"cycle": self.cycle_id},
+        }
+
+    def write(self, trace_folder):
+        """Write <cycle>.trace.jsonl and <cycle>.trace.json to the trace folder."""
+        trace_folder = Path(trace_folder)
+        trace_folder.mkdir(parents=True, exist_ok=True)
+        jsonl_file = trace_folder / "{}.trace.jsonl".format(self.cycle_id)
+        with open(jsonl_file, "w") as f:
+            for record in sorted(self.spans + self.samples, key=lambda r: r["start"]):
+                f.write(json.dumps(record) + "\n")
+        with open(trace_folder / "{}.trace.json".format(self.cycle_id), "w") as f:
+            json.dump(self.chrome_trace(), f)
+        logger.info("trace of %s spans written to %s", len(self.spans), jsonl_file)
+
+
+def start_trace(cycle_id, trace_memory=True):
+    global _tracer
+    _tracer = Tracer(cycle_id, trace_memory)
+    return _tracer
+
+
+def stop_trace():
+    global _tracer
+    tracer, _tracer = _tracer, None
+    if tracer is not None:
+        tracer.close()
+    return tracer
+
+
+def span(name, category="function"):
+    """Trace a block of code, a no-op when no trace is running."""
+    if _tracer is None:
+        return contextlib.nullcontext()
+    return _tracer.span(name, category)
+
+
+def sample(name, **values):
+    """Record counter values in the trace, a no-op when no trace is running."""
+    if _tracer is not None:
+        _tracer.add_sample(name, **values)
+
+
+def traced(function):
+    """Decorator tracing every call of a function (by its qualified name)."""
+
+    @functools.wraps(function)
+    def wrapper(*args, **kwargs):
+        if _tracer is None:
+            return function(*args, **kwargs)
+        with _tracer.span(function.__qualname__):
+            return function(*args, **kwargs)
+
+    return wrapper
@@ -0,0 +1,267 @@
+from collections import deque
+from pathlib import Path
+from tuflowflash import metrics
+from tuflowflash.resource_watchdog import DEFAULT_SAMPLE_SECONDS
+from tuflowflash.resource_watchdog import ResourceWatchdog
+
+import logging
+import re
+import subprocess
+import threading
+import time
+
+
+logger = logging.getLogger(__name__)
+
+PROGRESS_LOG_SECONDS = 60
+LOG_POLL_SECONDS = 1
+TAIL_LINES = 20
+
+# TUFLOW (classic and HPC) prints the simulation clock as h:mm:ss at the start
+# of a progress line, the logs also contain "Time = 1.25 h" style values.
+CLOCK_PATTERN = re.compile(r"^\s*(-?\d+):(\d{2}):(\d{2}(?:\.\d+)?)\b")
+HOURS_PATTERN = re.compile(
+    r"\b(?:sim(?:ulation)?\s+)?time\s*[=:]\s*(-?\d+(?:\.\d+)?)\s*(?:h|hr|hrs|hours)\b",
+    re.IGNORECASE,
+)
+TIMESTEP_PATTERN = re.compile(
+    r"\bdt(?:2d)?\s*[=:]?\s*(\d+(?:\.\d+)?(?:[eE][-+]?\d+)?)", re.IGNORECASE
+)
+WET_CELLS_PATTERN = re.compile(r"\bn?wet(?:\s*cells)?\s*[=:]?\s*(\d+)", re.IGNORECASE)
+
+
+def parse_progress_line(line):
+    """Return the simulated time (h), timestep (s) and wet cells in a line."""
+    progress = {}
+    clock = CLOCK_PATTERN.match(line)
+    if clock:
+        hours, minutes, seconds = clock.groups()
+        sign = -1 if hours.startswith("-") else 1
+        progress["simulated_time"] = sign * (
+            abs(int(hours)) + int(minutes) / 60 + float(seconds) / 3600
+        )
+    else:
+        hours = HOURS_PATTERN.search(line)
+        if hours:
+            progress["simulated_time"] = float(hours.group(1))
+    timestep = TIMESTEP_PATTERN.search(line)
+    if timestep:
+        progress["timestep"] = float(timestep.group(1))
+    wet_cells = WET_CELLS_PATTERN.search(line)
+    if wet_cells:
+        progress["wet_cells"] = int(wet_cells.group(1))
+    return progress
+
+
+class TuflowSupervisor:
+    """Run TUFLOW and follow its progress while it runs.
+
+    stdout and the .tlf log are streamed line by line and parsed for the
+    simulated time, timestep and wet cells. ``progress`` and ``eta`` are
+    available while the model runs, progress is logged every
+    ``PROGRESS_LOG_SECONDS`` and exported as metrics. Callbacks registered with
+    ``add_milestone`` are called (from the reader thread) as soon as the
+    simulated time passes their time. A ResourceWatchdog samples the process
+    and enforces ``max_wall_seconds`` and ``max_rss_bytes``.
+    """
+
+    def __init__(
+        self,
+        command,
+        start_time,
+        end_time,
+        log_files=(),
+        name=None,
+        max_wall_seconds=None,
+        max_rss_bytes=None,
+        sample_seconds=DEFAULT_SAMPLE_SECONDS,
+    ):
+        self.command = command
+        self.max_wall_seconds = max_wall_seconds
+        self.max_rss_bytes = max_rss_bytes
+        self.sample_seconds = sample_seconds
+        self.watchdog = None
+        self.name = name
+        self.log_prefix = "TUFLOW {}".format(name) if name else "TUFLOW"
+        self.metric_labels = {"domain": name} if name else {}
+        self.start_time = float(start_time)
+        self.end_time = float(end_time)
+        self.log_files = [Path(f) for f in log_files]
+        self.simulated_time = None
+        self.timestep = None
+        self.wet_cells = None
+        self.started = None
+        self.started_wall_time = None
+        self.finished = threading.Event()
+        self.tail = deque(maxlen=TAIL_LINES)
+        self.milestones = []
+        self.lock = threading.Lock()
+        self.last_progress_log = 0
+
+    def add_milestone(self, simulated_time, callback):
+        """Call ``callback(simulated_time)`` once TUFLOW passed that time (h)."""
+        with self.lock:
+            self.milestones.append((float(simulated_time), callback))
+            self.milestones.sort(key=lambda milestone: milestone[0])
+
+    @property
+    def progress(self):
+        """Fraction of the simulation period done, None before the first step."""
+        if self.simulated_time is None or self.end_time <= self.start_time:
+            return None
+        fraction = (self.simulated_time - self.start_time) / (
+            self.end_time - self.start_time
+        )
+        return min(max(fraction, 0.0), 1.0)
+
+    @property
+    def eta(self):
+        """Estimated seconds until TUFLOW finishes, None when unknown."""
+        progress = self.progress
+        if not progress or self.started is None:
+            return None
+        elapsed = time.monotonic() - self.started
+        return elapsed * (1 - progress) / progress
+
+    def update(self, line):
+        progress = parse_progress_line(line)
+        if not progress:
+            return
+        reached = []
+        with self.lock:
+            simulated_time = progress.get("simulated_time")
+            if simulated_time is not None and (
+                self.simulated_time is None or simulated_time > self.simulated_time
+            ):
+                self.simulated_time = simulated_time
+                while self.milestones and self.milestones[0][0] <= simulated_time:
+                    reached.append(self.milestones.pop(0))
+            self.timestep = progress.get("timestep", self.timestep)
+            self.wet_cells = progress.get("wet_cells", self.wet_cells)
+
+        for milestone_time, callback in reached:
+            try:
+                callback(milestone_time)
+            except Exception:
+                logger.exception("milestone callback at %s h failed", milestone_time)
+        self.report()
+
+    def report(self, force=False):
+        if self.simulated_time is None:
+            return
+        metrics.set_gauge(
+            "tuflow_simulated_hours", self.simulated_time, **self.metric_labels
+        )
+        metrics.set_gauge(
+            "tuflow_progress_ratio", self.progress or 0.0, **self.metric_labels
+        )
+        now = time.monotonic()
+        if not force and now - self.last_progress_log < PROGRESS_LOG_SECONDS:
+            return
+        self.last_progress_log = now
+        eta = self.eta
+        logger.info(
+            "%s at %.2f h (%.0f%%), dt %s s, %s wet cells, ETA %s",
+            self.log_prefix,
+            self.simulated_time,
+            100 * (self.progress or 0.0),
+            self.timestep,
+            self.wet_cells,
+            "{:.0f} s".format(eta) if eta is not None else "unknown",
+        )
+
+    def read_stdout(self, stream):
+        for line in stream:
+            line = line.rstrip()
+            if line:
+                self.tail.append(line)
+                logger.debug("%s: %s", self.log_prefix, line)
+                self.update(line)
+
+    def follow_log(self, log_file):
+        """Follow a log file once it is (re)written after the start of the run."""
+        while not (
+            log_file.exists() and log_file.stat().st_mtime >= self.started_wall_time
+        ):
+            if self.finished.wait(LOG_POLL_SECONDS):
+                return
+        logger.debug("following TUFLOW log %s", log_file)
+        with open(log_file, errors="replace") as f:
+            buffer = ""
+            while True:
+                chunk = f.read()
+                if chunk:
+                    buffer += chunk
+                    *lines, buffer = buffer.split("\n")
+                    for line in lines:
+                        self.update(line)
+                elif self.finished.wait(LOG_POLL_SECONDS):
+                    # read what was written after the last poll
+                    for line in (buffer + f.read()).split("\n"):
+                        self.update(line)
+                    return
+
+    def run(self):
+        """Run TUFLOW, return its exit code."""
+        self.started = time.monotonic()
+        # logs of a previous run may be left, allow for coarse file mtimes
+        self.started_wall_time = time.time() - LOG_POLL_SECONDS
+        process = subprocess.Popen(
+            self.command,
+            stdout=subprocess.PIPE,
+            stderr=subprocess.STDOUT,
+            stdin=subprocess.DEVNULL,
+            text=True,
+            errors="replace",
+            bufsize=1,
+        )
+        stdout_reader = threading.Thread(
+            target=self.read_stdout, args=(process.stdout,), name="tuflow-stdout"
+        )
+        log_followers = [
+            threading.Thread(
+                target=self.follow_log, args=(log_file,), name="tuflow-log"
+            )
+            for log_file in self.log_files
+        ]
+        self.watchdog = ResourceWatchdog(
+            process,
+            self.log_prefix,
+            self.sample_seconds,
+            self.max_wall_seconds,
+            self.max_rss_bytes,
+            self.metric_labels,
+        )
+        for thread in [stdout_reader] + log_followers:
+            thread.start()
+        self.watchdog.start()
+        try:
+            returncode = process.wait()
+        except BaseException:
+            process.kill()
+            raise
+        finally:
+            self.watchdog.stop()
+            stdout_reader.join()
+            self.finished.set()
+            for thread in log_followers:
+                thread.join()
+            process.stdout.close()
+        self.report(force=True)
+        summary = self.watchdog.summary()
+        if summary:
+            logger.info(
+                "%s used %.0f CPU s (mean %.0f%%), peak RSS %.0f MB",
+                self.log_prefix,
+                summary["cpu_seconds"],
+                summary["mean_cpu_percent"],
+                summary["peak_rss_bytes"] / 1e6,
+            )
+        if returncode != 0:
+            logger.error(
+                "%s exited with code %s, last output:\n%s",
+                self.log_prefix,
+                returncode,
+                "\n".join(self.tail),
+            )
+        return returncode